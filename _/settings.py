@@ -147,8 +147,41 @@ APSCHEDULER_DATETIME_FORMAT = 'N j, Y, f:s a'
 # options).
 APSCHEDULER_RUN_NOW_TIMEOUT = 25  # Seconds
 
+# The max number of unused SaFunctions or orphan files removed in one batch
+# by the cleanup routine.
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', '1000'))
+
 FILE_UPLOAD_DIR = 'datas/upload/'
 RESULT_DIR = os.path.join(FILE_UPLOAD_DIR, 'result/')
+# The uploaded files are kept in BLOB_DIR by the SHA-256 of their content,
+# the files with the same content share one blob.
+BLOB_DIR = os.path.join(FILE_UPLOAD_DIR, 'blobs/')
+# The max total size (bytes) of the extracted files of an uploaded archive.
+ARCHIVE_UPLOAD_MAX_SIZE = int(os.getenv('ARCHIVE_UPLOAD_MAX_SIZE', str(512 * 1024 * 1024)))
+
+# The built device zip files are kept in BUILD_CACHE_DIR by the hash of their build
+# inputs. The least recently used ones are removed once the total size of the cache
+# exceeds BUILD_CACHE_MAX_SIZE (bytes).
+BUILD_CACHE_DIR = os.path.join(RESULT_DIR, 'cache/')
+BUILD_CACHE_MAX_SIZE = int(os.getenv('BUILD_CACHE_MAX_SIZE', str(512 * 1024 * 1024)))
+
+# The max number of compiled Jinja2 templates kept in each process.
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '256'))
+
+# The device builds run in DEVICE_BUILD_WORKERS background threads of each process,
+# at most DEVICE_BUILD_QUEUE_SIZE builds can wait in the queue.
+# Set DEVICE_BUILD_WORKERS to 0 to run the builds in the request thread.
+DEVICE_BUILD_WORKERS = int(os.getenv('DEVICE_BUILD_WORKERS', '2'))
+DEVICE_BUILD_QUEUE_SIZE = int(os.getenv('DEVICE_BUILD_QUEUE_SIZE', '20'))
+# The seconds a build can be queued or running, a build not done by then is failed.
+# The builds of an exited process are failed once it's found.
+DEVICE_BUILD_TIMEOUT = int(os.getenv('DEVICE_BUILD_TIMEOUT', '600'))
+# The max number of devices built by one batch build (api/device/batch).
+DEVICE_BUILD_BATCH_MAX_SIZE = int(os.getenv('DEVICE_BUILD_BATCH_MAX_SIZE', '100'))
+# The lock files of the device builds and the chunked uploads. The builds of the same
+# device or device-library, and the chunks of the same file, run one by one in all
+# the processes. It must not be under FILE_UPLOAD_DIR.
+BUILD_LOCK_DIR = 'datas/lock/'
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.2/howto/static-files/
@@ -266,6 +299,14 @@ XTALK_OAUTH2_CLIENT_SECRET = os.getenv('XTALK_OAUTH2_CLIENT_SECRET')
 
 # AutoGen setting
 AUTOGEN_CCMAPI_URL = os.getenv('AUTOGEN_CCMAPI_URL')
+# The timeout (seconds) of each request to the AG server.
+AG_REQUEST_TIMEOUT = float(os.getenv('AG_REQUEST_TIMEOUT', '5'))
+# The device object information got from the AG server is cached for AG_INFO_CACHE_TTL
+# seconds. After that, the cached one is still used for at most AG_INFO_CACHE_STALE
+# seconds while it's refreshed in background. If the AG server fails, the cached one
+# is used no matter how old it is.
+AG_INFO_CACHE_TTL = int(os.getenv('AG_INFO_CACHE_TTL', '60'))
+AG_INFO_CACHE_STALE = int(os.getenv('AG_INFO_CACHE_STALE', '3600'))
 
 # DeviceTalk setting
 DA_SERVER_URL_DEFAULT = os.getenv('IOTTALK_EC_URL')
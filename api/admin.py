@@ -13,6 +13,7 @@ from .models import (
     DeviceLibraryDf,
     DeviceDfHasSaFunction,
     DeviceLibraryDfHasSaFunction,
+    BuildJob,
 )
 
 
@@ -27,6 +28,12 @@ class SaFunctionAdmin(admin.ModelAdmin):
     list_filter = ('function_type', )
 
 
+class BuildJobAdmin(admin.ModelAdmin):
+    readonly_fields = ('created_at', 'updated_at')
+    list_display = ('uuid', 'device', 'state', 'updated_at')
+    list_filter = ('state', )
+
+
 class LibraryPoolAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'user')
 
@@ -47,3 +54,4 @@ admin.site.register(DeviceDf)
 admin.site.register(DeviceLibraryDf)
 admin.site.register(DeviceDfHasSaFunction)
 admin.site.register(DeviceLibraryDfHasSaFunction)
+admin.site.register(BuildJob, BuildJobAdmin)
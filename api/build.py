@@ -0,0 +1,1123 @@
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import queue
+import shutil
+import socket
+import struct
+import threading
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import (
+    BuildJob,
+    DeviceDfHasSaFunction,
+)
+from .utils import (
+    ContentRender,
+    copy_file,
+    function_render,
+)
+from file_handle.models import File
+
+logger = logging.getLogger(__name__)
+
+# Bump this version when the layout of the generated zip file changes,
+# so the old cached zip files will not be used anymore.
+BUILD_KEY_VERSION = 1
+
+
+class BuildCache:
+    """ This class keep the built zip files in `cache_dir`, named by their build key.
+        The least recently used zip files are removed once the total size of
+        the cache exceeds `max_size`.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '%s.zip' % key)
+
+    def temp_path(self, key):
+        # Each build writes its own temp file, then moves it into the cache.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir, '%s.%s.tmp' % (key, uuid.uuid4().hex))
+
+    def get(self, key):
+        """ Return the path of the cached zip file, or None if cache miss.
+        """
+        path = self.path(key)
+        try:
+            # Mark this zip file as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, temp_path):
+        """ Move the built zip file into the cache and return its path.
+        """
+        path = self.path(key)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    @contextlib.contextmanager
+    def lock(self, key, kind='build'):
+        """ Hold the lock of building the zip file of `key`. So only one of the
+            identical builds in all the threads and processes runs, the others wait
+            for it and take its zip file from the cache. Each key has its own lock file,
+            it's removed when the lock is released, so they don't pile up.
+        """
+        with file_lock('%s-%s' % (kind, key)):
+            yield
+
+    def evict(self, keep=None):
+        # Collect all the cached zip files, the oldest one first.
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.zip'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total_size = sum(size for __, size, __ in entries)
+        for __, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+build_cache = BuildCache(settings.BUILD_CACHE_DIR, settings.BUILD_CACHE_MAX_SIZE)
+
+
+@contextlib.contextmanager
+def file_lock(name):
+    # Serialize the threads and the processes holding the lock of the same `name`.
+    # The lock file is removed when the lock is released, so they don't pile up.
+    os.makedirs(settings.BUILD_LOCK_DIR, exist_ok=True)
+    path = os.path.join(settings.BUILD_LOCK_DIR, '%s.lock' % name)
+    while True:
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # The lock file may be removed by its last holder while waiting for it,
+        # then lock the new one.
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield
+    finally:
+        os.remove(path)
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+@contextlib.contextmanager
+def build_lock(device_object, device_lib_object):
+    # The builds of the same device or the same device-library run one by one.
+    # The device's lock is always taken first, so they never deadlock.
+    with file_lock('device-%d' % device_object.id), \
+            file_lock('devicelibrary-%d' % device_lib_object.id):
+        yield
+
+
+def publish_file(src, dst):
+    # Put the file `src` at `dst` by hard link, fall back to copy.
+    # The new file replaces `dst` atomically, so `src` is never modified through `dst`.
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp_path = '%s.%s.tmp' % (dst, uuid.uuid4().hex)
+    try:
+        os.link(src, temp_path)
+    except OSError:
+        shutil.copyfile(src, temp_path)
+    os.replace(temp_path, dst)
+    # The rename does nothing if `dst` is a hard link of `src` already.
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+def file_content_key(file_object):
+    # Identify the content of the file: its SHA-256 if it's in the blob store,
+    # otherwise its uuid and the time it's updated.
+    return file_object.sha256 or [file_object.uuid.hex, str(file_object.updated_at)]
+
+
+def _is_static_file(config_result, file_path):
+    # Whether the basic file's file is copied into the zip file as is.
+    # Ignore config file, templates, device-library template(device_lib_path),
+    # new sa function template (idf_template, odf_template)
+    if file_path in config_result['template']:
+        return False
+    elif file_path == settings.BASICFILE_CONF_FILENAME:
+        return False
+    elif file_path in config_result['idf_template']:
+        return False
+    elif file_path in config_result['odf_template']:
+        return False
+    elif file_path in config_result['device_lib_path']:
+        return False
+    return True
+
+
+def _bundle(kind, group_id, file_objects, build=True):
+    # Return the path of the bundle of `file_objects` in `build_cache`, build it if
+    # it's not there. The entries are named by the files' `file_path`.
+    # If not `build`, return None if it's not there.
+    key = hashlib.sha256(json.dumps({
+        'version': BUILD_KEY_VERSION,
+        'bundle': [kind, group_id],
+        'files': sorted(
+            [file.file_path, file.uuid.hex, str(file.updated_at)]
+            for file in file_objects
+        ),
+    }, sort_keys=True).encode()).hexdigest()
+    path = build_cache.get(key)
+    if path is not None or not build:
+        return path
+    with build_cache.lock(key, 'bundle'):
+        # It may be built while waiting for the lock.
+        path = build_cache.get(key)
+        if path is not None:
+            return path
+        temp_path = build_cache.temp_path(key)
+        try:
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for file in file_objects:
+                    copy_file(file, file.file_path, zip_file)
+        except:
+            os.remove(temp_path)
+            raise
+        return build_cache.put(key, temp_path)
+
+
+def basic_file_static_files(basic_file_object, file_objects=None):
+    # Return the basic file's files which are copied into the zip file as is.
+    if file_objects is None:
+        file_objects = basic_file_object.file_set.all()
+    config_result = basic_file_object.get_all_config()
+    return [
+        file for file in file_objects if _is_static_file(config_result, file.file_path)
+    ]
+
+
+def basic_file_bundle(basic_file_object, file_objects=None, build=True):
+    """ Return the path of the pre-compressed bundle of the basic file's static files,
+        which are the same in all the device zip files.
+        It's kept in `build_cache` and built again if it's removed from there,
+        unless `build` is False, then None is returned.
+    """
+    return _bundle(
+        'basic_file',
+        basic_file_object.id,
+        basic_file_static_files(basic_file_object, file_objects),
+        build
+    )
+
+
+def library_bundle(library_object, file_objects=None, build=True):
+    """ Return the path of the pre-compressed bundle of all the library's files.
+        It's kept in `build_cache` and built again if it's removed from there,
+        unless `build` is False, then None is returned.
+    """
+    if file_objects is None:
+        file_objects = library_object.file_set.all()
+    return _bundle('library', library_object.id, list(file_objects), build)
+
+
+def _splice_entry_raw(src_zip, src_info, zip_file, info):
+    # Copy the compressed data of `src_info` as is. zipfile has no public API for
+    # this, so this uses its internals, see `_can_splice_raw`.
+    fp = src_zip.fp
+    # Skip the local file header of the entry, see `zipfile.ZipFile.open`.
+    fp.seek(src_info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    fp.seek(
+        fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH],
+        os.SEEK_CUR
+    )
+
+    # The sizes are written in the local file header, no data descriptor.
+    info.flag_bits = src_info.flag_bits & ~0x08
+    info.CRC = src_info.CRC
+    info.compress_size = src_info.compress_size
+    info.file_size = src_info.file_size
+
+    # This does what `zipfile.ZipFile.write` does for a new entry.
+    with zip_file._lock:
+        zip_file._writecheck(info)
+        zip_file._didModify = True
+        info.header_offset = zip_file.fp.tell()
+        zip64 = (info.file_size > zipfile.ZIP64_LIMIT
+                 or info.compress_size > zipfile.ZIP64_LIMIT)
+        zip_file.fp.write(info.FileHeader(zip64))
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile('Truncated entry %s' % src_info.filename)
+            zip_file.fp.write(chunk)
+            remaining -= len(chunk)
+        zip_file.filelist.append(info)
+        zip_file.NameToInfo[info.filename] = info
+        zip_file.start_dir = zip_file.fp.tell()
+
+
+def _splice_entry_copy(src_zip, src_info, zip_file, info):
+    # Decompress and compress the entry again with the public API.
+    with src_zip.open(src_info) as src, zip_file.open(info, 'w') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+# If the private zipfile internals used by `_splice_entry_raw` work in this Python,
+# None if it's not checked yet.
+_raw_splice_supported = None
+
+
+def _can_splice_raw():
+    """ Return if `_splice_entry_raw` works in this Python. It's checked once by
+        splicing a small zip file into a seekable and an unseekable zip file
+        and reading them back.
+    """
+    global _raw_splice_supported
+    if _raw_splice_supported is not None:
+        return _raw_splice_supported
+    content = b'splice test\n' * 100
+    try:
+        src_buffer = io.BytesIO()
+        with zipfile.ZipFile(src_buffer, 'w', zipfile.ZIP_DEFLATED) as src_zip:
+            src_zip.writestr('a/b.txt', content)
+            src_zip.writestr('c.txt', b'')
+        for dst in (io.BytesIO(), ZipStream()):
+            with zipfile.ZipFile(src_buffer) as src_zip:
+                with zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                    for src_info in src_zip.infolist():
+                        _splice_entry_raw(
+                            src_zip, src_info, zip_file, _splice_info(src_info, 'x'))
+            data = dst.getvalue() if isinstance(dst, io.BytesIO) else dst.pop()
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                if (zip_file.testzip() is not None
+                        or zip_file.read('x/a/b.txt') != content
+                        or zip_file.read('x/c.txt') != b''):
+                    raise zipfile.BadZipFile('Spliced zip file is different')
+        _raw_splice_supported = True
+    except:
+        logger.exception('Cannot copy the compressed zip entries as is, '
+                         'they will be compressed again.')
+        _raw_splice_supported = False
+    return _raw_splice_supported
+
+
+def _splice_info(src_info, prefix):
+    # Return the ZipInfo of the entry `src_info` under the directory `prefix`.
+    info = zipfile.ZipInfo(
+        os.path.normpath(os.path.join(prefix, src_info.filename)),
+        src_info.date_time
+    )
+    info.compress_type = src_info.compress_type
+    info.create_system = src_info.create_system
+    info.external_attr = src_info.external_attr
+    return info
+
+
+def splice_zip(src_zip, zip_file, prefix):
+    """ Copy all the entries of `src_zip` (zipfile.ZipFile) into `zip_file` under the
+        directory `prefix`. The compressed data is copied as is, without recompressing,
+        if `_can_splice_raw`, otherwise the entries are compressed again.
+        Return the number of the copied entries.
+    """
+    splice_entry = _splice_entry_raw if _can_splice_raw() else _splice_entry_copy
+    src_infos = src_zip.infolist()
+    for src_info in src_infos:
+        splice_entry(src_zip, src_info, zip_file, _splice_info(src_info, prefix))
+    return len(src_infos)
+
+
+# The size of the chunks of a streamed zip file read from the build cache.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class ZipStream:
+    """ This class is a write-only file object for `zipfile.ZipFile`, it keeps
+        the written data until `pop` is called. So a zip file can be sent while
+        it's generated.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        # Return and clear all the data written since the last `pop`.
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class BuildStats:
+    """ This class record the time spent in each stage of one build,
+        and the amount of work done by the build.
+    """
+    # queue: waiting in the build queue.
+    # db: loading the build inputs and computing the build key.
+    # function_render: rendering the SA functions' code.
+    # render: rendering the templates, into the zip file or the device-library file.
+    # copy: copying the files into the zip file.
+    # zip: finishing the zip file and putting it into the build cache,
+    #      or restoring the device-library file from the cached zip file.
+    # publish: linking the zip file to the device's file.
+    STAGES = ('queue', 'lock', 'db', 'function_render', 'render', 'copy', 'zip', 'publish')
+    COUNTERS = ('templates_rendered', 'files_copied', 'bytes_written', 'cache_hits')
+
+    def __init__(self):
+        self.timers = {stage: 0.0 for stage in self.STAGES}
+        self.counters = {counter: 0 for counter in self.COUNTERS}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter() - start
+
+    @property
+    def info(self):
+        return {
+            'seconds': {stage: round(t, 6) for stage, t in self.timers.items()},
+            **self.counters,
+        }
+
+
+class BuildMetrics:
+    """ This class accumulate the BuildStats of all the builds in this process,
+        so the regressions of each stage can be found, and the workers can be sized.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.failed_builds = 0
+        self.timers = {stage: 0.0 for stage in BuildStats.STAGES}
+        self.counters = {counter: 0 for counter in BuildStats.COUNTERS}
+
+    def add(self, stats, failed=False):
+        with self._lock:
+            self.builds += 1
+            if failed:
+                self.failed_builds += 1
+            for stage, t in stats.timers.items():
+                self.timers[stage] += t
+            for counter, value in stats.counters.items():
+                self.counters[counter] += value
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'builds': self.builds,
+                'failed_builds': self.failed_builds,
+                'seconds': {stage: round(t, 6) for stage, t in self.timers.items()},
+                **self.counters,
+            }
+
+
+build_metrics = BuildMetrics()
+
+
+class BuildInputs:
+    """ This class load the build inputs which are shared by the devices only once:
+        the files of the basic files and the libraries, and the template sources.
+        The builds of a batch share one BuildInputs, so the shared inputs are read
+        once for the whole batch.
+    """
+    def __init__(self):
+        # {('basic_file' | 'library', id): [file_object<File>, ...]}
+        self._file_lists = {}
+        # {file_id: template source<str>}
+        self._sources = {}
+
+    def basic_files(self, basic_file_object):
+        return self._files(('basic_file', basic_file_object.id), basic_file_object)
+
+    def library_files(self, library_object):
+        return self._files(('library', library_object.id), library_object)
+
+    def _files(self, key, file_group_object):
+        file_objects = self._file_lists.get(key)
+        if file_objects is None:
+            file_objects = list(file_group_object.file_set.all())
+            self._file_lists[key] = file_objects
+        return file_objects
+
+    def source(self, file_object):
+        # Return the content of the template file.
+        source = self._sources.get(file_object.id)
+        if source is None:
+            with file_object.open('r') as f:
+                source = f.read()
+            self._sources[file_object.id] = source
+        return source
+
+    def basic_file_source(self, basic_file_object, file_path):
+        # Return the content of the template file `file_path` in the basic file.
+        file_objects = [
+            file_object for file_object in self.basic_files(basic_file_object)
+            if file_object.file_path == file_path
+        ]
+        if len(file_objects) != 1:
+            raise File.DoesNotExist('%s not found in %s' % (file_path, basic_file_object))
+        return self.source(file_objects[0])
+
+
+class DeviceBuilder:
+    """ This class generate the device-library file and the SA code zip file of a device.
+        The generated zip file is kept in `build_cache` by the hash of all the build
+        inputs, so building a device with the same inputs again renders nothing.
+    """
+    def __init__(self, device_object, used_df_list, stats=None, inputs=None):
+        """
+            Input::
+                device_object: api.models.Device
+                used_df_list: list of the name of the used dfs in this device.
+                stats: BuildStats, the time and work of this build are recorded in it.
+                inputs: BuildInputs, the inputs shared with the other builds.
+        """
+        self.device = device_object
+        self.stats = stats or BuildStats()
+        self.inputs = inputs or BuildInputs()
+        with self.stats.timer('db'):
+            self.basic_file = device_object.basic_file
+            self.config_result = self.basic_file.get_all_config()
+            self.lib_root = self.basic_file.lib_root
+            self.used_df_objects = [
+                df_object
+                for df_object in device_object.df_set.select_related('df_type')
+                if df_object.name in used_df_list
+            ]
+            # The selected function of each used df. The build key and the rendering
+            # both use these objects, so the key always matches what's rendered.
+            self.selected_relations = {}
+            for relation in DeviceDfHasSaFunction.objects.filter(
+                device__in=self.used_df_objects,
+                selected=True
+            ).select_related('function__function_type').order_by('id'):
+                self.selected_relations.setdefault(relation.device_id, relation)
+        # {device_lib_id: (dependency libraries, device-library's files)}
+        self._device_lib_inputs = {}
+
+        # Create the render context.
+        # The `functions` is rendered only when the zip file is really built.
+        self.context = {
+            'sa': {
+                'device_name': device_object.name,
+                'global_variable_setup': device_object.global_var_setup
+            },
+            'da': {
+                'server_url': device_object.server_url,
+                'device_model': device_object.dm_name,
+                'device_addr': device_object.device_address,
+                'push_interval': device_object.push_interval,
+            },
+            'functions': [],
+            'idf': self._df_context('idf'),
+            'odf': self._df_context('odf'),
+        }
+        self.content_render = ContentRender(self.context)
+
+    def _df_context(self, df_type):
+        df_objects = [
+            df_object for df_object in self.used_df_objects
+            if df_object.df_type.df_type == df_type
+        ]
+        return {
+            'name_list': [df_object.name for df_object in df_objects],
+            'info': [
+                {
+                    'name': df_object.name,
+                    'func_name': df_object.re_name,
+                    'params': {
+                        'list': df_object.df_type.params,
+                        'set': set(df_object.df_type.params),
+                        'len': len(df_object.df_type.params),
+                        'set_len': len(set(df_object.df_type.params)),
+                    }
+                }
+                for df_object in df_objects
+            ]
+        }
+
+    @property
+    def device_lib_path(self):
+        """ Return the path of the device-library file, relative to `lib_root`.
+            Ex: `Dummy_demo_library/...`
+        """
+        # render the lib path from format-string. Ex:
+        # config_result['device_lib_path'][0]: libraries/{sa[device_name]}_library/...
+        # new_lib_file_path: libraries/Dummy_demo_library/...
+        new_lib_file_path = self.content_render.render_string(
+            self.config_result['device_lib_path'][0], False
+        )
+        return os.path.relpath(new_lib_file_path, self.lib_root)
+
+    def build_key(self, device_lib_object):
+        """ Return the hash of all the inputs of this build. Only the content is hashed,
+            not the ids of the rows, so the devices with the same content share
+            the zip file, ex: the same device saved by different users.
+        """
+        device = self.device
+        libraries, device_lib_files = self.device_lib_inputs(device_lib_object)
+        relations = [
+            (df_object.name, self.selected_relations.get(df_object.id))
+            for df_object in self.used_df_objects
+        ]
+        inputs = {
+            'version': BUILD_KEY_VERSION,
+            'device': [
+                device.name,
+                device.dm_name,
+                device.global_var_setup,
+            ],
+            'da': [
+                device.server_url,
+                device.device_address,
+                device.push_interval,
+            ],
+            'dfs': [
+                [df_object.name, df_object.df_type.df_type, df_object.df_type.params]
+                for df_object in self.used_df_objects
+            ],
+            'functions': [
+                [
+                    df_name,
+                    relation.var_setup,
+                    relation.function.name,
+                    relation.function.code,
+                    relation.function.readonly_lines,
+                    relation.function.function_type.df_type,
+                ]
+                if relation is not None else None
+                for df_name, relation in relations
+            ],
+            'basic_files': sorted(
+                [file.file_path, file_content_key(file)]
+                for file in self.inputs.basic_files(self.basic_file)
+            ),
+            'lib_files': sorted(
+                [file.file_path, file_content_key(file)]
+                for library in libraries
+                for file in self.inputs.library_files(library)
+            ),
+            # The first file is generated from the other inputs.
+            'device_lib_files': [device_lib_files[0].file_path] + sorted(
+                [file.file_path, file_content_key(file)] for file in device_lib_files[1:]
+            ),
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode()
+        ).hexdigest()
+
+    def device_lib_inputs(self, device_lib_object):
+        """ Return the dependency libraries and the files of the device-library.
+            They are loaded once, the build key and the zip file both use them.
+        """
+        inputs = self._device_lib_inputs.get(device_lib_object.id)
+        if inputs is None:
+            inputs = (
+                list(device_lib_object.dependency_library.order_by('id')),
+                list(device_lib_object.file.order_by('id')),
+            )
+            self._device_lib_inputs[device_lib_object.id] = inputs
+        return inputs
+
+    def _zip_entry_name(self, *path):
+        return os.path.normpath(os.path.join(self.device.name, *path))
+
+    def build(self, device_lib_object):
+        """ Write the device-library file and the SA code zip file of this device.
+            The builds of the same device or device-library wait for each other.
+            Input::
+                device_lib_object: api.models.DeviceLibrary, the device-library
+                    generated by this device.
+            Output::
+                bool. True if the zip file is taken from the build cache.
+        """
+        start = time.perf_counter()
+        with build_lock(self.device, device_lib_object):
+            # The time waiting for the other builds.
+            self.stats.timers['lock'] += time.perf_counter() - start
+            return self._build(device_lib_object)
+
+    def _build(self, device_lib_object):
+        stats = self.stats
+        with stats.timer('db'):
+            key = self.build_key(device_lib_object)
+        is_cached = True
+        cached_path = build_cache.get(key)
+        if cached_path is None:
+            # Only one of the identical builds runs, the others wait for it
+            # and take its zip file from the build cache.
+            start = time.perf_counter()
+            with build_cache.lock(key):
+                stats.timers['lock'] += time.perf_counter() - start
+                cached_path = build_cache.get(key)
+                if cached_path is None:
+                    is_cached = False
+                    cached_path = self._build_zip(key, device_lib_object)
+        if is_cached:
+            self._restore_device_library(cached_path, device_lib_object)
+
+        with stats.timer('publish'):
+            publish_file(cached_path, self.device.file.real_path)
+        return is_cached
+
+    def _restore_device_library(self, cached_path, device_lib_object):
+        # The device-library file is in the cached zip file already.
+        stats = self.stats
+        stats.counters['cache_hits'] += 1
+        with stats.timer('zip'), zipfile.ZipFile(cached_path) as zip_file:
+            for file in self.device_lib_inputs(device_lib_object)[1]:
+                entry_name = self._zip_entry_name(self.lib_root, file.file_path)
+                content = zip_file.read(entry_name)
+                file.write(content)
+                stats.counters['bytes_written'] += len(content)
+
+    def _build_zip(self, key, device_lib_object):
+        # Write the device-library file and put the zip file into the build cache,
+        # return the cached zip file's path.
+        stats = self.stats
+        self._render_functions()
+        with stats.timer('render'):
+            self._write_device_library(device_lib_object)
+        # Each build writes its own temp file, then moves it into the cache.
+        temp_path = build_cache.temp_path(key)
+        try:
+            self._write_zip(device_lib_object, temp_path)
+        except:
+            os.remove(temp_path)
+            raise
+        with stats.timer('zip'):
+            stats.counters['bytes_written'] += os.path.getsize(temp_path)
+            return build_cache.put(key, temp_path)
+
+    def _render_device_library(self):
+        # Get SA template from basic file and return the device-library file's content.
+        new_lib_file_template = self.inputs.basic_file_source(
+            self.basic_file, self.config_result['device_lib_path'][0]
+        )
+        return self.content_render.render_string(new_lib_file_template)
+
+    def _write_device_library(self, device_lib_object):
+        # Write the result into device-library file.
+        self.device_lib_inputs(device_lib_object)[1][0].write(
+            self._render_device_library())
+
+    def _render_functions(self):
+        with self.stats.timer('function_render'):
+            self.context['functions'] = [
+                function_render(df_object, self.selected_relations.get(df_object.id))
+                for df_object in self.used_df_objects
+            ]
+
+    def stream(self, device_lib_object):
+        """ Generate the SA code zip file of this device, and yield its content chunk
+            by chunk while it's generated. The zip file is not saved: it's not put
+            into `build_cache` and the device's file is not changed. Only the
+            device-library file is written like `build`, so it matches the saved
+            device. No lock is held while the content is yielded.
+            Input::
+                device_lib_object: api.models.DeviceLibrary, the device-library
+                    generated by this device.
+        """
+        stats = self.stats
+        start = time.perf_counter()
+        with build_lock(self.device, device_lib_object):
+            stats.timers['lock'] += time.perf_counter() - start
+            with stats.timer('db'):
+                key = self.build_key(device_lib_object)
+            self._render_functions()
+            with stats.timer('render'):
+                device_lib_content = self._render_device_library()
+                self.device_lib_inputs(device_lib_object)[1][0].write(device_lib_content)
+
+        # Send the zip file built with the same inputs already.
+        cached_path = build_cache.get(key)
+        if cached_path is not None:
+            try:
+                f = open(cached_path, 'rb')
+            except FileNotFoundError:
+                # Just evicted from the build cache.
+                pass
+            else:
+                stats.counters['cache_hits'] += 1
+                with f:
+                    for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                        yield chunk
+                return
+
+        stream = ZipStream()
+        zip_file = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for __ in self._write_entries(
+                    device_lib_object, zip_file, device_lib_content, build_bundles=False):
+                chunk = stream.pop()
+                if chunk:
+                    stats.counters['bytes_written'] += len(chunk)
+                    yield chunk
+        finally:
+            with stats.timer('zip'):
+                zip_file.close()
+        chunk = stream.pop()
+        stats.counters['bytes_written'] += len(chunk)
+        yield chunk
+
+    def _write_zip(self, device_lib_object, dst):
+        zip_file = zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for __ in self._write_entries(device_lib_object, zip_file):
+                pass
+        finally:
+            with self.stats.timer('zip'):
+                zip_file.close()
+
+    def _write_entries(self, device_lib_object, zip_file, device_lib_content=None,
+                       build_bundles=True):
+        """ Write all the entries of the SA code into `zip_file`. This is a generator,
+            it yields after each rendered file and each copied bundle.
+            Input::
+                device_lib_content: str, if given, it's written as the device-library
+                    file instead of copying the file.
+                build_bundles: bool, if False, the bundles not in `build_cache` are
+                    not built, their files are copied one by one.
+        """
+        config_result = self.config_result
+        # Get all SA code's file objects.
+        basic_files = self.inputs.basic_files(self.basic_file)
+        # Get all dependency libraries and the device-library's files.
+        libraries, device_lib_files = self.device_lib_inputs(device_lib_object)
+
+        # All the entries are written straight into the zip file under `<d_name>/`.
+        stats = self.stats
+        # Render templates into the zip file.
+        for file in basic_files:
+            if file.file_path in config_result['template']:
+                entry_name = self._zip_entry_name(file.file_path)
+                with stats.timer('render'):
+                    self.content_render.render_file(
+                        file, entry_name, zip_file, source=self.inputs.source(file)
+                    )
+                stats.counters['templates_rendered'] += 1
+                yield
+
+        # Copy the other basic files and all the libraries files
+        # from their pre-compressed bundles.
+        with stats.timer('copy'):
+            stats.counters['files_copied'] += self._splice_bundle(
+                lambda: basic_file_bundle(self.basic_file, basic_files, build_bundles),
+                lambda: basic_file_static_files(self.basic_file, basic_files),
+                self._zip_entry_name(),
+                zip_file
+            )
+        yield
+        for library in libraries:
+            with stats.timer('copy'):
+                # Need to add lib_root in front all the files
+                stats.counters['files_copied'] += self._splice_bundle(
+                    lambda: library_bundle(
+                        library, self.inputs.library_files(library), build_bundles),
+                    lambda: self.inputs.library_files(library),
+                    self._zip_entry_name(self.lib_root),
+                    zip_file
+                )
+            yield
+
+        # Copy the device-library's files, the first one is the generated file.
+        for file in device_lib_files:
+            entry_name = self._zip_entry_name(self.lib_root, file.file_path)
+            with stats.timer('copy'):
+                if device_lib_content is not None and file is device_lib_files[0]:
+                    zip_file.writestr(entry_name, device_lib_content)
+                else:
+                    copy_file(file, entry_name, zip_file)
+            stats.counters['files_copied'] += 1
+            yield
+
+    def _splice_bundle(self, get_bundle, get_files, prefix, zip_file):
+        # Copy the entries of the bundle into the zip file under `prefix`.
+        # If `get_bundle` returns None, copy the bundle's files `get_files` instead.
+        try:
+            bundle_path = get_bundle()
+            src_zip = bundle_path and zipfile.ZipFile(bundle_path)
+        except FileNotFoundError:
+            # The bundle is just evicted from `build_cache`, build it again.
+            bundle_path = get_bundle()
+            src_zip = bundle_path and zipfile.ZipFile(bundle_path)
+        if src_zip is None:
+            file_objects = list(get_files())
+            for file in file_objects:
+                copy_file(file, os.path.join(prefix, file.file_path), zip_file)
+            return len(file_objects)
+        with src_zip:
+            return splice_zip(src_zip, zip_file, prefix)
+
+
+def run_build_job(job_id):
+    """ This function run the build of the BuildJob(id=job_id), and record the result
+        state in the job.
+    """
+    job = BuildJob.objects.select_related('device', 'device_library').get(id=job_id)
+    _run_build(job)
+
+
+def _run_build(job, inputs=None):
+    stats = BuildStats()
+    stats.timers['queue'] = (timezone.now() - job.created_at).total_seconds()
+    job.state = BuildJob.State.RUNNING
+    job.save()
+    try:
+        DeviceBuilder(job.device, job.used_df_list, stats, inputs).build(
+            job.device_library)
+    except Exception as e:
+        logger.exception('Build job %s failed.', job.uuid)
+        job.state = BuildJob.State.FAILED
+        job.reason = 'Build failed: %s' % str(e)
+    else:
+        job.state = BuildJob.State.DONE
+    job.save()
+    build_metrics.add(stats, failed=job.state == BuildJob.State.FAILED)
+    # One structured log line per build.
+    logger.info('Build job %s %s: %s', job.uuid, job.state, json.dumps(stats.info))
+
+
+def stream_build(device_object, used_df_list, device_lib_object):
+    """ This function generate the SA code zip file of the device, and yield its
+        content while it's generated, see `DeviceBuilder.stream`.
+    """
+    stats = BuildStats()
+    failed = True
+    try:
+        yield from DeviceBuilder(device_object, used_df_list, stats).stream(
+            device_lib_object)
+        failed = False
+    except Exception:
+        logger.exception('Build stream of %s failed.', device_object)
+        raise
+    finally:
+        build_metrics.add(stats, failed=failed)
+        # One structured log line per build.
+        logger.info('Build stream of %s %s: %s', device_object,
+                    'failed' if failed else 'done', json.dumps(stats.info))
+
+
+def batch_archive_path(batch_id):
+    # The archive of all the device zip files of the batch.
+    # It's not a File, so it's removed by the cleanup routine after one day.
+    return os.path.join(settings.RESULT_DIR, 'batch', '%s.zip' % batch_id)
+
+
+def run_build_batch(batch_id):
+    """ This function run all the BuildJob of the batch `batch_id` one by one.
+        The inputs shared by the devices are loaded once for the whole batch.
+        If all the builds are done, their zip files are put into one archive,
+        `<dm_name>/<d_name>.zip` for each device, see `batch_archive_path`.
+    """
+    fail_lost_jobs(BuildJob.objects.filter(batch=batch_id))
+    jobs = list(BuildJob.objects.filter(batch=batch_id).select_related(
+        'device__file', 'device_library').order_by('id'))
+    inputs = BuildInputs()
+    for job in jobs:
+        _run_build(job, inputs)
+    if any(job.state != BuildJob.State.DONE for job in jobs):
+        return
+
+    # The device zip files are compressed already, just store them.
+    dst = batch_archive_path(batch_id)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp_path = '%s.%s.tmp' % (dst, uuid.uuid4().hex)
+    try:
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_STORED) as zip_file:
+            for job in jobs:
+                # Only (dm_name, d_name) is unique in a batch.
+                zip_file.write(
+                    job.device.file.real_path,
+                    posixpath.join(job.device.dm_name, job.device.file.file_path)
+                )
+    except:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, dst)
+
+
+def build_batch_info(batch_id):
+    """ Return the state of the batch and all its builds, None if the batch not found.
+
+        Return format::
+
+            {
+                'batch_id': 'abc123...',
+                'state': 'queued' | 'running' | 'done' | 'failed',
+                'jobs': [...]  # Detail format: api.models.BuildJob.info
+            }
+    """
+    jobs = list(BuildJob.objects.filter(batch=batch_id).select_related(
+        'device__file').order_by('id'))
+    if not jobs:
+        return None
+    states = set(job.state for job in jobs)
+    if BuildJob.State.FAILED in states:
+        state = BuildJob.State.FAILED
+    elif states == {BuildJob.State.QUEUED}:
+        state = BuildJob.State.QUEUED
+    elif states == {BuildJob.State.DONE} and os.path.exists(batch_archive_path(batch_id)):
+        state = BuildJob.State.DONE
+    else:
+        state = BuildJob.State.RUNNING
+    return {
+        'batch_id': str(batch_id),
+        'state': state,
+        'jobs': [job.info for job in jobs],
+    }
+
+
+def _is_alive(pid):
+    # Whether the process `pid` in this host is alive.
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fail_lost_jobs(job_objects=None):
+    """ This function fail the queued or running BuildJob which will never be done,
+        since their process exited (ex: restarted or crashed), or they are not done
+        in `settings.DEVICE_BUILD_TIMEOUT` seconds.
+        Input::
+            job_objects: QuerySet of BuildJob, default all the BuildJob.
+        Return the number of the failed jobs.
+    """
+    if job_objects is None:
+        job_objects = BuildJob.objects.all()
+    job_objects = job_objects.filter(
+        state__in=[BuildJob.State.QUEUED, BuildJob.State.RUNNING]
+    )
+    hostname = socket.gethostname()
+    lost_workers = []
+    for worker in set(job_objects.values_list('worker', flat=True)):
+        host, __, pid = worker.rpartition(':')
+        # The processes in the other hosts can't be checked, their jobs time out.
+        if host == hostname and pid.isdigit() and not _is_alive(int(pid)):
+            lost_workers.append(worker)
+    timeout = timezone.now() - timedelta(seconds=settings.DEVICE_BUILD_TIMEOUT)
+    count = job_objects.filter(
+        Q(worker__in=lost_workers) | Q(created_at__lt=timeout)
+    ).update(
+        state=BuildJob.State.FAILED,
+        reason='Build job is lost, please try again.',
+        updated_at=timezone.now()
+    )
+    if count:
+        logger.warning('%d lost build jobs failed.', count)
+    return count
+
+
+class BuildQueue:
+    """ This class run the build jobs in a pool of background worker threads.
+        At most `max_size` jobs can wait in the queue, so one process can't be
+        saturated by builds. If `workers` <= 0, the jobs run in the caller's thread.
+    """
+    def __init__(self, workers, max_size):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, job_id):
+        """ Put the BuildJob(id=job_id) into the queue.
+            Raise `queue.Full` if there are too many waiting jobs.
+        """
+        self._put(run_build_job, job_id)
+
+    def submit_batch(self, batch_id):
+        """ Put all the BuildJob of the batch `batch_id` into the queue,
+            they are run by one worker.
+            Raise `queue.Full` if there are too many waiting jobs.
+        """
+        self._put(run_build_batch, batch_id)
+
+    def _put(self, func, arg):
+        if self.workers <= 0:
+            func(arg)
+            return
+        self._start_workers()
+        self._queue.put_nowait((func, arg))
+
+    @property
+    def size(self):
+        # Number of the jobs waiting in the queue.
+        return self._queue.qsize()
+
+    def _start_workers(self):
+        # The worker threads are started at the first submit,
+        # so management commands (ex: migrate) won't start them.
+        with self._lock:
+            if not self._threads:
+                # The jobs left by the exited processes will never be run.
+                fail_lost_jobs()
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='device-build-%d' % len(self._threads),
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, arg = self._queue.get()
+            # Each worker thread has its own DB connection.
+            close_old_connections()
+            try:
+                func(arg)
+            except:
+                logger.exception('Build job (%s) not found or can not be saved.', arg)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+
+build_queue = BuildQueue(settings.DEVICE_BUILD_WORKERS, settings.DEVICE_BUILD_QUEUE_SIZE)
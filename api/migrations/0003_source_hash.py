@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_buildjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basicfile',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='library',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_source_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='buildjob',
+            name='batch',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+    ]
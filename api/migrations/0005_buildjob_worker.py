@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:09
+
+import api.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_buildjob_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='buildjob',
+            name='worker',
+            field=models.CharField(blank=True, default=api.models.current_worker, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_buildjob_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basicfile',
+            name='config_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
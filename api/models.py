@@ -1,12 +1,17 @@
 import configparser
+import hashlib
+import os
 import re
-import jinja2
+import socket
 import traceback
+import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 
+from .templating import template_cache
+
 __all__ = [
     'Language',
     'BasicFile',
@@ -21,6 +26,7 @@ __all__ = [
     'DeviceLibraryDf',
     'DeviceDfHasSaFunction',
     'DeviceLibraryDfHasSaFunction',
+    'BuildJob',
 ]
 
 
@@ -47,6 +53,11 @@ class FileGroup(models.Model):
         blank=False,
         default='/'
     )
+    # The hash of the directory tree imported by `manage.py initdb`.
+    source_hash = models.CharField(
+        max_length=64,
+        blank=True
+    )
 
     class Meta:
         abstract = True
@@ -62,19 +73,61 @@ class BasicFile(FileGroup):
         on_delete=models.CASCADE,
     )
 
+    # The SHA-256 of the config file, the parsed config file is cached by it.
+    # Empty if it's not known, see `config`.
+    config_version = models.CharField(
+        max_length=64,
+        blank=True
+    )
+
     class Meta:
         unique_together = ['name', 'language']
 
+    # The parsed config file of the basic files in this process.
+    # {basic_file_id: (config_version, configparser.ConfigParser)}
+    _config_cache = {}
+
+    @property
+    def config(self):
+        """ Return the parsed config file (configparser.ConfigParser) of this basic file.
+            The result is cached in the process by `config_version`, which is loaded
+            with this basic file, so reading a cached config file costs no query.
+            The config file is read again if its version is not known,
+            ex: after `invalidate_config`.
+        """
+        config = self.__dict__.get('_config')
+        if config is not None:
+            return config
+        cached = self._config_cache.get(self.id)
+        if self.config_version and cached and cached[0] == self.config_version:
+            config = cached[1]
+        else:
+            config_file_object = self.file_set.get(
+                file_path=settings.BASICFILE_CONF_FILENAME)
+            with open(config_file_object.real_path) as f:
+                content = f.read()
+            config = configparser.ConfigParser()
+            config.read_string(content)
+            version = hashlib.sha256(content.encode()).hexdigest()
+            if version != self.config_version:
+                self.config_version = version
+                BasicFile.objects.filter(id=self.id).update(config_version=version)
+            self._config_cache[self.id] = (version, config)
+        self._config = config
+        return config
+
+    def invalidate_config(self):
+        # The config file is replaced, all the processes read it again.
+        self._config_cache.pop(self.id, None)
+        self.__dict__.pop('_config', None)
+        self.config_version = ''
+        BasicFile.objects.filter(id=self.id).update(config_version='')
+
     def get_config(self, section, option):
-        config_file_object = self.file_set.get(file_path='config.ini')
-        config = configparser.ConfigParser()
-        config.read(config_file_object.real_path)
-        return config.get(section, option)
+        return self.config.get(section, option)
 
     def get_all_config(self):
-        config_file_object = self.file_set.get(file_path='config.ini')
-        config = configparser.ConfigParser()
-        config.read(config_file_object.real_path)
+        config = self.config
         return {
             'template': config.get(*settings.BASICFILE_CONF_TEMPLATE_LIST).split(','),
             'device_lib_path': config.get(
@@ -113,7 +166,7 @@ class BasicFile(FileGroup):
                         *settings.BASICFILE_CONF_ODF_TEMPLATE)
                 with self.open(template_file_path, 'r') as f:
                     template_string = f.read()
-            tm = jinja2.Template(template_string)
+            tm = template_cache.get_template(template_string)
         except:
             tb = traceback.format_exc()
             print(tb)
@@ -371,17 +424,66 @@ class DeviceLibrary(LibraryPoolBase):
     def f_id(self):
         return 'D%d' % self.id
 
-    def add_df_functions(self, ddf_object):
-        df_objects = self.df_set.filter(name=ddf_object.name)
-        if len(df_objects) == 0:
-            df_object = DeviceLibraryDf.objects.create(
-                name=ddf_object.name,
-                df_type=ddf_object.df_type,
-                device_library=self
-            )
-        else:
-            df_object = df_objects.first()
-        df_object.set_json(ddf_object.content)
+    def add_df_functions(self, *ddf_objects):
+        """ This function copy the function relations of the device's dfs
+            (api.models.DeviceDf) into the dfs with the same name in this
+            device-library. The missing dfs are created.
+        """
+        # {df_name<str>: df_object<DeviceLibraryDf>}
+        df_objects = {}
+        for df_object in self.df_set.order_by('id'):
+            df_objects.setdefault(df_object.name, df_object)
+
+        new_df_names = []
+        for ddf_object in ddf_objects:
+            if ddf_object.name not in df_objects and ddf_object.name not in new_df_names:
+                new_df_names.append(ddf_object.name)
+
+        with transaction.atomic():
+            if new_df_names:
+                ddf_types = {
+                    ddf_object.name: ddf_object.df_type_id
+                    for ddf_object in reversed(ddf_objects)
+                }
+                DeviceLibraryDf.objects.bulk_create([
+                    DeviceLibraryDf(
+                        name=name,
+                        df_type_id=ddf_types[name],
+                        device_library=self
+                    )
+                    for name in new_df_names
+                ])
+                # Get the ids of the created dfs.
+                for df_object in self.df_set.filter(name__in=new_df_names).order_by('id'):
+                    df_objects.setdefault(df_object.name, df_object)
+
+            DeviceLibraryDf.bulk_set_json([
+                (df_objects[ddf_object.name], ddf_object.content)
+                for ddf_object in ddf_objects
+            ])
+
+
+class DeviceQuerySet(models.QuerySet):
+    def with_content(self):
+        """ Prefetch all the objects used by `Device.content`, so the content
+            of the devices is built in a fixed number of queries.
+        """
+        return self.select_related('basic_file__language').prefetch_related(
+            models.Prefetch(
+                'df_set',
+                queryset=DeviceDf.objects.select_related('df_type').prefetch_related(
+                    models.Prefetch(
+                        'function_relation_set',
+                        queryset=DeviceDfHasSaFunction.objects.order_by('id')
+                    )
+                ).order_by('id')
+            ),
+            'library_set',
+            models.Prefetch(
+                'functions',
+                queryset=SaFunction.objects.select_related('function_type').order_by('id')
+            ),
+        )
 
 
 class Device(LibraryPoolBase):
@@ -398,6 +500,8 @@ class Device(LibraryPoolBase):
     )
     push_interval = models.FloatField()
 
+    objects = DeviceQuerySet.as_manager()
+
     class Meta:
         unique_together = ['name', 'dm_name', 'user']
 
@@ -409,8 +513,11 @@ class Device(LibraryPoolBase):
         )
 
     # Return content of this device.
+    # Use `Device.objects.with_content()` to get the device,
+    # otherwise each related object is queried one by one.
     @property
     def content(self):
+        df_objects = self.df_set.all()
         return {
             'DA': {
                 'iottalk_server': self.server_url,
@@ -420,7 +527,7 @@ class Device(LibraryPoolBase):
             'SA': {
                 'basic': {
                     'language': self.basic_file.language.name,
-                    'basic_file': self.basic_file.id,
+                    'basic_file': self.basic_file_id,
                     'global_var_setup': {
                         'content': self.global_var_setup,
                         'readonly_lines': self.gvs_readonly_lines,
@@ -429,9 +536,8 @@ class Device(LibraryPoolBase):
                 'safuncs': {
                     dftype + 's': [
                         df.content
-                        for df in self.df_set.filter(
-                            df_type__df_type=dftype
-                        )
+                        for df in df_objects
+                        if df.df_type.df_type == dftype
                     ] for dftype in ('idf', 'odf')
                 },
                 'libs': [
@@ -444,7 +550,7 @@ class Device(LibraryPoolBase):
                         'name': func.name,
                         'dftype': func.function_type.df_type,
                         'params': func.function_type.params,
-                        'library_ref': None if not func.library_ref else func.library_ref.id
+                        'library_ref': func.library_ref_id
                     }
                     for func in self.functions.all()
                 ]
@@ -462,38 +568,46 @@ class Device(LibraryPoolBase):
         df_list = []
         df_list.extend(value['SA']['safuncs']['idfs'])
         df_list.extend(value['SA']['safuncs']['odfs'])
-        for df in df_list:
-            df_object = self.df_set.get(
-                name=df['name']
-            )
-            df_object.set_json(df)
-        self.library_set.all().delete()
-        count = 0
+        df_objects = {
+            df_object.name: df_object
+            for df_object in self.df_set.filter(name__in=[df['name'] for df in df_list])
+        }
+
+        # Only the existing libraries and device-libraries are kept.
+        lib_ids = {'L': [], 'D': []}
+        for lib_id in value['SA']['libs']:
+            if lib_id[0] in lib_ids:
+                lib_ids[lib_id[0]].append(int(lib_id[1:]))
+        library_ids = set(
+            Library.objects.filter(id__in=lib_ids['L']).values_list('id', flat=True)
+        )
+        device_library_ids = set(
+            DeviceLibrary.objects.filter(id__in=lib_ids['D']).values_list('id', flat=True)
+        )
+        library_relation_objects = []
         for lib_id in value['SA']['libs']:
-            if lib_id[0] == 'L':
-                library_objects = Library.objects.filter(id=int(lib_id[1:]))
-                if len(library_objects) == 0:
-                    continue
-                DeviceHasLibrary.objects.create(
+            if lib_id[0] == 'L' and int(lib_id[1:]) in library_ids:
+                library_relation_objects.append(DeviceHasLibrary(
                     device=self,
-                    library=library_objects.first(),
-                    order=count
-                )
-                count += 1
-            elif lib_id[0] == 'D':
-                device_library_objects = DeviceLibrary.objects.filter(id=int(lib_id[1:]))
-                if len(device_library_objects) == 0:
-                    continue
-                DeviceHasLibrary.objects.create(
+                    library_id=int(lib_id[1:]),
+                    order=len(library_relation_objects)
+                ))
+            elif lib_id[0] == 'D' and int(lib_id[1:]) in device_library_ids:
+                library_relation_objects.append(DeviceHasLibrary(
                     device=self,
-                    device_library=device_library_objects.first(),
-                    order=count
-                )
-                count += 1
-        self.functions.clear()
-        for func_id in value['SA']['safunction_list']:
-            self.functions.add(func_id)
-        self.save()
+                    device_library_id=int(lib_id[1:]),
+                    order=len(library_relation_objects)
+                ))
+
+        with transaction.atomic():
+            DeviceDf.bulk_set_json([
+                (df_objects[df['name']], df)
+                for df in df_list
+            ])
+            self.library_set.all().delete()
+            DeviceHasLibrary.objects.bulk_create(library_relation_objects)
+            self.functions.set(value['SA']['safunction_list'])
+            self.save()
 
 
 class DeviceHasLibrary(models.Model):
@@ -522,10 +636,10 @@ class DeviceHasLibrary(models.Model):
     @property
     def info(self):
         # Returns which library or device library this relationship object represents.
-        if self.library:
-            return "L%d" % self.library.id
-        if self.device_library:
-            return "D%d" % self.device_library.id
+        if self.library_id is not None:
+            return "L%d" % self.library_id
+        if self.device_library_id is not None:
+            return "D%d" % self.device_library_id
         return None
 
 
@@ -562,7 +676,7 @@ class DeviceFeatureBase(models.Model):
             'params': self.df_type.params,
             'functions': [
                 {
-                    'id': func_relation.function.id,
+                    'id': func_relation.function_id,
                     'var_setup': func_relation.var_setup,
                     'selected': func_relation.selected
                 }
@@ -584,39 +698,81 @@ class DeviceFeatureBase(models.Model):
                            set to false.
             Output:: None
         """
+        self._bulk_set_json([(self, value)], RelationModel, relation_field, delete_flag)
 
-        # {sa_func_id<int>: sa_func_object<SaFunction>}
-        functions = {
-            int(f['id']): f for f in value['functions']
-        }
-
-        # Check all the old function relation.
-        func_relation_objects = self.function_relation_set.all()
-        for func_relation_object in func_relation_objects:
-            func_id = func_relation_object.function.id
-            if func_id in functions:
-                # If this relation exists in new function relation, udate the relation item.
-                func_relation_object.var_setup = functions[func_id]['var_setup']
-                func_relation_object.selected = functions[func_id]['selected']
-                func_relation_object.save()
-                del functions[func_id]
-            else:
-                # If this relation don't exist in new function relation.
-                # For `DeviceDf`, needs to remove this relationship.
-                # For `DeviceLibraryDf`, don't needs to remove this relationship,
-                # just keep as the selection history.
-                if delete_flag:
-                    func_relation_object.delete()
-
-        # Create new relation.
-        for __, info in functions.items():
-            fields = {
-                'selected': info['selected'],
-                'var_setup': info['var_setup'],
-                'function_id': info['id'],
-                relation_field: self
+    @classmethod
+    def _bulk_set_json(cls, df_values, RelationModel, relation_field, delete_flag):
+        """ This function set the content of many DFs from dict format, with a fixed
+            number of queries in a single transaction.
+            Input::
+                df_values: list of (df_object, value). `value` is the dict format
+                           content of `df_object`.
+                The others are the same as `_set_json`.
+            Output:: None
+        """
+        # Get all the old function relations of these DFs.
+        # {df_id<int>: [relation_object<RelationModel>]}
+        df_relation_objects = {}
+        for func_relation_object in RelationModel.objects.filter(**{
+            relation_field + '__in': [df_object for df_object, __ in df_values]
+        }).order_by('id'):
+            df_id = getattr(func_relation_object, relation_field + '_id')
+            df_relation_objects.setdefault(df_id, []).append(func_relation_object)
+
+        update_objects = []
+        delete_ids = []
+        create_objects = []
+        for df_object, value in df_values:
+            # {sa_func_id<int>: sa_func_object<SaFunction>}
+            functions = {
+                int(f['id']): f for f in value['functions']
             }
-            RelationModel.objects.create(**fields)
+            func_relation_objects = df_relation_objects.setdefault(df_object.id, [])
+
+            # Check all the old function relation.
+            for func_relation_object in list(func_relation_objects):
+                func_id = func_relation_object.function_id
+                if func_id in functions:
+                    # If this relation exists in new function relation,
+                    # udate the relation item.
+                    func_relation_object.var_setup = functions[func_id]['var_setup']
+                    func_relation_object.selected = functions[func_id]['selected']
+                    if func_relation_object.id is not None:
+                        update_objects.append(func_relation_object)
+                    del functions[func_id]
+                else:
+                    # If this relation don't exist in new function relation.
+                    # For `DeviceDf`, needs to remove this relationship.
+                    # For `DeviceLibraryDf`, don't needs to remove this relationship,
+                    # just keep as the selection history.
+                    if delete_flag:
+                        func_relation_objects.remove(func_relation_object)
+                        if func_relation_object.id is None:
+                            create_objects.remove(func_relation_object)
+                        else:
+                            delete_ids.append(func_relation_object.id)
+
+            # Create new relation.
+            for __, info in functions.items():
+                fields = {
+                    'selected': info['selected'],
+                    'var_setup': info['var_setup'],
+                    'function_id': info['id'],
+                    relation_field: df_object
+                }
+                func_relation_object = RelationModel(**fields)
+                # Keep the new relation, the same DF may be set again in `df_values`.
+                func_relation_objects.append(func_relation_object)
+                create_objects.append(func_relation_object)
+
+        with transaction.atomic():
+            if update_objects:
+                RelationModel.objects.bulk_update(
+                    set(update_objects), ['var_setup', 'selected'])
+            if delete_ids:
+                RelationModel.objects.filter(id__in=delete_ids).delete()
+            if create_objects:
+                RelationModel.objects.bulk_create(create_objects)
 
     def reset(self):
         self.functions.clear()
@@ -645,6 +801,10 @@ class DeviceDf(DeviceFeatureBase):
     def set_json(self, value):
         self._set_json(value, DeviceDfHasSaFunction, 'device', True)
 
+    @classmethod
+    def bulk_set_json(cls, df_values):
+        cls._bulk_set_json(df_values, DeviceDfHasSaFunction, 'device', True)
+
 
 class DeviceLibraryDf(DeviceFeatureBase):
     device_library = models.ForeignKey(
@@ -661,6 +821,10 @@ class DeviceLibraryDf(DeviceFeatureBase):
     def set_json(self, value):
         self._set_json(value, DeviceLibraryDfHasSaFunction, 'device_library', False)
 
+    @classmethod
+    def bulk_set_json(cls, df_values):
+        cls._bulk_set_json(df_values, DeviceLibraryDfHasSaFunction, 'device_library', False)
+
 
 '''
 The class `DeviceDfHasSaFunction` and `DeviceLibraryDfHasSaFunction` are the relation
@@ -699,3 +863,84 @@ class DeviceLibraryDfHasSaFunction(DfHasSaFunctionBase):
         on_delete=models.CASCADE,
         related_name='function_relation_set'
     )
+
+
+def current_worker():
+    # The process running the builds submitted in this process, `<hostname>:<pid>`.
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class BuildJob(models.Model):
+    """ A device build that runs in the background worker pool (api.build.build_queue).
+        The device-library file and SA code zip file of `device` are generated
+        by the build, the result zip file is `device.file`.
+    """
+    class State(models.TextChoices):
+        QUEUED = 'queued', _('queued')
+        RUNNING = 'running', _('running')
+        DONE = 'done', _('done')
+        FAILED = 'failed', _('failed')
+    uuid = models.UUIDField(
+        default=uuid.uuid4,
+        editable=False,
+        unique=True
+    )
+    device = models.ForeignKey(
+        Device,
+        on_delete=models.CASCADE,
+        related_name='build_job_set'
+    )
+    device_library = models.ForeignKey(
+        DeviceLibrary,
+        on_delete=models.CASCADE,
+    )
+    # List of the name of the used dfs in this build.
+    used_df_list = models.JSONField(
+        default=list
+    )
+    # The jobs created by one batch build share the same `batch`,
+    # see `api.build.run_build_batch`.
+    batch = models.UUIDField(
+        null=True,
+        blank=True,
+        db_index=True
+    )
+    state = models.CharField(
+        max_length=10,
+        choices=State.choices,
+        default=State.QUEUED
+    )
+    reason = models.TextField(blank=True)
+    # The process running this build. The jobs left by an exited process are
+    # failed by `api.build.fail_lost_jobs`.
+    worker = models.CharField(
+        max_length=100,
+        blank=True,
+        default=current_worker
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
+
+    def __str__(self):
+        return "%s: %s(%s)" % (
+            str(self.uuid),
+            str(self.device),
+            self.state
+        )
+
+    @property
+    def info(self):
+        # Return the state of this build, and the zip file if the build is done.
+        info = {
+            'job_id': str(self.uuid),
+            'state': self.state,
+            'reason': self.reason,
+        }
+        if self.state == self.State.DONE:
+            info['zip_path'] = self.device.file.url
+            info['zip_name'] = self.device.file.file_path
+        return info
@@ -0,0 +1,67 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import jinja2
+from django.conf import settings
+
+# The delimiters of Jinja2 Environment, in the order of its arguments:
+# (block_start, block_end, variable_start, variable_end, comment_start, comment_end)
+DEFAULT_DELIMITERS = ('{%', '%}', '{{', '}}', '{#', '#}')
+# SA function's code uses `{* ... *}` as the variable delimiters.
+FUNCTION_DELIMITERS = ('{%', '%}', '{*', '*}', '{#', '#}')
+
+
+class TemplateCache:
+    """ This class keep one process-wide Jinja2 Environment for each delimiter
+        configuration, and a LRU of the compiled templates keyed by the delimiters and
+        the hash of the template source. So the same template is compiled only once
+        in a process.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._environments = {}
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_environment(self, delimiters=DEFAULT_DELIMITERS):
+        with self._lock:
+            env = self._environments.get(delimiters)
+            if env is None:
+                env = jinja2.Environment(*delimiters, loader=jinja2.BaseLoader)
+                self._environments[delimiters] = env
+            return env
+
+    def get_template(self, source, delimiters=DEFAULT_DELIMITERS):
+        """ Return the compiled template (jinja2.Template) of `source`.
+        """
+        key = (delimiters, hashlib.sha256(source.encode()).hexdigest())
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+
+        # Compile outside the lock, the other threads don't need to wait for it.
+        template = self.get_environment(delimiters).from_string(source)
+        with self._lock:
+            self.misses += 1
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._templates),
+            }
+
+
+template_cache = TemplateCache(settings.TEMPLATE_CACHE_SIZE)
@@ -1,3 +1,707 @@
-# from django.test import TestCase
+import fcntl
+import io
+import json
+import os
+import queue
+import random
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import build
+from .models import (
+    BasicFile,
+    BuildJob,
+    Device,
+    DeviceLibrary,
+    DfType,
+    Language,
+    Library,
+    LibraryFunction,
+    SaFunction,
+)
+from .utils import create_library
+from file_handle.tests import DataDirTestCase
+from my_admin.utils import update_basicfile
+
+BASIC_FILES = {
+    settings.BASICFILE_CONF_FILENAME: """[templates]
+sa = SA.py
+safuncs = libraries/{sa[device_name]}_library/safuncs.py
+[new-function]
+IDF = new_idf.tpl
+ODF = new_odf.tpl
+[manual]
+url = http://manual
+[lib]
+root = libraries/
+example-dir = examples
+""",
+    'SA.py': """# {{ sa.device_name }} @ {{ da.server_url }}
+{{ sa.global_variable_setup }}
+{% for f in functions %}{{ f.content }}
+{% endfor %}
+IDF = {{ idf.name_list }}
+ODF = {{ odf.name_list }}
+""",
+    'libraries/{sa[device_name]}_library/safuncs.py': """# {{ sa.device_name }}
+{% for f in functions %}{{ f.name }}
+{% endfor %}""",
+    'new_idf.tpl': 'def f({{ params.list|join(",") }}):\n    return 1\n',
+    'new_odf.tpl': 'def o({{ params.len }}):\n    pass\n',
+    'README.md': 'readme\n' * 100,
+    'utils/helper.py': 'def helper():\n    return 42\n',
+}
+LIBRARY_FILES = {
+    'RPi/RPi/gpio.py': 'GPIO = 1\n' * 50,
+    'RPi/examples/GPIO_input.py': """# ***[import_string]***
+import RPi
+# ***[runs_content]***
+    return RPi.GPIO
+""",
+}
+
+
+def reference_global_var_setup(library_objects):
+    """ The original merge of the libraries' global_var_setup, one line at a time.
+        Input::
+            library_objects: the libraries, the one selected last first.
+    """
+    global_var = {
+        'readonly': [],
+        'editable': []
+    }
+    for library_object in library_objects:
+        readonly = []
+        editable = []
+        content_lines = library_object.global_var_setup.split('\n')
+        for i in range(len(content_lines)):
+            if i in library_object.gvs_readonly_lines:
+                readonly.append(content_lines[i])
+            else:
+                editable.append(content_lines[i])
+        for line in readonly:
+            if line in global_var['editable']:
+                global_var['editable'].remove(line)
+            if line in global_var['readonly']:
+                global_var['readonly'].remove(line)
+        for line in editable:
+            if line in global_var['editable']:
+                global_var['editable'].remove(line)
+        global_var['readonly'] = readonly + global_var['readonly']
+        global_var['editable'] = editable + global_var['editable']
+    return {
+        'content': '\n'.join(global_var['readonly'] + global_var['editable']),
+        'readonly_lines': list(range(len(global_var['readonly'])))
+    }
+
+
+class LibraryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username='alice')
+        cls.language = Language.objects.create(name='Python')
+        cls.function_type = DfType.objects.create(df_type='idf', params=['int'])
+
+    def create_libraries(self, n, basic_file_name):
+        """ Create a basic file with `n` libraries and `n` device-libraries,
+            each of them has 3 functions. Return the basic file.
+        """
+        basic_file_object = BasicFile.objects.create(
+            name=basic_file_name,
+            language=self.language
+        )
+        Library.objects.bulk_create([
+            Library(
+                name='lib%d' % i,
+                basic_file=basic_file_object,
+                global_var_setup='import lib%d\nx = %d' % (i, i),
+                gvs_readonly_lines=[0]
+            )
+            for i in range(n)
+        ])
+        # `bulk_create` may not set the ids.
+        library_objects = list(basic_file_object.library_set.order_by('id'))
+        LibraryFunction.objects.bulk_create([
+            LibraryFunction(library=library_object, name='func%d' % j)
+            for library_object in library_objects
+            for j in range(3)
+        ])
+        DeviceLibrary.objects.bulk_create([
+            DeviceLibrary(
+                name='device%d_library' % i,
+                basic_file=basic_file_object,
+                user=self.user if i % 2 else None,
+                global_var_setup='import lib%d\ny = %d' % (i, i),
+                gvs_readonly_lines=[0]
+            )
+            for i in range(n)
+        ])
+        SaFunction.objects.bulk_create([
+            SaFunction(name='sa%d' % j, code='pass', function_type=self.function_type)
+            for j in range(3)
+        ])
+        function_objects = list(SaFunction.objects.order_by('-id')[:3])
+        for i, device_library_object in enumerate(
+                DeviceLibrary.objects.filter(basic_file=basic_file_object)):
+            device_library_object.functions.set(function_objects)
+            device_library_object.dependency_library.set(library_objects[i:i + 1])
+        return basic_file_object
+
+    def get(self, url, data=None):
+        # Return (the result, the number of the queries).
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['result'], len(queries)
+
+
+class LibraryManagerViewTest(LibraryTestCase):
+    def test_query_count(self):
+        # The number of the queries doesn't grow with the number of the libraries.
+        query_counts = {}
+        for n in (10, 100, 1000):
+            basic_file_object = self.create_libraries(n, 'basic%d' % n)
+            result, query_counts[n] = self.get(
+                '/api/library/Python/%d' % basic_file_object.id,
+                {'username': 'alice'}
+            )
+            library_list = result['library_list']
+            self.assertEqual(len(library_list), 2 * n)
+            self.assertTrue(all(len(lib['functions']) == 3 for lib in library_list))
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
+
+
+class ListFunctionManagerViewTest(LibraryTestCase):
+    def selection(self, basic_file_object):
+        library_ids = list(
+            basic_file_object.library_set.values_list('id', flat=True))
+        device_library_ids = list(DeviceLibrary.objects.filter(
+            basic_file=basic_file_object).values_list('id', flat=True))
+        return ['L%d' % i for i in library_ids] + ['D%d' % i for i in device_library_ids]
+
+    def test_query_count(self):
+        # The number of the queries doesn't grow with the number of the selected
+        # libraries. The query string has 2n `libs`, at most
+        # settings.DATA_UPLOAD_MAX_NUMBER_FIELDS (1000).
+        query_counts = {}
+        for n in (10, 100, 450):
+            basic_file_object = self.create_libraries(n, 'basic%d' % n)
+            result, query_counts[n] = self.get(
+                '/api/function', {'libs': self.selection(basic_file_object)})
+            self.assertEqual(len(result['libfunction_list']), n)
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
+
+    def test_global_var_setup_merge(self):
+        # The merged global_var_setup is the same as the original merge, for the
+        # libraries sharing lines in any selection order.
+        basic_file_object = self.create_libraries(8, 'basic')
+        rng = random.Random(0)
+        lines = ['import a', 'import b', 'x = 1', 'y = 2', '']
+        library_objects = {}
+        for lib in self.selection(basic_file_object):
+            model = Library if lib[0] == 'L' else DeviceLibrary
+            library_object = model.objects.get(id=int(lib[1:]))
+            content_lines = [rng.choice(lines) for i in range(rng.randint(1, 6))]
+            library_object.global_var_setup = '\n'.join(content_lines)
+            library_object.gvs_readonly_lines = [
+                i for i in range(len(content_lines)) if rng.random() < 0.5
+            ]
+            library_object.save()
+            library_objects[lib] = library_object
+
+        for i in range(50):
+            libs = rng.sample(list(library_objects), rng.randint(1, len(library_objects)))
+            result, __ = self.get('/api/function', {'libs': libs})
+            self.assertEqual(
+                result['global_var_setup'],
+                reference_global_var_setup(
+                    [library_objects[lib] for lib in reversed(libs)]),
+                libs
+            )
+
+
+class SpliceZipTest(SimpleTestCase):
+    files = {
+        'main.py': b'print("main")\n' * 100,
+        'lib/util.py': b'',
+        'lib/data.bin': bytes(range(256)) * 50,
+    }
+
+    def splice(self, dst):
+        # Splice a bundle of `files` into `dst` under `d_name/`, return the zip file.
+        src_buffer = io.BytesIO()
+        with zipfile.ZipFile(src_buffer, 'w', zipfile.ZIP_DEFLATED) as src_zip:
+            for name, content in self.files.items():
+                src_zip.writestr(name, content)
+        with zipfile.ZipFile(src_buffer) as src_zip:
+            with zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr('d_name/config.py', b'x = 1')
+                self.assertEqual(
+                    build.splice_zip(src_zip, zip_file, 'd_name'), len(self.files))
+        data = dst.getvalue() if isinstance(dst, io.BytesIO) else dst.pop()
+        return zipfile.ZipFile(io.BytesIO(data))
+
+    def assertSpliced(self, zip_file):
+        # The spliced zip file has the same entries as it's written one by one.
+        self.assertIsNone(zip_file.testzip())
+        expected = dict(
+            {'d_name/config.py': b'x = 1'},
+            **{'d_name/' + name: content for name, content in self.files.items()}
+        )
+        self.assertEqual(
+            {name: zip_file.read(name) for name in zip_file.namelist()}, expected)
+
+    def test_raw(self):
+        # The private zipfile internals work in the supported Python versions.
+        self.assertTrue(build._can_splice_raw())
+        for dst in (io.BytesIO(), build.ZipStream()):
+            with self.splice(dst) as zip_file:
+                self.assertSpliced(zip_file)
+
+    def test_copy(self):
+        # If the entries can't be copied as is, they are compressed again.
+        with mock.patch.object(build, '_raw_splice_supported', None), \
+                mock.patch.object(build, '_splice_entry_raw', side_effect=AttributeError), \
+                self.assertLogs(build.logger, 'ERROR'):
+            self.assertFalse(build._can_splice_raw())
+            for dst in (io.BytesIO(), build.ZipStream()):
+                with self.splice(dst) as zip_file:
+                    self.assertSpliced(zip_file)
+        self.assertTrue(build._can_splice_raw())
+
+
+class BuildTestCase(DataDirTestCase):
+    """ A basic file, a library and the SA functions to save and build the devices,
+        the builds run in the request thread.
+    """
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(build.build_queue, 'workers', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Language.objects.create(name='Python')
+        self.assertEqual(update_basicfile(
+            self.upload(BASIC_FILES), 'completed', 'Python', 'default'), ('', 200))
+        self.basic_file = BasicFile.objects.get(name='default')
+        self.assertEqual(create_library(
+            'Python', self.basic_file.id, self.upload(LIBRARY_FILES), 'completed'
+        ), ('', 200))
+        self.library = Library.objects.get(name='RPi')
+        for username in ('alice', 'bob'):
+            get_user_model().objects.create(
+                sub=username, username=username, email='%s@x' % username)
+        idf_type = DfType.objects.create(df_type='idf', params=['float'])
+        odf_type = DfType.objects.create(df_type='odf', params=['float'])
+        self.idf_function = SaFunction.objects.create(
+            name='rnd', function_type=idf_type, var_setup='',
+            code='def {{df_name}}():\n    {*variable_setup*}\n    return 1')
+        self.odf_function = SaFunction.objects.create(
+            name='out', function_type=odf_type, var_setup='',
+            code='def {{df_name}}(x):\n    {*variable_setup*}\n    print(x)')
+
+    def device_body(self, d_name='Dummy', username='alice', is_new=False,
+                    var_setup='x = 1', global_var_setup='G = 1'):
+        # Return the request body of saving the device.
+        idfs = [{'name': 'Dummy-I%d' % i, 'df_type': ['float'], 'used': 1}
+                for i in range(2)]
+        odfs = [{'name': 'Dummy-O%d' % i, 'df_type': ['float'], 'used': 1}
+                for i in range(2)]
+        return {'data': {
+            'is_new': is_new,
+            'd_name': d_name,
+            'username': username,
+            'dm_result': {
+                'dm': {'name': 'Dummy_Device', 'id': 1}, 'idf': idfs, 'odf': odfs},
+            'content': {
+                'DA': {'iottalk_server': 'https://iottalk', 'device_addr': 'abc',
+                       'push_interval': 10},
+                'SA': {
+                    'basic': {
+                        'language': 'Python',
+                        'basic_file': self.basic_file.id,
+                        'global_var_setup': {
+                            'content': global_var_setup, 'readonly_lines': []}
+                    },
+                    'safuncs': {
+                        'idfs': [{'name': df['name'], 'params': ['float'], 'functions': [{
+                            'id': self.idf_function.id,
+                            'var_setup': var_setup,
+                            'selected': True
+                        }]} for df in idfs],
+                        'odfs': [{'name': df['name'], 'params': ['float'], 'functions': [{
+                            'id': self.odf_function.id,
+                            'var_setup': '',
+                            'selected': True
+                        }]} for df in odfs],
+                    },
+                    'libs': [self.library.f_id],
+                    'safunction_list': [self.idf_function.id, self.odf_function.id],
+                },
+            },
+        }}
+
+    def post_device(self, body):
+        # Save the device, return the response.
+        return self.client.post('/api/device', json.dumps(body),
+                                content_type='application/json')
+
+    def save_device(self, **kwargs):
+        # Save and build the device, return the saved Device.
+        response = self.post_device(self.device_body(**kwargs))
+        self.assertEqual(response.status_code, 200, response.content)
+        result = json.loads(response.content)['result']
+        self.assertEqual(result['state'], 'done', result)
+        return BuildJob.objects.get(uuid=result['job_id']).device
+
+    def zip_entries(self, path):
+        # Return {entry name: content} of the zip file.
+        with zipfile.ZipFile(path) as zip_file:
+            return {
+                info.filename: zip_file.read(info)
+                for info in zip_file.infolist() if not info.is_dir()
+            }
+
+    def build_key(self, device_object):
+        job = device_object.build_job_set.latest('id')
+        return build.DeviceBuilder(device_object, job.used_df_list).build_key(
+            job.device_library)
+
+
+class RenderErrorTest(BuildTestCase):
+    def test_template_error_fails_build(self):
+        # A template which fails to render fails the build, no partial zip file
+        # is cached or published.
+        template = self.basic_file.file_set.get(file_path='SA.py')
+        template.write('{{ sa.device_name ')
+        template.save()
+        with self.assertLogs(build.logger, 'ERROR'):
+            response = self.post_device(self.device_body())
+        result = json.loads(response.content)['result']
+        self.assertEqual(result['state'], 'failed')
+        self.assertIn('Build failed', result['reason'])
+        device_object = Device.objects.get(name='Dummy')
+        self.assertIsNone(build.build_cache.get(self.build_key(device_object)))
+        self.assertFalse(os.path.exists(device_object.file.real_path))
+
+
+class BasicFileConfigTest(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        Language.objects.create(name='Python')
+        self.assertEqual(update_basicfile(
+            self.upload(BASIC_FILES), 'completed', 'Python', 'default'), ('', 200))
+
+    def test_cached_config_costs_no_query(self):
+        BasicFile.objects.get(name='default').get_all_config()
+        basic_file_object = BasicFile.objects.get(name='default')
+        with self.assertNumQueries(0):
+            basic_file_object.get_all_config()
+            self.assertEqual(basic_file_object.lib_root, 'libraries/')
+
+    def test_replaced_config(self):
+        # The replaced config file is read again, also by the other processes
+        # whose cache is not invalidated.
+        self.assertEqual(BasicFile.objects.get(name='default').lib_root, 'libraries/')
+        other_process_cache = dict(BasicFile._config_cache)
+        config = BASIC_FILES[settings.BASICFILE_CONF_FILENAME].replace(
+            'root = libraries/', 'root = lib/')
+        self.assertEqual(update_basicfile(
+            self.upload(dict(BASIC_FILES, **{settings.BASICFILE_CONF_FILENAME: config})),
+            'completed', 'Python', 'default', is_create=False
+        ), ('', 200))
+        self.assertEqual(BasicFile.objects.get(name='default').lib_root, 'lib/')
+        BasicFile._config_cache.update(other_process_cache)
+        self.assertEqual(BasicFile.objects.get(name='default').lib_root, 'lib/')
+
+
+class BuildLockTest(BuildTestCase):
+    def held_locks(self):
+        # Return the names of the lock files, and check they are all locked.
+        names = set()
+        for name in os.listdir(settings.BUILD_LOCK_DIR):
+            with open(os.path.join(settings.BUILD_LOCK_DIR, name)) as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            names.add(name.split('-')[0])
+        return names
+
+    def test_save_and_build_hold_device_locks(self):
+        # Saving a device and building it hold the same locks of the device and its
+        # device-library, so they run one by one. The lock files are removed after.
+        held = {}
+        add_df_functions = DeviceLibrary.add_df_functions
+        _build = build.DeviceBuilder._build
+
+        def save(*args):
+            held['save'] = self.held_locks()
+            return add_df_functions(*args)
+
+        def build_zip(*args):
+            held['build'] = self.held_locks()
+            return _build(*args)
+
+        with mock.patch.object(DeviceLibrary, 'add_df_functions', save), \
+                mock.patch.object(build.DeviceBuilder, '_build', build_zip):
+            self.save_device()
+        self.assertEqual(held, {
+            'save': {'device', 'devicelibrary'},
+            'build': {'device', 'devicelibrary'},
+        })
+        self.assertEqual(os.listdir(settings.BUILD_LOCK_DIR), [])
+
+
+class DeviceBatchTest(BuildTestCase):
+    def batch_body(self, *device_bodies):
+        return {'data': {
+            'is_new': False,
+            'username': 'alice',
+            'devices': [
+                {key: body['data'][key] for key in ('dm_result', 'd_name', 'content')}
+                for body in device_bodies
+            ],
+        }}
+
+    def post_batch(self, body):
+        return self.client.post('/api/device/batch', json.dumps(body),
+                                content_type='application/json')
+
+    def data_files(self):
+        return set(
+            os.path.join(dirpath, filename)
+            for dirpath, __, filenames in os.walk(self.data_dir)
+            for filename in filenames
+        )
+
+    def test_same_d_name_of_different_device_models(self):
+        # The devices' zip files are named by their device model in the archive.
+        other = self.device_body()
+        other['data']['dm_result']['dm']['name'] = 'Other_Device'
+        response = self.post_batch(self.batch_body(self.device_body(), other))
+        result = json.loads(response.content)['result']
+        self.assertEqual(result['state'], 'done', result)
+        response = self.client.get('/api/build/batch/%s/download' % result['batch_id'])
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                ['Dummy_Device/Dummy.zip', 'Other_Device/Dummy.zip']
+            )
+
+    def test_failed_batch_saves_nothing(self):
+        # A device failed to save rolls back the whole batch, and leaves no file.
+        data_files = self.data_files()
+        bad = self.device_body(d_name='Bad')
+        del bad['data']['content']['DA']
+        with self.assertLogs('api.views', 'ERROR'):
+            response = self.post_batch(self.batch_body(self.device_body(), bad))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Device.objects.exists())
+        self.assertFalse(BuildJob.objects.exists())
+        self.assertEqual(self.data_files(), data_files)
+
+
+class BuildCacheTest(BuildTestCase):
+    def rebuild(self, device_object):
+        # Build the device again, return True if the zip file is taken from the cache.
+        job = device_object.build_job_set.latest('id')
+        return build.DeviceBuilder(device_object, job.used_df_list).build(
+            job.device_library)
+
+    def read(self, device_object):
+        with open(device_object.file.real_path, 'rb') as f:
+            return f.read()
+
+    def count_builds(self):
+        # Return the list of the build keys really built, while the patch is active.
+        built = []
+        build_zip = build.DeviceBuilder._build_zip
+
+        def count(builder, key, device_lib_object):
+            built.append(key)
+            return build_zip(builder, key, device_lib_object)
+        patcher = mock.patch.object(build.DeviceBuilder, '_build_zip', count)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return built
+
+    def test_identical_rebuild(self):
+        # Building the same inputs again is a cache hit with the same zip file.
+        device_object = self.save_device()
+        content = self.read(device_object)
+        self.assertTrue(self.rebuild(device_object))
+        self.assertEqual(self.read(device_object), content)
+        self.assertIn('Dummy/SA.py', self.zip_entries(device_object.file.real_path))
+
+    def test_rendered_inputs_change_key(self):
+        # The device saved by alice, the first one saved is global.
+        self.save_device()
+        device_object = self.save_device()
+        key = self.build_key(device_object)
+        keys = [key]
+
+        # The global variable setup.
+        self.assertEqual(self.save_device(global_var_setup='G = 2'), device_object)
+        device_object.refresh_from_db()
+        keys.append(self.build_key(device_object))
+        # The SA function's code.
+        self.idf_function.code += '\n# changed'
+        self.idf_function.save()
+        keys.append(self.build_key(device_object))
+        # The basic file's template.
+        self.assertEqual(update_basicfile(
+            self.upload(dict(BASIC_FILES, **{'SA.py': '# changed\n'})),
+            'completed', 'Python', 'default', is_create=False
+        ), ('', 200))
+        keys.append(self.build_key(device_object))
+        self.assertEqual(len(set(keys)), 4)
+
+        # The new inputs are built, not taken from the cache.
+        self.assertFalse(self.rebuild(device_object))
+        self.assertEqual(
+            self.zip_entries(device_object.file.real_path)['Dummy/SA.py'], b'# changed')
+
+    def test_same_content_shares_cache(self):
+        # The devices with the same content share one cached zip file, whoever
+        # saved them. The different content is built again.
+        built = self.count_builds()
+        device_objects = [
+            self.save_device(username='alice'),  # global
+            self.save_device(username='alice'),
+            self.save_device(username='bob'),
+        ]
+        self.assertEqual(len(set(device_object.id for device_object in device_objects)), 3)
+        self.assertEqual(len(built), 1)
+        self.assertEqual(
+            set(self.read(device_object) for device_object in device_objects),
+            {self.read(device_objects[0])}
+        )
+        self.assertEqual(
+            set(self.build_key(device_object) for device_object in device_objects),
+            set(built)
+        )
+
+        self.save_device(username='bob', var_setup='x = 2')
+        self.assertEqual(len(built), 2)
+        self.assertNotEqual(built[0], built[1])
+
+    def test_lru_eviction(self):
+        # The least recently used zip files are removed once the cache exceeds
+        # its limit, the recently used ones are kept.
+        cache = build.BuildCache(os.path.join(self.data_dir, 'cache'), 3500)
+        for i, key in enumerate('abcd'):
+            temp_path = cache.temp_path(key)
+            with open(temp_path, 'wb') as f:
+                f.write(b'x' * 1000)
+            # The files' time is in seconds on some file systems.
+            os.utime(temp_path, (i, i))
+            path = cache.put(key, temp_path)
+            os.utime(path, (i, i))
+            if key == 'c':
+                # `a` is used after `c`.
+                self.assertIsNotNone(cache.get('a'))
+                os.utime(cache.path('a'), (i + 0.5, i + 0.5))
+        self.assertEqual([key for key in 'abcd' if cache.get(key)], ['a', 'c', 'd'])
+        self.assertLessEqual(
+            sum(os.path.getsize(cache.path(key)) for key in 'acd'), cache.max_size)
+
+
+class BuildJobTest(BuildTestCase):
+    def setUp(self):
+        super().setUp()
+        # The jobs wait in the queue until `run_queued` is called.
+        self.queue = queue.Queue(maxsize=1)
+        for name, value in [('workers', 1), ('_queue', self.queue),
+                            ('_start_workers', lambda: None)]:
+            patcher = mock.patch.object(build.build_queue, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_queued(self):
+        func, arg = self.queue.get_nowait()
+        func(arg)
+
+    def get_job(self, job_id):
+        response = self.client.get('/api/build/%s' % job_id)
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)['result']
+
+    def test_submit_and_poll(self):
+        response = self.post_device(self.device_body())
+        result = json.loads(response.content)['result']
+        self.assertEqual(result['state'], 'queued')
+        self.assertNotIn('zip_path', result)
+        self.assertEqual(self.get_job(result['job_id'])['state'], 'queued')
+        response = self.client.get('/api/build/%s/download' % result['job_id'])
+        self.assertEqual(response.status_code, 400)
+
+        self.run_queued()
+        job = self.get_job(result['job_id'])
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['zip_name'], 'Dummy.zip')
+        response = self.client.get('/api/build/%s/download' % result['job_id'])
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as f:
+            self.assertIn('Dummy/SA.py', f.namelist())
+
+    def test_failed_job(self):
+        self.idf_function.code = '{{ broken '
+        self.idf_function.save()
+        result = json.loads(self.post_device(self.device_body()).content)['result']
+        with self.assertLogs(build.logger, 'ERROR'):
+            self.run_queued()
+        job = self.get_job(result['job_id'])
+        self.assertEqual(job['state'], 'failed')
+        self.assertIn('Build failed', job['reason'])
+        self.assertNotIn('zip_path', job)
+
+    def test_wait(self):
+        # The build runs in the request thread, the response has the zip file.
+        body = self.device_body()
+        body['data']['wait'] = True
+        result = json.loads(self.post_device(body).content)['result']
+        self.assertEqual(result['state'], 'done')
+        self.assertEqual(result['zip_name'], 'Dummy.zip')
+        self.assertTrue(self.queue.empty())
+
+    def test_queue_full(self):
+        self.assertEqual(self.post_device(self.device_body()).status_code, 200)
+        response = self.post_device(self.device_body(d_name='Other', is_new=True))
+        self.assertEqual(response.status_code, 503)
+        # The job not queued is removed.
+        self.assertEqual(BuildJob.objects.count(), 1)
+
+    def test_fail_lost_jobs(self):
+        self.post_device(self.device_body())
+        job = BuildJob.objects.get()
+        jobs = {
+            name: BuildJob.objects.create(
+                device=job.device,
+                device_library=job.device_library,
+                state=state,
+                worker=worker
+            )
+            for name, state, worker in [
+                ('alive', BuildJob.State.RUNNING, 'host:1'),
+                ('exited', BuildJob.State.RUNNING, 'host:2'),
+                ('timeout', BuildJob.State.QUEUED, 'other-host:1'),
+                ('done', BuildJob.State.DONE, 'host:2'),
+            ]
+        }
+        job.delete()
+        BuildJob.objects.filter(id=jobs['timeout'].id).update(
+            created_at=timezone.now() - timedelta(
+                seconds=settings.DEVICE_BUILD_TIMEOUT + 1))
+
+        with mock.patch('socket.gethostname', return_value='host'), \
+                mock.patch.object(build, '_is_alive', lambda pid: pid == 1), \
+                self.assertLogs(build.logger, 'WARNING'):
+            self.assertEqual(build.fail_lost_jobs(), 2)
+        states = {name: self.get_job(job.uuid)['state'] for name, job in jobs.items()}
+        self.assertEqual(states, {
+            'alive': 'running', 'exited': 'failed', 'timeout': 'failed', 'done': 'done'})
@@ -5,6 +5,10 @@ from django.urls import (
 from .views import (
     LibraryManagerView,
     DeviceManagerView,
+    DeviceBatchView,
+    BuildBatchView,
+    BuildJobView,
+    BuildStatsView,
     ListFunctionManagerView,
     NewFunctionManagerView,
     SingleFunctionManagerView,
@@ -39,5 +43,25 @@ urlpatterns = [
         name='singel_function_endpoint'
     ),
     path('device', DeviceManagerView.as_view(), name='device_endpoint'),
+    path('device/batch', DeviceBatchView.as_view(), name='device_batch_endpoint'),
+    path('build/stats', BuildStatsView.as_view(), name='build_stats_endpoint'),
+    path(
+        'build/batch/<str:batch_id>',
+        BuildBatchView.as_view(),
+        name='build_batch_endpoint'
+    ),
+    path(
+        'build/batch/<str:batch_id>/download',
+        BuildBatchView.as_view(),
+        {'download': True},
+        name='build_batch_download_endpoint'
+    ),
+    path('build/<str:job_id>', BuildJobView.as_view(), name='build_job_endpoint'),
+    path(
+        'build/<str:job_id>/download',
+        BuildJobView.as_view(),
+        {'download': True},
+        name='build_job_download_endpoint'
+    ),
     path('file/', include('file_handle.urls')),
 ]
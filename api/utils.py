@@ -1,13 +1,13 @@
 import errno
-import jinja2
 import json
 import os
 import re
 import shutil
-import traceback
 
 from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
+from django.utils import timezone
 
 from .models import (
     BasicFile,
@@ -15,7 +15,16 @@ from .models import (
     Library,
     LibraryFunction,
 )
-from file_handle.models import UploadBatch
+from .templating import (
+    DEFAULT_DELIMITERS,
+    FUNCTION_DELIMITERS,
+    template_cache,
+)
+from file_handle.models import (
+    File,
+    UploadBatch,
+    file_sha256,
+)
 from my_admin.utils import remove_file_group
 
 
@@ -24,14 +33,11 @@ class ContentRender:
         When calling `render_string` or `render_file`, this class will
         use Jinja2 or str-format to render the input-data using self.ctx,
         and return the result string or save to a file.
+        The compiled Jinja2 templates are shared in the process by `template_cache`.
     """
-    def __init__(self, context, env=None):
+    def __init__(self, context, delimiters=DEFAULT_DELIMITERS):
         self.ctx = context
-        self.env = env
-        if self.env:
-            self.render_function = self.env.from_string
-        else:
-            self.render_function = jinja2.Template
+        self.delimiters = delimiters
 
     def render_string(self, input_string, render_flag=True):
         """ This function input template and return the result in string format
@@ -46,28 +52,36 @@ class ContentRender:
 
         """
         if render_flag:
-            tm = self.render_function(input_string)
+            tm = template_cache.get_template(input_string, self.delimiters)
             return tm.render(self.ctx)
         else:
             return input_string.format(**self.ctx)
 
-    def render_file(self, file_object, dst):
+    def render_file(self, file_object, dst, zip_file=None, source=None):
         """ This function input template and return the result in string format
         Args:
            file_object (file_handle.models.File): The template's target file.
            dst (str): The render result should be written in this file.
+           zip_file (zipfile.ZipFile): Default value is None
+               If given, `dst` is the entry name and the render result is
+               written into this zip file instead of the file system.
+           source (str): Default value is None
+               The content of `file_object` if it's read already.
 
         Returns:
            None
 
+        Raises:
+           The error of reading or rendering the template, so a build never
+           leaves out a template.
+
         """
-        try:
+        if source is None:
             with file_object.open('r') as f:
-                tem_str = f.read()
-            r = self.render_string(tem_str)
-        except Exception as e:
-            # traceback.print_stack()
-            traceback.print_tb(e)
+                source = f.read()
+        r = self.render_string(source)
+        if zip_file is not None:
+            zip_file.writestr(os.path.normpath(dst), r)
             return
         # Create the file's dir if not exist.
         if not os.path.exists(os.path.dirname(dst)):
@@ -147,8 +161,12 @@ class DeviceTalkErrorJsonResponse(JsonResponse):
         )
 
 
-def copy_file(file_object, dst):
-    # This function copy the file_object's file to the path of `dst`
+def copy_file(file_object, dst, zip_file=None):
+    # This function copy the file_object's file to the path of `dst`.
+    # If `zip_file` is given, `dst` is the entry name in that zip file.
+    if zip_file is not None:
+        zip_file.write(file_object.real_path, os.path.normpath(dst))
+        return
     if not os.path.exists(os.path.dirname(dst)):
         try:
             os.makedirs(os.path.dirname(dst))
@@ -158,16 +176,20 @@ def copy_file(file_object, dst):
     shutil.copy(file_object.real_path, dst)
 
 
-def function_render(device_df):
+def function_render(device_df, df_function_select_object=None):
     """ This function render the SF* code to SF code.
         See the document for more detail.
+        Input::
+            df_function_select_object: DeviceDfHasSaFunction, the selected SaFunction
+                relation of `device_df`, it's queried if not given.
     """
 
     # Get the selected SaFunction relation.
-    df_function_select_object = DeviceDfHasSaFunction.objects.filter(
-        device=device_df,
-        selected=True
-    ).first()
+    if df_function_select_object is None:
+        df_function_select_object = DeviceDfHasSaFunction.objects.filter(
+            device=device_df,
+            selected=True
+        ).first()
     df_function_object = df_function_select_object.function
 
     code = df_function_object.code
@@ -191,7 +213,7 @@ def function_render(device_df):
             'df_name': device_df.re_name,
             'new_line': ''
         },
-        jinja2.Environment('{%', '%}', '{*', '*}', '{#', '#}', loader=jinja2.BaseLoader)
+        FUNCTION_DELIMITERS
     )
     final_code = jinja2_content_render.render_string(code)
     return {
@@ -206,6 +228,16 @@ def function_render(device_df):
     }
 
 
+def _file_hash(file_object):
+    # Return the SHA-256 of the file's content, None if the file is missing.
+    if file_object.sha256:
+        return file_object.sha256
+    try:
+        return file_sha256(file_object.real_path)
+    except FileNotFoundError:
+        return None
+
+
 def create_library(language, basic_file_id, file_upload_id, state):
     try:
         upload_batch_object = UploadBatch.objects.get(id=int(file_upload_id))
@@ -224,37 +256,23 @@ def create_library(language, basic_file_id, file_upload_id, state):
         return '', 200
 
     if state == 'completed':
+        file_objects = list(upload_batch_object.file_set.order_by('id'))
         # Get the library name
-        first_file_object = upload_batch_object.file_set.first()
+        first_file_object = file_objects[0]
         lib_name = first_file_object.file_path.split('/')[0]
 
-        lib_objects = Library.objects.filter(
-            basic_file=basic_file_object,
-            name=lib_name
-        )
-        # If the library existed, clear the old record.
-        if len(lib_objects) > 0:
-            library_object = lib_objects.first()
-            library_object.libraryfunction_set.all().delete()
-            for f in library_object.file_set.all():
-                f.delete()
-        else:
-            library_object = Library.objects.create(
-                name=lib_name,
-                dir_path=f'{lib_name}/',
-                basic_file=basic_file_object
-            )
-
-        file_objects = upload_batch_object.file_set.all()
-        # Parse the files in uploaded library
+        # Parse the files in uploaded library, then apply all the changes at once.
+        kept_file_objects = []
+        invalid_file_objects = []
+        library_function_objects = []
+        library_fields = {}
         for file in file_objects:
             # File's path startwith `<lib_name>/<lib_name>/`
             if file.file_path.startswith(f'{lib_name}/{lib_name}/'):
                 # Change the file's path from `<lib_name>/<lib_name>/...` to
                 # `<lib_name>/...`
                 file.file_path = file.file_path.split('/', 1)[1]
-                file.library = library_object
-                file.save()
+                kept_file_objects.append(file)
             # File's path startwith `<lib_name>/<example_dir>/`
             elif file.file_path.startswith(
                     f'{lib_name}/{basic_file_object.lib_example_dir}'):
@@ -275,22 +293,110 @@ def create_library(language, basic_file_id, file_upload_id, state):
                             global_var_setup = ""
                         if not gvs_readonly_lines:
                             gvs_readonly_lines = []
-                        library_object.global_var_setup = global_var_setup
-                        library_object.gvs_readonly_lines = gvs_readonly_lines
-                        library_object.save()
+                        library_fields['global_var_setup'] = global_var_setup
+                        library_fields['gvs_readonly_lines'] = gvs_readonly_lines
                         continue
 
                     ep_sections = ep.all_valid_sections()
                     if ep_sections:
-                        LibraryFunction.objects.create(
+                        library_function_objects.append(LibraryFunction(
                             name=example_file_name,
-                            **ep_sections,
-                            library=library_object
-                        )
+                            **ep_sections
+                        ))
             # Delete invalid files
             else:
-                file.delete()
-
-        upload_batch_object.delete()
+                invalid_file_objects.append(file)
+
+        # The library is updated completely or not at all.
+        # Only the changed files and functions are written, so the unchanged ones keep
+        # their ids. The removed files are unlinked from file system after commit.
+        with transaction.atomic():
+            lib_objects = Library.objects.filter(
+                basic_file=basic_file_object,
+                name=lib_name
+            ).order_by('id')[:1]
+            if len(lib_objects) > 0:
+                library_object = lib_objects[0]
+            else:
+                library_object = Library.objects.create(
+                    name=lib_name,
+                    dir_path=f'{lib_name}/',
+                    basic_file=basic_file_object
+                )
+            if any(getattr(library_object, k) != v for k, v in library_fields.items()):
+                for field, value in library_fields.items():
+                    setattr(library_object, field, value)
+                library_object.save()
+
+            # Compare the files with the old ones by file path and content.
+            # {file_path: file_object<File>}
+            old_file_objects = {}
+            removed_file_objects = invalid_file_objects
+            for file in library_object.file_set.order_by('id'):
+                if file.file_path in old_file_objects:
+                    removed_file_objects.append(file)
+                else:
+                    old_file_objects[file.file_path] = file
+            changed_file_objects = []
+            now = timezone.now()
+            for file in kept_file_objects:
+                old_file_object = old_file_objects.pop(file.file_path, None)
+                if old_file_object is not None:
+                    old_hash = _file_hash(old_file_object)
+                    if old_hash is not None and old_hash == _file_hash(file):
+                        # Not changed, keep the old file and drop the uploaded one.
+                        removed_file_objects.append(file)
+                        continue
+                    removed_file_objects.append(old_file_object)
+                file.library = library_object
+                file.updated_at = now
+                changed_file_objects.append(file)
+            # The old files not in the uploaded library.
+            removed_file_objects.extend(old_file_objects.values())
+            File.objects.bulk_update(
+                changed_file_objects, ['file_path', 'library', 'updated_at'])
+            File.bulk_delete(removed_file_objects)
+
+            # Compare the library functions with the old ones by name and sections.
+            # {name: [library_function_object<LibraryFunction>]}
+            old_function_objects = {}
+            for old_function_object in library_object.libraryfunction_set.order_by('id'):
+                old_function_objects.setdefault(
+                    old_function_object.name, []).append(old_function_object)
+            updated_function_objects = []
+            new_function_objects = []
+            for library_function_object in library_function_objects:
+                same_name_objects = old_function_objects.get(library_function_object.name)
+                if not same_name_objects:
+                    library_function_object.library = library_object
+                    new_function_objects.append(library_function_object)
+                    continue
+                old_function_object = same_name_objects.pop(0)
+                sections = {
+                    field: getattr(library_function_object, field)
+                    for field in settings.LIB_FUNC_FIELDS
+                }
+                if any(getattr(old_function_object, k) != v for k, v in sections.items()):
+                    for field, value in sections.items():
+                        setattr(old_function_object, field, value)
+                    updated_function_objects.append(old_function_object)
+            removed_function_ids = [
+                library_function_object.id
+                for same_name_objects in old_function_objects.values()
+                for library_function_object in same_name_objects
+            ]
+            if updated_function_objects:
+                LibraryFunction.objects.bulk_update(
+                    updated_function_objects, settings.LIB_FUNC_FIELDS)
+            if removed_function_ids:
+                LibraryFunction.objects.filter(id__in=removed_function_ids).delete()
+            LibraryFunction.objects.bulk_create(new_function_objects)
+
+            upload_batch_object.delete()
+
+        # Pre-compress the library's files for the device builds.
+        # `api.build` imports this module, so import it here.
+        from .build import library_bundle
+        library_bundle(library_object)
         return '', 200
     return 'Wrong state', 400
@@ -1,16 +1,41 @@
 import json
-import os
-from urllib.parse import parse_qs
+import logging
+import queue
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs, quote
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import (
+    F,
+    Max,
+    Prefetch,
+    Q,
+    Subquery,
+)
+from django.http import (
+    FileResponse,
+    StreamingHttpResponse,
+)
 from django.views.generic.base import View
 
+from .build import (
+    BuildInputs,
+    DeviceBuilder,
+    batch_archive_path,
+    build_batch_info,
+    build_metrics,
+    build_queue,
+    fail_lost_jobs,
+    file_lock,
+    run_build_job,
+    stream_build,
+)
+from .templating import template_cache
 from .utils import (
-    ContentRender,
-    copy_file,
     create_library,
-    function_render,
     DeviceTalkJsonResponse,
     DeviceTalkErrorJsonResponse
 )
@@ -24,20 +49,32 @@ from .models import (
     DeviceLibrary,
     Device,
     DeviceDf,
+    DeviceLibraryDf,
+    DeviceLibraryDfHasSaFunction,
+    BuildJob,
+)
+from file_handle.models import (
+    File,
+    UploadBatch,
 )
-from file_handle.models import File
+from file_handle.utils import save_archive
+from my_admin.utils import remove_file_group
 from xtalk_account.utils import check_login
 
+logger = logging.getLogger(__name__)
+
 
 class LibraryManagerView(View):
     '''
     Route: DEVICETALK_POSFIX/api/library/<str:language>/<int:basic_file_id>
     GET: Get the all the libraries information by language.
     PUT: Check the uploaded file's format and create library object
+    POST: Upload the library in a single archive and create library object
     '''
     http_method_names = [
         'get',
-        'put'
+        'put',
+        'post',
     ]
 
     @check_login
@@ -89,34 +126,30 @@ class LibraryManagerView(View):
 
         library_list = []
         # Get the device-libraries
-        # First, get all the user's device-libraries
-        user_device_library_objects = DeviceLibrary.objects.filter(
+        # The user's device-libraries and the global device-libraries (user == None).
+        # Two library with same name will confuse user. If there is a non-global
+        # device-library with the same name, skip the global device-library.
+        user_device_library_names = DeviceLibrary.objects.filter(
             basic_file_id=basic_file_id,
             user=user_object
-        )
-        device_library_name_list = [
-            device_object.name for device_object in user_device_library_objects
-        ]
-        device_library_list = [
-            device_object for device_object in user_device_library_objects
-        ]
-
-        # Then, get all the global device-libraries
-        # global device-library <=> user == None
-        global_device_library_objects = DeviceLibrary.objects.filter(
+        ).values('name')
+        device_library_objects = DeviceLibrary.objects.filter(
+            Q(user=user_object) | Q(user=None),
             basic_file_id=basic_file_id,
-            user=None
+        ).exclude(
+            user=None,
+            name__in=Subquery(user_device_library_names)
+        ).order_by(
+            F('user').asc(nulls_last=True), 'id'
+        ).prefetch_related(
+            Prefetch('dependency_library', queryset=Library.objects.only('id')),
+            Prefetch('functions', queryset=SaFunction.objects.only('id', 'name')),
         )
-        for device_object in global_device_library_objects:
-            if device_object.name in device_library_name_list:
-                # Two library with same name will confuse user.
-                # If there is a non-global device-library with the same name,
-                # skip the global device-library
+        device_library_name_set = set()
+        for device_library_object in device_library_objects:
+            if device_library_object.name in device_library_name_set:
                 continue
-            device_library_list.append(device_object)
-            device_library_name_list.append(device_object.name)
-
-        for device_library_object in device_library_list:
+            device_library_name_set.add(device_library_object.name)
             library_list.append({
                 'id': device_library_object.f_id,
                 'name': device_library_object.name,
@@ -134,6 +167,11 @@ class LibraryManagerView(View):
         # Get all libaries
         library_objects = Library.objects.filter(
             basic_file_id=basic_file_id,
+        ).prefetch_related(
+            Prefetch(
+                'libraryfunction_set',
+                queryset=LibraryFunction.objects.only('id', 'name', 'library')
+            ),
         )
         for library_object in library_objects:
             library_list.append({
@@ -191,6 +229,53 @@ class LibraryManagerView(View):
         else:
             return DeviceTalkJsonResponse()
 
+    def post(self, request, *args, **kwargs):
+        """ This function extract the uploaded archive and create library object,
+            the same as uploading the files one by one then PUT.
+        Request format::
+            Header:
+                Content-Type: multipart/form-data
+            Body:
+                file: zip or tar(.gz) archive. The paths in the archive are the same
+                      as the uploaded files' paths, ex: `RPi/RPi/__init__.py`,
+                      `RPi/examples/GPIO_input.py`.
+
+        Sucess Response format::
+            {
+                'state': 'OK',
+                'result': {}
+            }
+
+        Error Response format::
+            {
+                'state': 'error',
+                'reason': '...'
+            }
+        """
+        language = kwargs.get('language', None)
+        basic_file_id = kwargs.get('basic_file_id', None)
+
+        archive = request.FILES.get('file')
+        if archive is None:
+            return DeviceTalkErrorJsonResponse('Archive file not found.', 400)
+        err_msg, code, file_upload_id = save_archive(archive)
+        if err_msg:
+            return DeviceTalkErrorJsonResponse(err_msg, code)
+
+        err_msg, code = create_library(
+            language,
+            basic_file_id,
+            file_upload_id,
+            'completed',
+        )
+        if err_msg:
+            # Remove the extracted files if they are not used.
+            for upload_batch_object in UploadBatch.objects.filter(id=file_upload_id):
+                remove_file_group(upload_batch_object)
+            return DeviceTalkErrorJsonResponse(err_msg, code)
+        else:
+            return DeviceTalkJsonResponse()
+
 
 class ListFunctionManagerView(View):
     '''
@@ -268,96 +353,147 @@ class ListFunctionManagerView(View):
         qs_body = parse_qs(request.GET.urlencode())
         libs = qs_body.get('libs', [])
         libs.reverse()
+        libs_set = set(libs)
+
+        # Get all the selected libraries and device-libraries at once.
+        library_id_list = []
+        device_library_id_list = []
+        for lib in libs:
+            try:
+                lib_id = int(lib[1:])
+            except:
+                continue
+            if lib[0] == 'D':
+                device_library_id_list.append(lib_id)
+            elif lib[0] == 'L':
+                library_id_list.append(lib_id)
+        device_library_objects = DeviceLibrary.objects.prefetch_related(
+            Prefetch(
+                'functions',
+                queryset=SaFunction.objects.select_related('function_type').order_by('id')
+            ),
+            Prefetch(
+                'df_set',
+                queryset=DeviceLibraryDf.objects.select_related('df_type').prefetch_related(
+                    Prefetch(
+                        'function_relation_set',
+                        queryset=DeviceLibraryDfHasSaFunction.objects.order_by('id')
+                    )
+                ).order_by('id')
+            ),
+        ).in_bulk(device_library_id_list)
+        library_objects = Library.objects.prefetch_related(
+            Prefetch(
+                'libraryfunction_set',
+                # `last_safunction_id`: the last SA-function which imports this
+                # library-function.
+                queryset=LibraryFunction.objects.only('id', 'name', 'library').annotate(
+                    last_safunction_id=Max('safunction__id')
+                ).order_by('id')
+            ),
+        ).in_bulk(library_id_list)
+
+        def get_library_object(lib):
+            try:
+                lib_id = int(lib[1:])
+            except:
+                return None
+            if lib[0] == 'D':
+                return device_library_objects.get(lib_id)
+            elif lib[0] == 'L':
+                return library_objects.get(lib_id)
+            return None
 
         # Init the result list
         safunction_list = []
         df_safuncs = {'idfs': [], 'odfs': []}
-        safunction_name_list = []
-        df_safuncs_name = {'idfs': [], 'odfs': []}
-        safunction_libref_id_list = []
+        safunction_name_set = set()
+        df_safuncs_name = {'idfs': set(), 'odfs': set()}
+        safunction_libref_id_set = set()
         lib_function_list = []
-        global_var = {
-            'readonly': [],
-            'editable': []
-        }
 
-        # This function update the global_var_setup's content by library_object.
+        # This function returns the global_var_setup's content of all the libraries.
         # The rules:
         #     Merge all the `read-only` part to the top
         #     If there two lines with same instruction in different libraries,
-        #         use the first one and ignore the latter one. Cause the for loop
-        #         below visit the later library first, we need to remove the previoues
-        #         ones if same instruction appears.
-        def update_global_var_setup_content(library_object):
-            readonly = []
-            editable = []
-            content_lines = library_object.global_var_setup.split('\n')
-            readonly_lines = library_object.gvs_readonly_lines
-            for i in range(len(content_lines)):
-                if i in readonly_lines:
-                    readonly.append(content_lines[i])
-                else:
-                    editable.append(content_lines[i])
-            for line in readonly:
-                if line in global_var['editable']:
-                    global_var['editable'].remove(line)
-                if line in global_var['readonly']:
-                    global_var['readonly'].remove(line)
-            for line in editable:
-                if line in global_var['editable']:
-                    global_var['editable'].remove(line)
-            global_var['readonly'] = readonly + global_var['readonly']
-            global_var['editable'] = editable + global_var['editable']
+        #         use the one in the library selected first and ignore the latter one.
+        #     Each line of a library cancels one same line of the libraries selected
+        #         after it. A `read-only` line cancels one same `read-only` line and
+        #         one same editable line, an editable line cancels one same editable line.
+        def merge_global_var_setup_content(library_object_list):
+            global_var = {
+                'readonly': [],
+                'editable': []
+            }
+            # The number of the lines which are not cancelled yet.
+            # {<line>: <count>}
+            cancel_count = {
+                'readonly': Counter(),
+                'editable': Counter()
+            }
+            for library_object in library_object_list:
+                readonly = []
+                editable = []
+                content_lines = library_object.global_var_setup.split('\n')
+                readonly_lines = set(library_object.gvs_readonly_lines)
+                for i in range(len(content_lines)):
+                    if i in readonly_lines:
+                        readonly.append(content_lines[i])
+                    else:
+                        editable.append(content_lines[i])
+                for part, lines in (('readonly', readonly), ('editable', editable)):
+                    for line in lines:
+                        if cancel_count[part][line] > 0:
+                            cancel_count[part][line] -= 1
+                        else:
+                            global_var[part].append(line)
+                cancel_count['readonly'].update(readonly)
+                cancel_count['editable'].update(readonly)
+                cancel_count['editable'].update(editable)
+            return global_var
 
         # This function update the safunction_list by function_object.
         def insert_sa_functions(function_object):
             # If already exist SaFunction with same name.
             # Skip this SaFunction.
-            if function_object.name not in safunction_name_list:
+            if function_object.name not in safunction_name_set:
                 # If this SaFunction ref a library, but that library isn't selected
                 # Skip this SaFunction.
-                if function_object.library_ref:
-                    if function_object.library_ref.f_id not in libs:
+                library_ref_id = function_object.library_ref_id
+                if library_ref_id is not None:
+                    if 'L%d' % library_ref_id not in libs_set:
                         return
-                safunction_name_list.append(function_object.name)
-                library_ref = function_object.library_ref
+                safunction_name_set.add(function_object.name)
                 safunction_list.append({
                     'id': function_object.id,
                     'name': function_object.name,
                     'dftype': function_object.function_type.df_type,
                     'params': function_object.function_type.params,
-                    'library_ref': None if not library_ref else library_ref.id
+                    'library_ref': library_ref_id
                 })
                 # Add this function's imported library-function's id in
-                # `safunction_libref_id_list`
-                if function_object.library_ref:
-                    safunction_libref_id_list.append(function_object.library_ref.id)
+                # `safunction_libref_id_set`
+                if library_ref_id is not None:
+                    safunction_libref_id_set.add(library_ref_id)
 
         for lib in libs:
             if lib[0] == 'D':
-                try:
-                    device_library_object = DeviceLibrary.objects.get(id=int(lib[1:]))
-                except:
+                device_library_object = get_library_object(lib)
+                if not device_library_object:
                     continue
-                update_global_var_setup_content(device_library_object)
                 for funcs in device_library_object.functions.all():
                     insert_sa_functions(funcs)
                 # Insert df's function
-                for idf in device_library_object.df_set.filter(df_type__df_type='idf'):
-                    if idf.name not in df_safuncs_name['idfs']:
-                        df_safuncs_name['idfs'].append(idf.name)
-                        df_safuncs['idfs'].append(idf.content)
-                for odf in device_library_object.df_set.filter(df_type__df_type='odf'):
-                    if odf.name not in df_safuncs_name['odfs']:
-                        df_safuncs_name['odfs'].append(odf.name)
-                        df_safuncs['odfs'].append(odf.content)
+                for df in device_library_object.df_set.all():
+                    df_type = df.df_type.df_type + 's'
+                    if df_type in df_safuncs and df.name not in df_safuncs_name[df_type]:
+                        df_safuncs_name[df_type].add(df.name)
+                        df_safuncs[df_type].append(df.content)
 
             elif lib[0] == 'L':
-                try:
-                    library_object = Library.objects.get(id=int(lib[1:]))
-                except:
+                library_object = get_library_object(lib)
+                if not library_object:
                     continue
-                update_global_var_setup_content(library_object)
                 library_object_info = {
                     'id': library_object.f_id,
                     'name': library_object.name,
@@ -377,31 +513,41 @@ class ListFunctionManagerView(View):
         # This for loop check that
         # for all the library-function have even imported by one of the SA-function,
         # there must at last one of the SA-function been selected
+        # If this library-function have even imported by SA-function
+        # but none of them been selected, add the last relation SA-function
+        last_safunction_id_list = []
         for lib in libs:
             if lib[0] == 'L':
-                try:
-                    library_object = Library.objects.get(id=int(lib[1:]))
-                except:
+                library_object = get_library_object(lib)
+                if not library_object:
                     continue
                 # Check if this library has library function
                 for lib_func in library_object.libraryfunction_set.all():
-                    if len(lib_func.safunction_set.all()) == 0:
+                    if lib_func.last_safunction_id is None:
                         continue
-                    # If this library-function have even imported by SA-function
-                    # but none of them been selected, add the last relation SA-function
-                    if lib_func.id not in safunction_libref_id_list:
-                        function_object = lib_func.safunction_set.last()
-                        if function_object.name not in safunction_name_list:
-                            safunction_name_list.append(function_object.name)
-                            library_ref = function_object.library_ref
-                            safunction_list.append({
-                                'id': function_object.id,
-                                'name': function_object.name,
-                                'dftype': function_object.function_type.df_type,
-                                'params': function_object.function_type.params,
-                                'library_ref': None if not library_ref else library_ref.id
-                            })
+                    if lib_func.id not in safunction_libref_id_set:
+                        last_safunction_id_list.append(lib_func.last_safunction_id)
+        last_safunction_objects = SaFunction.objects.select_related(
+            'function_type'
+        ).in_bulk(last_safunction_id_list)
+        for function_id in last_safunction_id_list:
+            function_object = last_safunction_objects[function_id]
+            if function_object.name not in safunction_name_set:
+                safunction_name_set.add(function_object.name)
+                safunction_list.append({
+                    'id': function_object.id,
+                    'name': function_object.name,
+                    'dftype': function_object.function_type.df_type,
+                    'params': function_object.function_type.params,
+                    'library_ref': function_object.library_ref_id
+                })
 
+        # The libraries in selection order.
+        global_var = merge_global_var_setup_content([
+            library_object
+            for library_object in map(get_library_object, reversed(libs))
+            if library_object
+        ])
         global_var_setup = {
             'content': '\n'.join(global_var['readonly'] + global_var['editable']),
             'readonly_lines': [i for i in range(len(global_var['readonly']))]
@@ -692,6 +838,186 @@ class SingleFunctionManagerView(View):
         })
 
 
+def _save_device(user_object, is_new, dm_result, d_name, content,
+                 basic_file_object=None, dftype_objects=None, inputs=None):
+    """ This function save the device's metadata, and its device-library.
+        Input::
+            basic_file_object: the BasicFile of `content`, if it's got already.
+            dftype_objects: {(df_type<str>, params<str>): dftype_object<DfType>},
+                the DfType got already, shared by the devices of a batch.
+            inputs: api.build.BuildInputs, shared by the devices of a batch.
+        Output::
+            (device_object<Device>, device_lib_object<DeviceLibrary>, used_df_list<list>)
+    """
+    if dftype_objects is None:
+        dftype_objects = {}
+    language = content['SA']['basic']['language']
+    basic_file_id = content['SA']['basic']['basic_file']
+    dm_name = dm_result['dm']['name']
+
+    # Save device
+    device_object = None
+    new_device_is_global = True
+
+    device_objects = Device.objects.filter(
+        dm_name=dm_name,
+        name=d_name
+    )
+    if len(device_objects) > 0:
+        new_device_is_global = False
+    device_objects = device_objects.filter(user=user_object)
+    if len(device_objects) > 0:
+        device_object = device_objects.first()
+
+    if is_new:
+        device_object = None
+
+    if not device_object:
+        if basic_file_object is None:
+            basic_file_object = BasicFile.objects.get(id=basic_file_id)
+        device_object = Device.objects.create(
+            dm_name=dm_name,
+            name=d_name,
+            server_url=content['DA']['iottalk_server'],
+            device_address=content['DA']['device_addr'],
+            push_interval=content['DA']['push_interval'],
+            basic_file=basic_file_object,
+            user=None if new_device_is_global else user_object,
+        )
+
+        # Create new file object.
+        device_file_file_path = d_name + '.zip'
+        device_file_uuid_code = File.uuid_generate()
+        device_file_real_path = '%s/%s.zip' % (
+            settings.RESULT_DIR + device_file_uuid_code.hex,
+            d_name
+        )
+        File.objects.create(
+            file_path=device_file_file_path,
+            real_path=device_file_real_path,
+            uuid=device_file_uuid_code,
+            is_upload=True,
+            device=device_object
+        )
+
+        # Create all the dfs object.
+        # No matter that df is used in this device.
+        new_df_objects = []
+        for df_type in ('idf', 'odf'):
+            df_list = dm_result[df_type]
+            for df in df_list:
+                dftype_key = (df_type, json.dumps(df['df_type']))
+                if dftype_key not in dftype_objects:
+                    dftype_objects[dftype_key], _ = DfType.objects.get_or_create(
+                        df_type=df_type,
+                        params=df['df_type']
+                    )
+                new_df_objects.append(DeviceDf(
+                    name=df['name'],
+                    df_type=dftype_objects[dftype_key],
+                    device=device_object,
+                ))
+        DeviceDf.objects.bulk_create(new_df_objects)
+
+    # The builds of this device wait until it's saved, see `api.build.build_lock`.
+    with file_lock('device-%d' % device_object.id):
+        device_lib_object, used_df_list = _save_device_content(
+            user_object, device_object, language, dm_result, content, inputs)
+    return device_object, device_lib_object, used_df_list
+
+
+def _save_device_content(user_object, device_object, language, dm_result, content,
+                         inputs=None):
+    """ This function save the device's content and its device-library,
+        while the device's lock is held by `_save_device`.
+        Output::
+            (device_lib_object<DeviceLibrary>, used_df_list<list>)
+    """
+    # Update device's content.
+    device_object.content = content
+    device_object.save()
+
+    # Not all df is used in this device.
+    # Create a list with all the used df's name.
+    used_df_list = []
+    for df_type in ('idf', 'odf'):
+        for df in dm_result[df_type]:
+            if df['used'] == 1:
+                used_df_list.append(df['name'])
+    device_builder = DeviceBuilder(device_object, used_df_list, inputs=inputs)
+
+    # Get the new_library_name. Ex:
+    # new_lib_file_path: Dummy_demo_library/...
+    # The library name is at first item of the path.
+    new_lib_file_path = device_builder.device_lib_path
+    new_library_name = new_lib_file_path.split('/')[0]
+
+    # Save device library
+
+    # If the exist device-library with same name
+    # Set new device-library non-global.
+    device_lib_objects = DeviceLibrary.objects.filter(
+        basic_file__language__name=language,
+        name=new_library_name
+    )
+    new_dl_is_global = len(device_lib_objects) == 0
+
+    device_lib_objects = device_lib_objects.filter(
+        user=user_object
+    )
+    # If this user already saved this device, device_lib_objects won't be empty
+    # after the filter.
+    if len(device_lib_objects) == 0:
+        # Create new device-library.
+        device_lib_object = DeviceLibrary.objects.create(
+            name=new_library_name,
+            basic_file=device_object.basic_file,
+            user=None if new_dl_is_global else device_object.user,
+            global_var_setup=device_object.global_var_setup,
+            dir_path=('%s/' % (new_library_name)),
+        )
+        new_lib_uuid_code = File.uuid_generate()
+        new_lib_real_path = settings.FILE_UPLOAD_DIR + new_lib_uuid_code.hex
+        # Get file extension name. ex: 'zip'
+        file_extension = new_lib_file_path.split('/')[-1].split('.')[-1]
+        if len(file_extension) > 1:
+            new_lib_real_path = new_lib_real_path + '.' + file_extension
+        File.objects.create(
+            file_path=new_lib_file_path,
+            real_path=new_lib_real_path,
+            uuid=new_lib_uuid_code,
+            device_library=device_lib_object,
+            is_upload=True
+        )
+    else:
+        # Just over-write the existed device-library.
+        device_lib_object = device_lib_objects.first()
+
+    # Copy all the functions' relation from device to device-library.
+    with file_lock('devicelibrary-%d' % device_lib_object.id):
+        with transaction.atomic():
+            # device's related functions
+            device_lib_object.functions.set(
+                device_object.functions.values_list('id', flat=True)
+            )
+            # device's related libraries
+            device_lib_object.dependency_library.set(
+                device_object.library_set.exclude(library=None).values_list(
+                    'library_id', flat=True)
+            )
+            # all df's related libraries
+            device_lib_object.add_df_functions(
+                *device_object.df_set.select_related('df_type').prefetch_related(
+                    'function_relation_set').order_by('id')
+            )
+            # global variable's settings.
+            device_lib_object.global_var_setup = device_object.global_var_setup
+            device_lib_object.gvs_readonly_lines = device_object.gvs_readonly_lines
+            device_lib_object.save()
+
+    return device_lib_object, used_df_list
+
+
 class DeviceManagerView(View):
     '''
     GET: Get the device's content and selected libraries info.
@@ -743,23 +1069,21 @@ class DeviceManagerView(View):
         d_name = qs_body.get('d_name', [None])[0]
         username = qs_body.get('username', [None])[0]
 
-        # Get device object
-        device_objects = Device.objects.filter(
+        # Get device object, with all the objects needed by its content.
+        device_objects = Device.objects.with_content().prefetch_related(
+            'library_set__library__libraryfunction_set'
+        ).filter(
             dm_name=dm_name,
-            name=d_name,
-            user=None
-        )
-        user_device_objects = Device.objects.filter(
-            dm_name=dm_name,
-            name=d_name,
-            user__username=username
-        )
+            name=d_name
+        ).order_by('id')
+        user_device_objects = device_objects.filter(user__username=username)[:1]
+        global_device_objects = device_objects.filter(user=None)[:1]
         # First check if there is device belong to the user.
         if len(user_device_objects) > 0:
-            device_object = user_device_objects.first()
+            device_object = user_device_objects[0]
         # Then check if there is global device (user == None).
-        elif len(device_objects) > 0:
-            device_object = device_objects.first()
+        elif len(global_device_objects) > 0:
+            device_object = global_device_objects[0]
         # Response error if device not found.
         else:
             return DeviceTalkErrorJsonResponse('Device not found')
@@ -769,7 +1093,7 @@ class DeviceManagerView(View):
         for lib_ref in device_object.library_set.all():
             # Ignore device-library. It function infomation is in device's
             # content already.
-            if lib_ref.library:
+            if lib_ref.library_id is not None:
                 library_object = lib_ref.library
                 library_object_info = {
                     'id': library_object.f_id,
@@ -799,18 +1123,39 @@ class DeviceManagerView(View):
                 'dm_result': the dm_result,
                 'd_name': 'Dummy_demo',
                 'username': 'IoTtalk',
-                'content': {...}  # Detail format: api.models.Device.content
+                'content': {...},  # Detail format: api.models.Device.content
+                # Optional, True means the SA code zip file is sent in the response
+                # while it's generated, without the build job. The zip file isn't
+                # saved, only the device-library file is updated.
+                'stream': True | False,
+                # Optional, True means the SA code is generated before the response,
+                # in the request thread, the response has `zip_path` and `zip_name`
+                # as before the builds run in the background.
+                'wait': True | False
             }
 
         Sucess Response format::
             {
                 'state': 'OK',
                 'result': {
-                    'zip_path': '/upload/result/...',  # The url to get the zip file
+                    # The SA code is generated in the background, poll the job
+                    # until it's done. Detail format: api.views.BuildJobView
+                    'job_id': 'abc123...',
+                    'state': 'queued' | 'running' | 'done' | 'failed',
+                    'reason': '',
+                    # Only if the build is done already, ex: `wait` is True or
+                    # DEVICE_BUILD_WORKERS is 0.
+                    # Breaking change: they were always responded before the builds
+                    # run in the background. The clients using them need to send
+                    # `wait` or poll the job until it's done.
+                    'zip_path': '/upload/result/...',
                     'zip_name': 'Dummy_demo.zip'
                 }
             }
 
+        Sucess Response format (stream)::
+            The SA code zip file, `<d_name>.zip`.
+
         Error Response format::
             {
                 'state': 'error',
@@ -824,287 +1169,333 @@ class DeviceManagerView(View):
             d_name = body['data'].get('d_name')
             content = body['data'].get('content')
             username = body['data'].get('username')
+            is_stream = bool(body['data'].get('stream', False))
+            is_wait = bool(body['data'].get('wait', False))
         except:
             DeviceTalkErrorJsonResponse('Wrong request parameter.', 400)
 
         user_object = get_user_model().objects.get(username=username)
         language = content['SA']['basic']['language']
         basic_file_id = content['SA']['basic']['basic_file']
-        dm_name = dm_result['dm']['name']
 
         # Check language name and basic file id
         if len(BasicFile.objects.filter(id=basic_file_id, language__name=language)) == 0:
             DeviceTalkErrorJsonResponse('Wrong language and basic file mapping.', 400)
 
-        # Save device
-        device_object = None
-        new_device_is_global = True
+        device_object, device_lib_object, used_df_list = _save_device(
+            user_object, is_new, dm_result, d_name, content)
 
-        device_objects = Device.objects.filter(
-            dm_name=dm_name,
-            name=d_name
-        )
-        if len(device_objects) > 0:
-            new_device_is_global = False
-        device_objects = device_objects.filter(user=user_object)
-        if len(device_objects) > 0:
-            device_object = device_objects.first()
-
-        if is_new:
-            device_object = None
-
-        if not device_object:
-            device_object = Device.objects.create(
-                dm_name=dm_name,
-                name=d_name,
-                server_url=content['DA']['iottalk_server'],
-                device_address=content['DA']['device_addr'],
-                push_interval=content['DA']['push_interval'],
-                basic_file=BasicFile.objects.get(id=basic_file_id),
-                user=None if new_device_is_global else user_object,
+        # Send the SA code while it's generated, without the build job.
+        if is_stream:
+            response = StreamingHttpResponse(
+                stream_build(device_object, used_df_list, device_lib_object),
+                content_type='application/zip'
             )
-
-            # Create new file object.
-            device_file_file_path = d_name + '.zip'
-            device_file_uuid_code = File.uuid_generate()
-            device_file_real_path = '%s/%s.zip' % (
-                settings.RESULT_DIR + device_file_uuid_code.hex,
-                d_name
+            response['Content-Disposition'] = "attachment; filename*=utf-8''%s" % (
+                quote(device_object.file.file_path)
             )
-            File.objects.create(
-                file_path=device_file_file_path,
-                real_path=device_file_real_path,
-                uuid=device_file_uuid_code,
-                is_upload=True,
-                device=device_object
+            return response
+
+        # Generate the device-library file and SA code in the background.
+        build_job_object = BuildJob.objects.create(
+            device=device_object,
+            device_library=device_lib_object,
+            used_df_list=used_df_list
+        )
+        try:
+            if is_wait:
+                run_build_job(build_job_object.id)
+            else:
+                build_queue.submit(build_job_object.id)
+        except queue.Full:
+            build_job_object.delete()
+            return DeviceTalkErrorJsonResponse(
+                'Too many devices are building, please try again later.', 503)
+        build_job_object.refresh_from_db()
+
+        return DeviceTalkJsonResponse(build_job_object.info)
+
+
+class DeviceBatchView(View):
+    '''
+    POST: Upload the metadata of a batch of devices and create their SA code together.
+        Route: DEVICETALK_POSFIX/api/device/batch
+    '''
+    http_method_names = [
+        'post'
+    ]
+
+    def post(self, request, *args, **kwargs):
+        """ This function upload the metadata of a batch of devices and create their
+            SA code together. The basic files and libraries shared by the devices are
+            read once for the whole batch.
+
+        Request format::
+            {
+                'is_new': True | False,  # The default `is_new` of the devices.
+                'username': 'IoTtalk',
+                'devices': [
+                    {
+                        'is_new': True | False,  # Optional
+                        'dm_result': the dm_result,
+                        'd_name': 'Dummy_demo',
+                        'content': {...}  # Detail format: api.models.Device.content
+                    },...
+                ]
+            }
+
+        Sucess Response format::
+            {
+                'state': 'OK',
+                'result': {
+                    # The SA code is generated in the background.
+                    # Detail format: api.views.BuildBatchView
+                    'batch_id': 'abc123...',
+                    'state': 'queued' | 'running' | 'done' | 'failed',
+                    'jobs': [...]  # Detail format: api.views.BuildJobView
+                }
+            }
+
+        Error Response format::
+            {
+                'state': 'error',
+                'reason': '...'
+            }
+        """
+        try:
+            body = json.loads(request.body)
+            default_is_new = body['data'].get('is_new')
+            username = body['data'].get('username')
+            devices = body['data']['devices']
+            basic_file_ids = set(
+                (device['content']['SA']['basic']['basic_file'],
+                 device['content']['SA']['basic']['language'])
+                for device in devices
             )
+            d_names = [(device['dm_result']['dm']['name'], device['d_name'])
+                       for device in devices]
+            user_object = get_user_model().objects.get(username=username)
+        except:
+            return DeviceTalkErrorJsonResponse('Wrong request parameter.', 400)
 
-            # Create all the dfs object.
-            # No matter that df is used in this device.
-            for df_type in ('idf', 'odf'):
-                df_list = dm_result[df_type]
-                for df in df_list:
-                    dftype_object, _ = DfType.objects.get_or_create(
-                        df_type=df_type,
-                        params=df['df_type']
+        if len(devices) == 0:
+            return DeviceTalkErrorJsonResponse('No device in the batch.', 400)
+        if len(devices) > settings.DEVICE_BUILD_BATCH_MAX_SIZE:
+            return DeviceTalkErrorJsonResponse(
+                'At most %d devices in a batch.' % settings.DEVICE_BUILD_BATCH_MAX_SIZE,
+                400)
+        if len(set(d_names)) != len(d_names):
+            return DeviceTalkErrorJsonResponse('Duplicate device name in the batch.', 400)
+
+        # Check language name and basic file id
+        basic_file_objects = {
+            basic_file_object.id: basic_file_object
+            for basic_file_object in BasicFile.objects.filter(
+                id__in=[basic_file_id for basic_file_id, __ in basic_file_ids]
+            ).select_related('language')
+        }
+        for basic_file_id, language in basic_file_ids:
+            basic_file_object = basic_file_objects.get(basic_file_id)
+            if basic_file_object is None or basic_file_object.language.name != language:
+                return DeviceTalkErrorJsonResponse(
+                    'Wrong language and basic file mapping.', 400)
+
+        # Save all the devices, or none of them.
+        batch_id = uuid.uuid4()
+        dftype_objects = {}
+        inputs = BuildInputs()
+        try:
+            with transaction.atomic():
+                for device in devices:
+                    device_object, device_lib_object, used_df_list = _save_device(
+                        user_object,
+                        device.get('is_new', default_is_new),
+                        device['dm_result'],
+                        device['d_name'],
+                        device['content'],
+                        basic_file_objects[device['content']['SA']['basic']['basic_file']],
+                        dftype_objects,
+                        inputs
                     )
-                    DeviceDf.objects.create(
-                        name=df['name'],
-                        df_type=dftype_object,
+                    BuildJob.objects.create(
                         device=device_object,
+                        device_library=device_lib_object,
+                        used_df_list=used_df_list,
+                        batch=batch_id
                     )
+        except:
+            logger.exception('Save the batch of devices failed.')
+            return DeviceTalkErrorJsonResponse('Wrong device content in the batch.', 400)
 
-        # Update device's content.
-        device_object.content = content
-        device_object.save()
+        # Generate the device-library files and SA code in the background.
+        try:
+            build_queue.submit_batch(batch_id)
+        except queue.Full:
+            BuildJob.objects.filter(batch=batch_id).delete()
+            return DeviceTalkErrorJsonResponse(
+                'Too many devices are building, please try again later.', 503)
 
-        # Create the device-library
-        config_result = device_object.basic_file.get_all_config()
+        return DeviceTalkJsonResponse(build_batch_info(batch_id))
 
-        # Not all df is used in this device.
-        # Create a list with all the used df's name.
-        used_df_list = []
-        for df_type in ('idf', 'odf'):
-            for df in dm_result[df_type]:
-                if df['used'] == 1:
-                    used_df_list.append(df['name'])
-
-        # Create the render context
-        jinja2_render_data = {
-            'sa': {
-                'device_name': device_object.name,
-                'global_variable_setup': device_object.global_var_setup
-            },
-            'da': {
-                'server_url': device_object.server_url,
-                'device_model': device_object.dm_name,
-                'device_addr': device_object.device_address,
-                'push_interval': device_object.push_interval,
-            },
-            'functions': [
-                function_render(df_object)
-                for df_object in device_object.df_set.all()
-                if df_object.name in used_df_list
-            ],
-            'idf': {
-                'name_list': [
-                    idf_object.name
-                    for idf_object in device_object.df_set.filter(df_type__df_type='idf')
-                    if idf_object.name in used_df_list
-                ],
-                'info': [
-                    {
-                        'name': idf_object.name,
-                        'func_name': idf_object.re_name,
-                        'params': {
-                            'list': idf_object.df_type.params,
-                            'set': set(idf_object.df_type.params),
-                            'len': len(idf_object.df_type.params),
-                            'set_len': len(set(idf_object.df_type.params)),
-                        }
-                    }
-                    for idf_object in device_object.df_set.filter(df_type__df_type='idf')
-                    if idf_object.name in used_df_list
-                ]
-            },
-            'odf': {
-                'name_list': [
-                    odf_object.name
-                    for odf_object in device_object.df_set.filter(df_type__df_type='odf')
-                    if odf_object.name in used_df_list
-                ],
-                'info': [
-                    {
-                        'name': odf_object.name,
-                        'func_name': odf_object.re_name,
-                        'params': {
-                            'list': odf_object.df_type.params,
-                            'set': set(odf_object.df_type.params),
-                            'len': len(odf_object.df_type.params),
-                            'set_len': len(set(odf_object.df_type.params)),
-                        }
-                    }
-                    for odf_object in device_object.df_set.filter(df_type__df_type='odf')
-                    if odf_object.name in used_df_list
-                ]
-            },
-        }
-        jinja2_content_render = ContentRender(jinja2_render_data)
-
-        # New lib file
-        # render the lib path from format-string. Ex:
-        # config_result['device_lib_path'][0]: libraries/{sa[device_name]}_library/...
-        # new_lib_file_path: libraries/Dummy_demo_library/...
-        new_lib_file_path = jinja2_content_render.render_string(
-            config_result['device_lib_path'][0], False
-        )
-        # Get the new_library_name. Ex:
-        # new_lib_file_path: libraries/Dummy_demo_library/...
-        # device_object.basic_file.lib_root: libraries/
-        # After os.path.relpath the result become `Dummy_demo_library/...`,
-        # so the library name is at first item of the path.
-        lib_root = device_object.basic_file.lib_root
-        new_lib_file_path = os.path.relpath(
-            new_lib_file_path, device_object.basic_file.lib_root
-        )
-        new_library_name = new_lib_file_path.split('/')[0]
 
-        # Save device library
+class BuildJobView(View):
+    '''
+    GET: Get the state of the device build.
+        Route: DEVICETALK_POSFIX/api/build/<str:job_id>
+    GET: Download the zip file of the finished device build.
+        Route: DEVICETALK_POSFIX/api/build/<str:job_id>/download
+    '''
+    http_method_names = [
+        'get',
+    ]
 
-        # If the exist device-library with same name
-        # Set new device-library non-global.
-        device_lib_objects = DeviceLibrary.objects.filter(
-            basic_file__language__name=language,
-            name=new_library_name
-        )
-        new_dl_is_global = len(device_lib_objects) == 0
+    @check_login
+    def get(self, request, *args, **kwargs):
+        """ This function get the state of the device build, or download its zip file.
 
-        device_lib_objects = device_lib_objects.filter(
-            user=user_object
-        )
-        # If this user already saved this device, device_lib_objects won't be empty
-        # after the filter.
-        if len(device_lib_objects) == 0:
-            # Create new device-library.
-            device_lib_object = DeviceLibrary.objects.create(
-                name=new_library_name,
-                basic_file=device_object.basic_file,
-                user=None if new_dl_is_global else device_object.user,
-                global_var_setup=device_object.global_var_setup,
-                dir_path=('%s/' % (new_library_name)),
-            )
-            new_lib_uuid_code = File.uuid_generate()
-            new_lib_real_path = settings.FILE_UPLOAD_DIR + new_lib_uuid_code.hex
-            # Get file extension name. ex: 'zip'
-            file_extension = new_lib_file_path.split('/')[-1].split('.')[-1]
-            if len(file_extension) > 1:
-                new_lib_real_path = new_lib_real_path + '.' + file_extension
-            File.objects.create(
-                file_path=new_lib_file_path,
-                real_path=new_lib_real_path,
-                uuid=new_lib_uuid_code,
-                device_library=device_lib_object,
-                is_upload=True
+        Url Params::
+            job_id: the job_id responded by `DeviceManagerView.post`
+
+        Sucess Response format::
+            {
+                'state': 'OK',
+                'result': {
+                    'job_id': 'abc123...',
+                    'state': 'queued' | 'running' | 'done' | 'failed',
+                    'reason': '',  # The error message if the build failed.
+                    # Only if the build is done.
+                    'zip_path': '/upload/result/...',  # The url to get the zip file
+                    'zip_name': 'Dummy_demo.zip'
+                }
+            }
+
+        Error Response format::
+            {
+                'state': 'error',
+                'reason': '...'
+            }
+        """
+        try:
+            build_job_object = BuildJob.objects.select_related('device__file').get(
+                uuid=kwargs['job_id']
             )
-        else:
-            # Just over-write the existed device-library.
-            device_lib_object = device_lib_objects.first()
-
-        # Get SA template from basic file and write the result into device-library file.
-        with device_object.basic_file.open(config_result['device_lib_path'][0], 'r') as f:
-            new_lib_file_template = f.read()
-        with device_lib_object.file.first().open('w') as f:
-            content_string = jinja2_content_render.render_string(new_lib_file_template)
-            f.write(content_string)
-
-        # Copy all the functions' relation from device to device-library.
-        # device's related functions
-        device_lib_object.functions.clear()
-        for func in device_object.functions.all():
-            device_lib_object.functions.add(func)
-        # device's related libraries
-        device_lib_object.dependency_library.clear()
-        for lib in device_object.library_set.all():
-            if lib.library:
-                device_lib_object.dependency_library.add(lib.library)
-        # all df's related libraries
-        for df in device_object.df_set.all():
-            device_lib_object.add_df_functions(df)
-        # global variable's settings.
-        device_lib_object.global_var_setup = device_object.global_var_setup
-        device_lib_object.gvs_readonly_lines = device_object.gvs_readonly_lines
-        device_lib_object.save()
-
-        # Generate SA code
-        dst_outer_dir = '/'.join(device_object.file.real_path.split('/')[:-1])
-        dst_dir = '%s/%s/' % (
-            dst_outer_dir,
-            d_name
-        )
-        # Get all SA code's file objects.
-        basic_files = [
-            file for file in device_object.basic_file.file_set.all()
-        ]
-        # Get the list of all dependency library's file objects.
-        lib_files = [
-            [file for file in library.file_set.all()]
-            for library in device_lib_object.dependency_library.all()
-        ]
-        # Append device-library's file objects into the list.
-        lib_files.append([file for file in device_lib_object.file.all()])
-        # Flat 2D list to 1D list.
-        lib_files = sum(lib_files, [])
-
-        # Render templates to file or copy other files to the dest. dir.
-        # Ignore config file, device-library template(device_lib_path),
-        # new sa function template (idf_template, odf_template)
-        for file in basic_files:
-            if file.file_path in config_result['template']:
-                jinja2_content_render.render_file(file, dst_dir + file.file_path)
-            elif file.file_path == settings.BASICFILE_CONF_FILENAME:
-                pass
-            elif file.file_path in config_result['idf_template']:
-                pass
-            elif file.file_path in config_result['odf_template']:
-                pass
-            elif file.file_path in config_result['device_lib_path']:
-                pass
-            else:
-                copy_file(file, os.path.join(dst_dir, file.file_path))
-        # Copy all the libraries files
-        for file in lib_files:
-            # Need to add lib_root in front all the files
-            copy_file(file, os.path.join(dst_dir, lib_root, file.file_path))
-        # Zip the dir
-        exec_str = 'cd %s; zip -FSr %s.zip %s > /dev/null; rm -r %s/' % (
-            dst_outer_dir,
-            d_name,
-            d_name,
-            d_name,
+        except:
+            return DeviceTalkErrorJsonResponse('Build job not found')
+        if fail_lost_jobs(BuildJob.objects.filter(id=build_job_object.id)):
+            build_job_object.refresh_from_db()
+
+        if not kwargs.get('download'):
+            return DeviceTalkJsonResponse(build_job_object.info)
+
+        if build_job_object.state != BuildJob.State.DONE:
+            return DeviceTalkErrorJsonResponse('Build job is not done', 400)
+        device_file_object = build_job_object.device.file
+        return FileResponse(
+            device_file_object.open('rb'),
+            as_attachment=True,
+            filename=device_file_object.file_path
         )
-        os.system(exec_str)
 
+
+class BuildStatsView(View):
+    '''
+    GET: Get the cumulative statistics of the device builds in this process.
+        Route: DEVICETALK_POSFIX/api/build/stats
+    '''
+    http_method_names = [
+        'get',
+    ]
+
+    @check_login
+    def get(self, request, *args, **kwargs):
+        """ This function get the cumulative statistics of the device builds.
+
+        Sucess Response format::
+            {
+                'state': 'OK',
+                'result': {
+                    'builds': 10,  # Number of the finished builds.
+                    'failed_builds': 1,
+                    'seconds': {  # Total seconds of each stage, see `api.build.BuildStats`
+                        'queue': 0.5,
+                        'db': 0.1,
+                        'function_render': 0.02,
+                        'render': 0.3,
+                        'copy': 1.2,
+                        'zip': 0.4,
+                        'publish': 0.01
+                    },
+                    'templates_rendered': 20,
+                    'files_copied': 300,
+                    'bytes_written': 1048576,
+                    'cache_hits': 4,
+                    'queue_size': 0,  # Number of the jobs waiting in the build queue.
+                    'templates': {  # The compiled template cache.
+                        'hits': 100,
+                        'misses': 10,
+                        'size': 10
+                    }
+                }
+            }
+        """
         return DeviceTalkJsonResponse({
-            'zip_path': device_object.file.url,
-            'zip_name': device_object.file.file_path
+            **build_metrics.stats,
+            'queue_size': build_queue.size,
+            'templates': template_cache.stats,
         })
+
+
+class BuildBatchView(View):
+    '''
+    GET: Get the state of the batch build.
+        Route: DEVICETALK_POSFIX/api/build/batch/<str:batch_id>
+    GET: Download the archive of all the device zip files of the finished batch build.
+        Route: DEVICETALK_POSFIX/api/build/batch/<str:batch_id>/download
+    '''
+    http_method_names = [
+        'get',
+    ]
+
+    @check_login
+    def get(self, request, *args, **kwargs):
+        """ This function get the state of the batch build, or download its archive.
+            The archive has the zip file of each device, `<dm_name>/<d_name>.zip`.
+
+        Url Params::
+            batch_id: the batch_id responded by `DeviceBatchView.post`
+
+        Sucess Response format::
+            {
+                'state': 'OK',
+                'result': {
+                    'batch_id': 'abc123...',
+                    # 'done' only if all the builds are done.
+                    'state': 'queued' | 'running' | 'done' | 'failed',
+                    'jobs': [...]  # Detail format: api.views.BuildJobView
+                }
+            }
+
+        Error Response format::
+            {
+                'state': 'error',
+                'reason': '...'
+            }
+        """
+        try:
+            batch_id = uuid.UUID(kwargs['batch_id'])
+        except:
+            return DeviceTalkErrorJsonResponse('Build batch not found')
+        batch_info = build_batch_info(batch_id)
+        if batch_info is None:
+            return DeviceTalkErrorJsonResponse('Build batch not found')
+
+        if not kwargs.get('download'):
+            return DeviceTalkJsonResponse(batch_info)
+
+        if batch_info['state'] != BuildJob.State.DONE:
+            return DeviceTalkErrorJsonResponse('Build batch is not done', 400)
+        return FileResponse(
+            open(batch_archive_path(batch_id), 'rb'),
+            as_attachment=True,
+            filename='devices.zip'
+        )
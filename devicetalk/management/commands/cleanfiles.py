@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from devicetalk.service import orphan_file_cleanup
+
+
+class Command(BaseCommand):
+    help = 'Remove the uploaded and built files which no File refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report the orphan files, do not remove them.'
+        )
+
+    def handle(self, *args, **kwargs):
+        dry_run = kwargs.get('dry_run', False)
+        cleaned_list, missing_list, reclaimed_bytes = orphan_file_cleanup(dry_run)
+
+        self.stdout.write("Orphan files:")
+        for path in cleaned_list:
+            self.stdout.write(f"\t{path}")
+        self.stdout.write("Files missing in file system:")
+        for file in missing_list:
+            self.stdout.write(f"\t{file}")
+
+        if dry_run:
+            self.stdout.write(
+                f"{len(cleaned_list)} files, {reclaimed_bytes} bytes can be reclaimed."
+            )
+        else:
+            self.stdout.write(
+                f"{len(cleaned_list)} files removed, {reclaimed_bytes} bytes reclaimed."
+            )
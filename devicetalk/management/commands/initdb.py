@@ -1,7 +1,12 @@
+import contextlib
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
 
 from api.models import (
     BasicFile,
@@ -9,6 +14,7 @@ from api.models import (
     Library
 )
 from api.utils import create_library
+from file_handle.models import file_sha256
 from file_handle.utils import (
     create_upload_batch,
     save_file
@@ -16,10 +22,49 @@ from file_handle.utils import (
 from my_admin.utils import update_basicfile
 
 
+def hash_tree(root):
+    # Return the hash of all the files' relative paths and contents under `root`.
+    sha256 = hashlib.sha256()
+    for dp, dn, filenames in os.walk(root):
+        # Walk the directories in a fixed order.
+        dn.sort()
+        for f in sorted(filenames):
+            path = os.path.join(dp, f)
+            sha256.update(os.path.relpath(path, root).encode())
+            sha256.update(b'\0')
+            sha256.update(file_sha256(path).encode())
+    return sha256.hexdigest()
+
+
 class Command(BaseCommand):
     help = 'Initialize the DB'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--update',
+            action='store_true',
+            help='Re-import the existing basic files and libraries whose directory '
+                 'tree is changed since the last import.'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of the basic files or libraries imported in parallel. '
+                 'With SQLite only the directory trees are hashed in parallel, '
+                 'the files are imported one tree at a time.'
+        )
+
     def handle(self, *args, **kwargs):
+        self.update = kwargs.get('update', False)
+        self.jobs = max(kwargs.get('jobs') or 1, 1)
+        # SQLite allows only one writer, the imports wait for each other
+        # while the trees are still hashed in parallel.
+        if connection.vendor == 'sqlite':
+            self.db_lock = threading.Lock()
+        else:
+            self.db_lock = contextlib.nullcontext()
+
         self.stdout.write("Start initializing the default database data.")
 
         self._init_language()
@@ -28,6 +73,46 @@ class Command(BaseCommand):
 
         self.stdout.write("Initialization finished.")
 
+    def _run_tasks(self, func, tasks):
+        # Run func(*task) in the worker threads, and write their messages in order.
+        def run(task):
+            try:
+                return func(*task)
+            finally:
+                # Each worker thread has its own DB connection.
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for messages in executor.map(run, tasks):
+                for message in messages:
+                    self.stdout.write(message)
+
+    def _upload_files(self, files):
+        """ Upload the files like the front-end, return (file_upload_id, err_msg).
+            Input::
+                files: {<short_path>: <full_path>, ...}
+                :full_path: the relative path from app root for copy file
+                :short_path: the required path for file_handler
+        """
+        # 1. Create upload file batch
+        """
+        batch_info = {
+            'upload_info': {
+                <short_path>: <uuid>,
+                ...
+            },
+            'file_upload_id': <upload_batch_object.id>
+        }
+        """
+        batch_info = create_upload_batch(files.keys())
+
+        # 2. Save files
+        err_msg = '\n\t\t'.join(filter(None, [
+            save_file(uuid, files[p])[0]
+            for p, uuid in batch_info.get('upload_info', {}).items()
+        ]))
+        return batch_info.get('file_upload_id'), err_msg
+
     def _init_language(self, *args, **kwargs):
         # Create all the default Languages.
         self.stdout.write("Initializing Languages...")
@@ -46,6 +131,7 @@ class Command(BaseCommand):
         self.stdout.write("Initializing Basic Files...")
 
         basicfile_root = 'DeviceTalk-Basic-file'
+        tasks = []
         # Read files
         for language in os.listdir(basicfile_root):
             # language_dir sample: 'DeviceTalk-Basic-file/Python'
@@ -60,77 +146,63 @@ class Command(BaseCommand):
                 continue
 
             for basicfile_name in os.listdir(language_dir):
-                # Check if the directory name is an existing basic file.
-                if BasicFile.objects.filter(
-                    name=basicfile_name,
-                    language__name=language
-                ).count() > 0:
-                    self.stdout.write(f"\t\t<{basicfile_name}> already exists, skip.")
-                    continue
+                tasks.append((language, basicfile_name, language_dir))
 
-                self.stdout.write(f"\t\t<{basicfile_name}> start importing...")
-                # 1. Get all files
-                # basicfile_dir sample: 'DeviceTalk-Basic-file/Python/default'
-                basicfile_dir = os.path.join(language_dir, basicfile_name)
-                """
-                files = {
-                    <short_path>: {
-                        'full_path': <full_path>,
-                        'uuid': None
-                    },
-                    ...
-                }
-                :full_path: the relative path from app root for copy file
-                :short_path: the required path for file_handler
-                :uuid: store uuid from upload file batch step
-                """
-                files = {
-                    os.path.join(dp, f).replace(f'{basicfile_dir}/', ''): {
-                        'full_path': os.path.join(dp, f),
-                        'uuid': None,
-                    } for dp, dn, filenames in os.walk(basicfile_dir) for f in filenames
-                }
-
-                # 2. Create upload file batch
-                """
-                batch_info = {
-                    'upload_info': {
-                        <short_path>: <uuid>,
-                        ...
-                    },
-                    'file_upload_id': <upload_batch_object.id>
-                }
-                """
-                batch_info = create_upload_batch(files.keys())
-                for p, uuid in batch_info.get('upload_info', {}).items():
-                    files[p].update({'uuid': uuid})
-
-                # 3. Save files
-                err_msg = '\n\t\t'.join(filter(None, [
-                    save_file(f['uuid'], f['full_path'])[0]
-                    for f in files.values()
-                ]))
-
-                # 4. Set upload file to basic file
-                if err_msg:
-                    self.stdout.write(f'\t\t{err_msg}')
-                state = 'failed' if err_msg else 'completed'
-                file_upload_id = batch_info.get('file_upload_id')
-                err_msg, code = update_basicfile(
-                    file_upload_id,
-                    state,
-                    language,
-                    basicfile_name,
-                    is_create=True
-                )
-                if err_msg:
-                    self.stdout.write(f'\t\t{err_msg}')
+        self._run_tasks(self._import_basic_file, tasks)
+
+    def _import_basic_file(self, language, basicfile_name, language_dir):
+        messages = []
+        # basicfile_dir sample: 'DeviceTalk-Basic-file/Python/default'
+        basicfile_dir = os.path.join(language_dir, basicfile_name)
+        basicfile_objects = BasicFile.objects.filter(
+            name=basicfile_name,
+            language__name=language
+        )
+        # Check if the directory name is an existing basic file.
+        is_create = basicfile_objects.count() == 0
+        if not is_create and not self.update:
+            messages.append(f"\t\t<{basicfile_name}> already exists, skip.")
+            return messages
+
+        source_hash = hash_tree(basicfile_dir)
+        if not is_create and basicfile_objects.first().source_hash == source_hash:
+            messages.append(f"\t\t<{basicfile_name}> not changed, skip.")
+            return messages
+
+        messages.append(f"\t\t<{basicfile_name}> start importing...")
+        # Get all files
+        files = {
+            os.path.join(dp, f).replace(f'{basicfile_dir}/', ''): os.path.join(dp, f)
+            for dp, dn, filenames in os.walk(basicfile_dir) for f in filenames
+        }
+
+        with self.db_lock:
+            file_upload_id, err_msg = self._upload_files(files)
+
+            # Set upload file to basic file
+            if err_msg:
+                messages.append(f'\t\t{err_msg}')
+            state = 'failed' if err_msg else 'completed'
+            err_msg, code = update_basicfile(
+                file_upload_id,
+                state,
+                language,
+                basicfile_name,
+                is_create=is_create
+            )
+            if err_msg:
+                # An existing basic file is kept as it is.
+                messages.append(f'\t\t<{basicfile_name}> not imported: {err_msg}')
+            elif state == 'completed':
+                basicfile_objects.update(source_hash=source_hash)
+        return messages
 
     def _init_library_file(self, *args, **kwargs):
         # Create all the default Library Files.
         self.stdout.write("Initializing Library Files...")
 
         libraryfile_root = 'DeviceTalk-Library-file'
+        tasks = []
         # Read files
         for language in os.listdir(libraryfile_root):
             # language_dir sample: 'DeviceTalk-Library-file/Python'
@@ -156,75 +228,62 @@ class Command(BaseCommand):
                     continue
                 basicfile_object = basicfile_objects.first()
 
-                self.stdout.write(f"\t\t<{basicfile_name}> start importing...")
                 # basicfile_dir sample: 'DeviceTalk-Basic-file/Python/default'
                 basicfile_dir = os.path.join(language_dir, basicfile_name)
 
                 # Check <language>/<basicfile>/<library>
                 for library_name in os.listdir(basicfile_dir):
-                    if Library.objects.filter(
-                        basic_file=basicfile_object,
-                        name=library_name
-                    ).count() != 0:
-                        self.stdout.write(
-                            f"\t\t\t<{basicfile_name}.{library_name}> already exists, skip"
-                        )
-                        continue
-                    else:
-                        self.stdout.write(
-                            f"\t\t\t<{basicfile_name}.{library_name}> start importing..."
-                        )
-                    # 1. Get all files
-                    library_dir = os.path.join(basicfile_dir, library_name)
-                    """
-                    files = {
-                        <short_path>: {
-                            'full_path': <full_path>,
-                            'uuid': None
-                        },
-                        ...
-                    }
-                    :full_path: the relative path from app root for copy file
-                    :short_path: the required path for file_handler
-                    :uuid: store uuid from upload file batch step
-                    """
-                    files = {
-                        os.path.join(dp, f).replace(f'{basicfile_dir}/', ''): {
-                            'full_path': os.path.join(dp, f),
-                            'uuid': None,
-                        } for dp, dn, filenames in os.walk(library_dir) for f in filenames
-                    }
-
-                    # 2. Create upload file batch
-                    """
-                    batch_info = {
-                        'upload_info': {
-                            <short_path>: <uuid>,
-                            ...
-                        },
-                        'file_upload_id': <upload_batch_object.id>
-                    }
-                    """
-                    batch_info = create_upload_batch(files.keys())
-                    for p, uuid in batch_info.get('upload_info', {}).items():
-                        files[p].update({'uuid': uuid})
-
-                    # 3. Save files
-                    err_msg = '\n\t\t'.join(filter(None, [
-                        save_file(f['uuid'], f['full_path'])[0]
-                        for f in files.values()
-                    ]))
-
-                    # 4. Set upload file to basic file
-                    if err_msg:
-                        self.stdout.write(f'\t\t{err_msg}')
-                    state = 'failed' if err_msg else 'completed'
-                    file_upload_id = batch_info.get('file_upload_id')
-                    err_msg, code = create_library(
-                        language,
-                        basicfile_object.id,
-                        file_upload_id,
-                        state,
-                    )
-                    if err_msg:
-                        self.stdout.write(f'\t\t{err_msg}')
+                    tasks.append((language, basicfile_object, basicfile_dir, library_name))
+
+        self._run_tasks(self._import_library, tasks)
+
+    def _import_library(self, language, basicfile_object, basicfile_dir, library_name):
+        messages = []
+        basicfile_name = basicfile_object.name
+        library_objects = Library.objects.filter(
+            basic_file=basicfile_object,
+            name=library_name
+        )
+        is_create = library_objects.count() == 0
+        if not is_create and not self.update:
+            messages.append(
+                f"\t\t\t<{basicfile_name}.{library_name}> already exists, skip"
+            )
+            return messages
+
+        library_dir = os.path.join(basicfile_dir, library_name)
+        source_hash = hash_tree(library_dir)
+        if not is_create and library_objects.first().source_hash == source_hash:
+            messages.append(
+                f"\t\t\t<{basicfile_name}.{library_name}> not changed, skip"
+            )
+            return messages
+
+        messages.append(
+            f"\t\t\t<{basicfile_name}.{library_name}> start importing..."
+        )
+        # Get all files
+        files = {
+            os.path.join(dp, f).replace(f'{basicfile_dir}/', ''): os.path.join(dp, f)
+            for dp, dn, filenames in os.walk(library_dir) for f in filenames
+        }
+
+        with self.db_lock:
+            file_upload_id, err_msg = self._upload_files(files)
+
+            # Set upload file to library, an existing library is updated
+            # with only the changed files and functions.
+            if err_msg:
+                messages.append(f'\t\t{err_msg}')
+            state = 'failed' if err_msg else 'completed'
+            err_msg, code = create_library(
+                language,
+                basicfile_object.id,
+                file_upload_id,
+                state,
+            )
+            if err_msg:
+                messages.append(f'\t\t{err_msg}')
+            elif state == 'completed':
+                library_objects.update(source_hash=source_hash)
+        return messages
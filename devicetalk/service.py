@@ -1,13 +1,28 @@
+import logging
+import os
 from datetime import timedelta
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 
-from api.models import SaFunction
-from file_handle.models import UploadBatch
+from api.models import (
+    BuildJob,
+    Device,
+    DeviceLibrary,
+    SaFunction,
+)
+from file_handle.models import (
+    File,
+    UploadBatch,
+    blob_lock,
+)
 
 timestrf_string = "%m/%d/%Y, %H:%M:%S"
 
+logger = logging.getLogger(__name__)
+
 
 def get_timeout_objects(model):
     """ This function returns all objects in `model` produced before
@@ -40,19 +55,192 @@ def upload_batch_cleanup():
 def sa_function_cleanup():
     """ This function clean all timeout SaFunction which didn't used by any
         Device or DeviceLibrary.
+        The unused functions are found in one query, and deleted in batches of
+        `settings.CLEANUP_BATCH_SIZE`.
     """
-    function_objects = get_timeout_objects(SaFunction)
+    function_objects = get_timeout_objects(SaFunction).annotate(
+        used_by_device=Exists(
+            Device.functions.through.objects.filter(safunction=OuterRef('pk'))
+        ),
+        used_by_devicelibrary=Exists(
+            DeviceLibrary.functions.through.objects.filter(safunction=OuterRef('pk'))
+        ),
+    ).filter(
+        used_by_device=False,
+        used_by_devicelibrary=False
+    )
+    cleaned_info = {
+        func.id: '%s @ [%s]' % (str(func), func.updated_at.strftime(timestrf_string))
+        for func in function_objects.select_related('function_type').order_by('id')
+    }
+    function_ids = list(cleaned_info)
     cleaned_list = []
-    for func in function_objects:
-        if func.used_count() == 0:
-            cleaned_list.append(
-                '%s @ [%s]' %
-                (str(func), func.updated_at.strftime(timestrf_string))
+    batch_size = max(settings.CLEANUP_BATCH_SIZE, 1)
+    for i in range(0, len(function_ids), batch_size):
+        batch_ids = function_ids[i:i + batch_size]
+        with transaction.atomic():
+            # Filter the unused functions again, a function may be used after it's found.
+            deleted_ids = set(
+                function_objects.filter(id__in=batch_ids).values_list('id', flat=True)
             )
-            func.delete()
+            SaFunction.objects.filter(id__in=deleted_ids).delete()
+        cleaned_list.extend(
+            cleaned_info[func_id] for func_id in batch_ids if func_id in deleted_ids
+        )
+        logger.info(
+            'Clean SA function: %d/%d checked, %d deleted.',
+            i + len(batch_ids), len(function_ids), len(cleaned_list)
+        )
     return cleaned_list
 
 
+def build_job_cleanup():
+    """ This function clean all timeout BuildJob.
+        The zip file of the build is kept in the device's file.
+    """
+    build_job_objects = get_timeout_objects(BuildJob)
+    cleaned_list = [
+        "BuildJob(%s) @ [%s]" %
+        (job.uuid, job.updated_at.strftime(timestrf_string))
+        for job in build_job_objects
+    ]
+    build_job_objects.delete()
+    return cleaned_list
+
+
+def _scan_dir(path):
+    # Yield the entries of all the files under `path`, the empty directories are
+    # yielded after their contents.
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_dir(entry.path)
+            yield entry
+
+
+def _remove_orphan_files(orphans, dry_run):
+    """ This function check the orphan files again and remove them.
+        Input::
+            orphans: [(path<str>, size<int>), ...]
+        Return the removed ones.
+    """
+    # Hold the blob lock, so no file can refer to a blob being removed.
+    with blob_lock():
+        used_paths = set(File.objects.filter(
+            real_path__in=[path for path, __ in orphans]
+        ).values_list('real_path', flat=True))
+        removed = []
+        for path, size in orphans:
+            if path in used_paths:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            removed.append((path, size))
+    return removed
+
+
+def orphan_file_cleanup(dry_run=False):
+    """ This function remove all timeout files under `settings.FILE_UPLOAD_DIR`,
+        including the blobs and the build results, which are not the `real_path`
+        of any File. The files are checked and removed in batches of
+        `settings.CLEANUP_BATCH_SIZE`.
+        It also reports the File whose `real_path` is missing, these File are kept.
+        With `dry_run`, nothing is removed, the orphan files are only reported.
+        Return (cleaned_list, missing_list, reclaimed_bytes).
+    """
+    filter_time = (timezone.now() - timedelta(days=1)).timestamp()
+    batch_size = max(settings.CLEANUP_BATCH_SIZE, 1)
+    # The set of the files in use.
+    real_paths = set(File.objects.values_list('real_path', flat=True).iterator())
+    found_paths = set()
+    # The root directories are kept even if they are empty.
+    root_dirs = {
+        os.path.normpath(d) for d in (
+            settings.FILE_UPLOAD_DIR,
+            settings.RESULT_DIR,
+            settings.BLOB_DIR,
+            settings.BUILD_CACHE_DIR,
+        )
+    }
+    lock_path = os.path.join(settings.BLOB_DIR, '.lock')
+    cache_dir = os.path.normpath(settings.BUILD_CACHE_DIR)
+
+    cleaned_list = []
+    reclaimed_bytes = 0
+    orphans = []
+    # The directories, the inner ones first.
+    dirs = []
+
+    def remove_orphans():
+        nonlocal reclaimed_bytes
+        for path, size in _remove_orphan_files(orphans, dry_run):
+            cleaned_list.append(path)
+            reclaimed_bytes += size
+        orphans.clear()
+        logger.info(
+            'Clean orphan file: %d files, %d bytes%s.',
+            len(cleaned_list), reclaimed_bytes, ' (dry run)' if dry_run else ''
+        )
+
+    if not os.path.isdir(settings.FILE_UPLOAD_DIR):
+        return cleaned_list, [], reclaimed_bytes
+    for entry in _scan_dir(settings.FILE_UPLOAD_DIR):
+        path = entry.path
+        if entry.is_dir(follow_symlinks=False):
+            if os.path.normpath(path) not in root_dirs:
+                dirs.append(entry)
+            continue
+        if path in real_paths:
+            found_paths.add(path)
+            continue
+        if path == lock_path:
+            continue
+        # The cached zip files are managed by `api.build.build_cache`.
+        if os.path.dirname(path) == cache_dir and path.endswith('.zip'):
+            continue
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        # Skip the new files, they may be still uploading or building.
+        if stat.st_mtime > filter_time:
+            continue
+        orphans.append((path, stat.st_size))
+        if len(orphans) >= batch_size:
+            remove_orphans()
+    if orphans:
+        remove_orphans()
+
+    # Remove the empty directories left, e.g. the device result directories.
+    if not dry_run:
+        removed_dirs = set(os.path.dirname(path) for path in cleaned_list)
+        with blob_lock():
+            for entry in dirs:
+                try:
+                    if entry.path in removed_dirs or entry.stat().st_mtime <= filter_time:
+                        os.rmdir(entry.path)
+                except OSError:
+                    pass
+
+    # The File whose `real_path` is missing. The device's zip file is built on demand,
+    # and the chunked upload may not have written any data yet, they are not reported.
+    missing_paths = list(real_paths - found_paths)
+    missing_list = []
+    for i in range(0, len(missing_paths), batch_size):
+        missing_list.extend(
+            '%s -> %s' % (str(file), file.real_path)
+            for file in File.objects.filter(
+                real_path__in=missing_paths[i:i + batch_size],
+                device__isnull=True,
+                upload_length__isnull=True
+            ).order_by('id')
+        )
+    return cleaned_list, missing_list, reclaimed_bytes
+
+
 def cleanup_routine():
     """ This function is the entry of scheduler routine.
         All the `print` content will be write in `datas/log/scheduler.log`
@@ -60,10 +248,19 @@ def cleanup_routine():
     t = timezone.localtime()
     sa_cleanup_result = sa_function_cleanup()
     upload_batch_cleanup_result = upload_batch_cleanup()
-    log_string = '[%s]\nClean SA function: %s\nClean Upload Batch: %s\n' % (
-        t.strftime(timestrf_string),
-        str(sa_cleanup_result),
-        str(upload_batch_cleanup_result)
+    build_job_cleanup_result = build_job_cleanup()
+    orphan_file_result, missing_file_result, reclaimed_bytes = orphan_file_cleanup()
+    log_string = (
+        '[%s]\nClean SA function: %s\nClean Upload Batch: %s\nClean Build Job: %s\n'
+        'Clean Orphan File: %s (%d bytes)\nMissing File: %s\n' % (
+            t.strftime(timestrf_string),
+            str(sa_cleanup_result),
+            str(upload_batch_cleanup_result),
+            str(build_job_cleanup_result),
+            str(orphan_file_result),
+            reclaimed_bytes,
+            str(missing_file_result)
+        )
     )
     c = open(f'{settings.LOG_DIR}/scheduler.log', 'a')
     c.write(log_string)
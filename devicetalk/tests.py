@@ -0,0 +1,96 @@
+import io
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management import call_command
+
+from file_handle.models import File
+from file_handle.tests import DataDirTestCase
+
+from .service import _remove_orphan_files, orphan_file_cleanup
+
+
+class OrphanFileCleanupTest(DataDirTestCase):
+    def write(self, path, content=b'x' * 10, age=2 * 24 * 3600):
+        # Write the file, `age` seconds old, return its path.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def create_file(self, real_path, **kwargs):
+        return File.objects.create(
+            file_path=os.path.basename(real_path),
+            real_path=real_path,
+            is_upload=True,
+            uuid=uuid.uuid4(),
+            **kwargs
+        )
+
+    def test_dry_run_report(self):
+        orphan = self.write(settings.FILE_UPLOAD_DIR + 'orphan.py')
+        stdout = io.StringIO()
+        call_command('cleanfiles', '--dry-run', stdout=stdout)
+        self.assertIn('\t%s\n' % orphan, stdout.getvalue())
+        self.assertIn('1 files, 10 bytes can be reclaimed.', stdout.getvalue())
+        # Nothing is removed by the dry run.
+        self.assertTrue(os.path.exists(orphan))
+
+        self.assertEqual(orphan_file_cleanup(), ([orphan], [], 10))
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_referenced_files_kept(self):
+        # The files referred to by a File are kept, so are the blob lock
+        # and the cached zip files.
+        paths = [
+            self.write(settings.FILE_UPLOAD_DIR + 'a.py'),
+            self.write(os.path.join(settings.BLOB_DIR, 'ab', 'ab' * 32)),
+            self.write(os.path.join(settings.RESULT_DIR, 'Dummy', 'Dummy.zip')),
+        ]
+        for path in paths:
+            self.create_file(path)
+        paths.append(self.write(os.path.join(settings.BLOB_DIR, '.lock')))
+        paths.append(self.write(os.path.join(settings.BUILD_CACHE_DIR, 'key.zip')))
+        orphan = self.write(os.path.join(settings.RESULT_DIR, 'Old', 'Old.zip'))
+
+        self.assertEqual(orphan_file_cleanup(), ([orphan], [], 10))
+        for path in paths:
+            self.assertTrue(os.path.exists(path), path)
+        # The empty directory left is removed.
+        self.assertFalse(os.path.exists(os.path.dirname(orphan)))
+
+    def test_new_files_kept(self):
+        # The new files may be still uploading or building.
+        paths = [
+            self.write(settings.FILE_UPLOAD_DIR + 'uploading.py', age=0),
+            self.write(os.path.join(settings.BUILD_CACHE_DIR, 'key.abc.tmp'), age=0),
+        ]
+        self.assertEqual(orphan_file_cleanup(), ([], [], 0))
+        for path in paths:
+            self.assertTrue(os.path.exists(path), path)
+
+    def test_referenced_while_removing(self):
+        # The orphan files are checked again before removed, the file may be
+        # referred to after it's found.
+        orphans = [
+            (self.write(settings.FILE_UPLOAD_DIR + name), 10)
+            for name in ['a.py', 'b.py']
+        ]
+        self.create_file(orphans[0][0])
+        self.assertEqual(_remove_orphan_files(orphans, dry_run=False), orphans[1:])
+        self.assertTrue(os.path.exists(orphans[0][0]))
+        self.assertFalse(os.path.exists(orphans[1][0]))
+
+    def test_missing_files(self):
+        # The File whose file is missing is reported, except the chunked upload
+        # which has no data yet.
+        file_object = self.create_file(settings.FILE_UPLOAD_DIR + 'missing.py')
+        self.create_file(settings.FILE_UPLOAD_DIR + 'chunked.py', upload_length=10)
+        self.assertEqual(
+            orphan_file_cleanup(dry_run=True),
+            ([], ['%s -> %s' % (file_object, file_object.real_path)], 0)
+        )
@@ -1,11 +1,141 @@
 import json
-import requests
+import logging
+import threading
+import time
+from collections import OrderedDict
 
+import requests
 from django.conf import settings
 from django.template.response import TemplateResponse
 
 from xtalk_account.models import AccessToken
 
+logger = logging.getLogger(__name__)
+
+# The HTTP connections to the AG server are kept and reused by all the requests.
+ag_session = requests.Session()
+ag_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+ag_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+
+class DoInfoError(Exception):
+    def __init__(self, reason, status_code=500):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+
+
+def fetch_do_info(p_id, do_id):
+    """ This function get the device object's information from AG.
+        Raise DoInfoError if AG fails.
+
+        Return format::
+
+            {
+                'dm': {'name': <dm_name>, 'id': <dm_id>},
+                'idf': [{'name': <df_name>, 'df_type': ['float'], 'used': 0 or 1}, ...],
+                'odf': [...]
+            }
+    """
+    v1url = f'https://classgui.iottalk.tw/api/v0/project/{p_id}/deviceobject/{do_id}'
+    try:
+        r1 = ag_session.get(v1url, timeout=settings.AG_REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise DoInfoError('AG is not available: %s' % e.__class__.__name__, 503)
+
+    if r1.status_code != 200:
+        raise DoInfoError('Unknown reason.', r1.status_code)
+
+    try:
+        info = json.loads(r1.text)['data']
+        dm = {'name': info['dm_name'], 'id': info['dm_id']}
+        idfs, odfs = ([
+            {
+                'name': df['df_name'],
+                # [para['param_type'] for para in df['df_parameter']],
+                'df_type': ['float'],
+                'used': 1 if df['df_name'] in info['do']['dfo'] else 0
+            }
+            for df in info['df_list']
+            if df['df_type'] == df_type
+        ] for df_type in ('input', 'output'))
+    except (ValueError, KeyError, TypeError):
+        raise DoInfoError('Invalid response from AG.', 502)
+    return {
+        'dm': dm,
+        'idf': idfs,
+        'odf': odfs,
+    }
+
+
+class DoInfoCache:
+    """ This class keep the device object's information from AG by (p_id, do_id).
+        A cached one is used for `ttl` seconds. After that, it's still used for at most
+        `stale` seconds while it's refreshed in background. If AG fails, the cached one
+        is used no matter how old it is.
+    """
+    def __init__(self, ttl, stale, max_size=1024):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_size = max_size
+        # {(p_id, do_id): (fetched_time<float>, do_info<dict>)}
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, p_id, do_id):
+        key = (p_id, do_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                return entry[1]
+            if age < self.ttl + self.stale:
+                self._refresh_in_background(key)
+                return entry[1]
+
+        try:
+            return self._fetch(key)
+        except DoInfoError as e:
+            if entry is None:
+                raise
+            logger.warning('Use the cached device object %s: %s', key, e.reason)
+            return entry[1]
+
+    def _fetch(self, key):
+        do_info = fetch_do_info(*key)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), do_info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return do_info
+
+    def _refresh_in_background(self, key):
+        # Only one thread refreshes a device object at a time.
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key)
+            except DoInfoError as e:
+                logger.warning('Refresh the device object %s failed: %s', key, e.reason)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+do_info_cache = DoInfoCache(settings.AG_INFO_CACHE_TTL, settings.AG_INFO_CACHE_STALE)
+
 
 class GetDoInfo:
     __is_valid = False
@@ -45,90 +175,21 @@ class GetDoInfo:
         return True
 
     def _get_info(self):
-        data = {
-            "api_name": "deviceobject.get",
-            "payload": {
-                "p_id": self.__p_id,
-                "do_id": self.__do_id
-            },
-#            "access_token": self.__access_token_object.token
-        }
-        '''
-        r = requests.post(settings.AUTOGEN_CCMAPI_URL, json=data)
-        '''
-
-        pid = self.__p_id# '566'
-        doid =self.__do_id# '2845'
-        v1url = f'https://classgui.iottalk.tw/api/v0/project/{pid}/deviceobject/{doid}'
-        r1 = requests.get(v1url)
-        info = json.loads(r1.text)
-        '''
-        body = json.loads(r.text)
-        '''
-
-        self.__status_code = r1.status_code
-        '''
-        self.__status_code = r.status_code
-        '''
-
-        if r1.status_code == 200:
-            '''
-            result = body['result']
-            '''
-            info = info['data'] 
-
-            self.__dm1 = {'name': info['dm_name'], 'id': info['dm_id']}
-            '''
-            self.__dm = {'name': result['dm_name'], 'id': result['dm_id']}
-            '''
-
-
-            self.__idfs1, self.__odfs1 = ([
-                {
-                    'name': df['df_name'],
-                    'df_type': ['float'], #[para['param_type'] for para in df['df_parameter']],
-                    'used': 1 if df['df_name'] in info['do']['dfo'] else 0
-                }
-                for df in info['df_list']
-                if df['df_type'] == df_type
-
-            ] for df_type in ('input', 'output'))
-            self.__is_valid = True
-
-#            print(self.__idfs1)
-#            print(self.__odfs1)
-
-            '''
-            self.__idfs, self.__odfs = ([
-                {
-                    'name': df['df_name'],
-                    'df_type': [para['param_type'] for para in df['df_parameter']],
-                    'used': 1 if df['df_name'] in result['do']['dfo'] else 0
-                }
-                for df in result['df_list']
-                if df['df_type'] == df_type
-            ] for df_type in ('input', 'output'))
-            self.__is_valid = True
-            '''
- #           print(self.__idfs)
- #           print(self.__odfs)
-
-#        elif 'reason' in body:
-#        elif 'reason' in info:
-#            self.__reason = 'Error in AG!\n%s' % body['reason']
-        else:
-            self.__reason = 'Unknown reason.'
-
-
-
+        """ This function get the device object's information from AG.
+            The result is cached by `do_info_cache`.
+        """
+        try:
+            self.__do_info = do_info_cache.get(self.__p_id, self.__do_id)
+        except DoInfoError as e:
+            self.__reason = e.reason
+            self.__status_code = e.status_code
+            return
+        self.__status_code = 200
+        self.__is_valid = True
 
     @property
     def do_info(self):
-        return {
-            'dm': self.__dm1,
-            'idf': self.__idfs1,
-            'odf': self.__odfs1,
-        }
+        return self.__do_info
 
     @property
     def reason(self):
@@ -7,7 +7,7 @@ from file_handle.models import (
 
 
 class FileAdmin(admin.ModelAdmin):
-    readonly_fields = ('created_at', 'uuid')
+    readonly_fields = ('created_at', 'uuid', 'sha256')
 
 
 admin.site.register(UploadBatch)
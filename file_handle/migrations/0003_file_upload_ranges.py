@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_handle', '0002_file_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='received_ranges',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='upload_length',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,8 +1,13 @@
+import contextlib
+import fcntl
+import hashlib
 import os
+import pathlib
+import shutil
 import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 
 from api.models import (
@@ -18,6 +23,27 @@ __all__ = [
 ]
 
 
+@contextlib.contextmanager
+def blob_lock():
+    # Adding or removing the references of the blobs is serialized
+    # between the threads and the processes by this lock.
+    os.makedirs(settings.BLOB_DIR, exist_ok=True)
+    with open(os.path.join(settings.BLOB_DIR, '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 class UploadBatch(models.Model):
     updated_at = models.DateTimeField(
         auto_now=True
@@ -39,6 +65,24 @@ class File(models.Model):
     is_upload = models.BooleanField(
         default=False
     )
+    # SHA-256 of the content if this file is in the blob store (settings.BLOB_DIR),
+    # then `real_path` is the blob and may be shared with the other files.
+    # Empty if this file has its own `real_path`.
+    sha256 = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True
+    )
+    # The total size and the received byte ranges ([[start, end], ...], sorted and
+    # disjoint) of the chunked upload, see `file_handle.utils.save_file_chunk`.
+    upload_length = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+    received_ranges = models.JSONField(
+        default=list,
+        blank=True
+    )
     uuid = models.UUIDField(
         editable=False,
         unique=True
@@ -88,13 +132,160 @@ class File(models.Model):
         return f'[{self.id}]{self.file_path}'
 
     # Open the file in file system.
+    # A blob is never modified, this file gets its own copy before writing.
     def open(self, mode):
+        if self.sha256 and any(m in mode for m in 'wax+'):
+            self.detach_blob(copy=not ('w' in mode or 'x' in mode))
         return open(self.real_path, mode)
 
-    # Before delete this item, delete the file in file system.
+    # Replace the content of the file in file system atomically,
+    # so the readers never see a partly written file.
+    def write(self, content):
+        if self.sha256:
+            self.detach_blob(copy=False)
+        temp_path = '%s.%s.tmp' % (self.real_path, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+                f.write(content)
+            os.replace(temp_path, self.real_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    # After delete this item, delete the file in file system after the current
+    # transaction is committed, so a rollback keeps it.
+    # A blob is deleted only if no other file refers to it.
+    # If it's interrupted between them, the file left is removed by
+    # `devicetalk.service.orphan_file_cleanup`.
     def delete(self, *args, **kwargs):
-        os.remove(self.real_path)
-        return super().delete(*args, **kwargs)
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: File.remove_files([self]))
+        return result
+
+    def store_blob(self, sha256=None):
+        """ Move this file into the blob store. If the blob with the same content
+            exists already, this file refers to it and its own copy is removed.
+            This file must be saved already, see `store_blobs`.
+            Input::
+                sha256: str, the SHA-256 of the content if it's known.
+        """
+        if sha256 is None:
+            sha256 = file_sha256(self.real_path)
+        File.store_blobs([(self, sha256)])
+
+    @staticmethod
+    def store_blobs(files):
+        """ Move the saved files into the blob store, in one `blob_lock`.
+            In a transaction, they're moved after it's committed. The rows referring
+            to a blob must be committed before `blob_lock` is released, otherwise
+            the blob may be released by the others.
+            Input::
+                files: [(file_object<File>, sha256<str>), ...]
+        """
+        def store():
+            with blob_lock():
+                stored = []
+                for file_object, sha256 in files:
+                    try:
+                        blob_path = File.move_to_blob(file_object.real_path, sha256)
+                    except FileNotFoundError:
+                        # The file is deleted meanwhile.
+                        continue
+                    file_object.real_path = blob_path
+                    file_object.sha256 = sha256
+                    stored.append(file_object)
+                # The files created by `bulk_create` may not have their id.
+                ids = dict(File.objects.filter(
+                    uuid__in=[file_object.uuid for file_object in stored]
+                ).values_list('uuid', 'id'))
+                for file_object in stored:
+                    file_object.id = ids.get(file_object.uuid)
+                File.objects.bulk_update(
+                    [file_object for file_object in stored if file_object.id],
+                    ['real_path', 'sha256']
+                )
+        transaction.on_commit(store)
+
+    @staticmethod
+    def move_to_blob(path, sha256):
+        """ Move the file at `path` into the blob store and return the blob's path.
+            The caller must hold `blob_lock` until the files referring to the blob
+            are saved and committed, otherwise the blob may be released by the others.
+        """
+        blob_path = os.path.join(settings.BLOB_DIR, sha256[:2], sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            os.remove(path)
+        else:
+            os.replace(path, blob_path)
+        return blob_path
+
+    def detach_blob(self, copy=True):
+        """ Move this file out of the blob store, to its own `real_path`.
+            Input::
+                copy: bool, copy the content of the blob to the new `real_path`.
+        """
+        blob_path = self.real_path
+        real_path = '%s%s%s' % (
+            settings.FILE_UPLOAD_DIR,
+            self.uuid,
+            pathlib.Path(self.file_path).suffix
+        )
+        if copy:
+            shutil.copyfile(blob_path, real_path)
+        self.real_path = real_path
+        self.sha256 = ''
+        self.save()
+        self.release_blob(blob_path)
+
+    @staticmethod
+    def release_blob(blob_path):
+        File.release_blobs([blob_path])
+
+    @staticmethod
+    def release_blobs(blob_paths):
+        # Remove the blobs which no file refers to anymore, after the current
+        # transaction is committed, so a rollback keeps them.
+        def release():
+            with blob_lock():
+                used_paths = set(File.objects.filter(
+                    real_path__in=blob_paths
+                ).values_list('real_path', flat=True))
+                for blob_path in set(blob_paths) - used_paths:
+                    try:
+                        os.remove(blob_path)
+                    except FileNotFoundError:
+                        pass
+        transaction.on_commit(release)
+
+    @staticmethod
+    def remove_files(file_objects):
+        # Remove the deleted files' files in file system.
+        File.release_blobs([
+            file_object.real_path
+            for file_object in file_objects if file_object.sha256
+        ])
+        for file_object in file_objects:
+            if file_object.sha256:
+                continue
+            try:
+                os.remove(file_object.real_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def bulk_delete(file_objects):
+        """ Delete the files in one query. Their files in file system are removed after
+            the current transaction is committed, so a rollback keeps all of them.
+        """
+        file_objects = list(file_objects)
+        if not file_objects:
+            return
+        File.objects.filter(
+            id__in=[file_object.id for file_object in file_objects]
+        ).delete()
+        transaction.on_commit(lambda: File.remove_files(file_objects))
 
     @property
     def url(self):
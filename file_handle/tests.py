@@ -1,3 +1,339 @@
-# from django.test import TestCase
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from .models import File, UploadBatch
+from .utils import create_upload_batch, save_archive, save_file
+
+
+class DataDirMixin:
+    """ The data directories in the settings are relative to the working directory,
+        each test runs in its own temporary working directory.
+    """
+    def setUp(self):
+        super().setUp()
+        cwd = os.getcwd()
+        self.data_dir = tempfile.mkdtemp()
+        os.chdir(self.data_dir)
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.addCleanup(os.chdir, cwd)
+        os.makedirs(settings.RESULT_DIR)
+
+    def upload(self, files):
+        # Upload the files {file_path: content} like the front-end,
+        # return the upload batch's id.
+        source_dir = tempfile.mkdtemp(dir=self.data_dir)
+        batch_info = create_upload_batch(list(files))
+        for file_path, uuid in batch_info['upload_info'].items():
+            path = os.path.join(source_dir, file_path.replace('/', '_'))
+            with open(path, 'wb' if isinstance(files[file_path], bytes) else 'w') as f:
+                f.write(files[file_path])
+            self.assertEqual(save_file(uuid, path), ('', 200))
+        return batch_info['file_upload_id']
+
+    def data_files(self):
+        # Return the paths of all the files under the data directory.
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.data_dir)
+            for root, __, names in os.walk(self.data_dir) for name in names
+        )
+
+
+class DataDirTestCase(DataDirMixin, TestCase):
+    pass
+
+
+class DataDirTransactionTestCase(DataDirMixin, TransactionTestCase):
+    # The on_commit callbacks run at once, ex: storing and releasing the blobs.
+    pass
+
+
+class ChunkedUploadTest(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = os.urandom(1000)
+        batch_info = create_upload_batch(['a.bin'])
+        self.uuid = batch_info['upload_info']['a.bin']
+        self.url = '/api/file/%s' % self.uuid
+
+    def post_chunk(self, start, end, length=None):
+        # Send the chunk [start, end) of the content, return the response.
+        return self.client.post(
+            self.url, self.content[start:end],
+            content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(start),
+            HTTP_UPLOAD_LENGTH=str(len(self.content) if length is None else length)
+        )
+
+    def finalize(self, sha256=None):
+        return self.client.put(
+            self.url, json.dumps({'data': {'sha256': sha256}}),
+            content_type='application/json')
+
+    def upload_state(self):
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response['Upload-Offset'], response['Upload-Length']
+
+    def assert_uploaded(self):
+        file_object = File.objects.get(uuid=self.uuid)
+        self.assertTrue(file_object.is_upload)
+        with file_object.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_head_resume(self):
+        self.assertEqual(self.upload_state(), ('0', ''))
+        self.assertEqual(self.post_chunk(0, 400).status_code, 200)
+        # The interrupted upload is resumed from `Upload-Offset`.
+        offset, length = self.upload_state()
+        self.assertEqual((offset, length), ('400', '1000'))
+        self.assertEqual(self.post_chunk(int(offset), 1000).status_code, 200)
+        self.assertEqual(self.finalize().status_code, 200)
+        self.assert_uploaded()
+        self.assertEqual(self.client.head('/api/file/unknown').status_code, 404)
+
+    def test_out_of_order_chunks(self):
+        for start in [600, 200, 800, 0, 400]:
+            self.assertEqual(self.post_chunk(start, start + 200).status_code, 200)
+            # Only the data received from the beginning is counted.
+            if start == 800:
+                self.assertEqual(self.upload_state(), ('0', '1000'))
+        self.assertEqual(self.upload_state(), ('1000', '1000'))
+        self.assertEqual(self.finalize().status_code, 200)
+        self.assert_uploaded()
+
+    def test_overlapping_chunks(self):
+        for start, end in [(0, 500), (300, 700), (300, 700), (650, 1000)]:
+            self.assertEqual(self.post_chunk(start, end).status_code, 200)
+        self.assertEqual(
+            File.objects.get(uuid=self.uuid).received_ranges, [[0, 1000]])
+        self.assertEqual(self.finalize().status_code, 200)
+        self.assert_uploaded()
+
+    def test_finalize_incomplete(self):
+        self.assertEqual(self.finalize().status_code, 400)
+        self.post_chunk(0, 400)
+        self.post_chunk(500, 1000)
+        response = self.finalize()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('not completely uploaded', json.loads(response.content)['reason'])
+
+    def test_length_mismatch(self):
+        self.post_chunk(0, 400)
+        # The total size can't be changed, the chunk can't exceed it.
+        self.assertEqual(self.post_chunk(400, 1000, length=2000).status_code, 400)
+        self.assertEqual(self.post_chunk(400, 1000, length=900).status_code, 400)
+        self.assertEqual(self.upload_state(), ('400', '1000'))
+
+    def test_sha256_mismatch(self):
+        self.post_chunk(0, 1000)
+        response = self.finalize('0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('SHA-256 mismatch', json.loads(response.content)['reason'])
+        # The received data is dropped, the file is uploaded again.
+        self.assertEqual(self.upload_state(), ('0', ''))
+        self.post_chunk(0, 1000)
+        self.assertEqual(
+            self.finalize(hashlib.sha256(self.content).hexdigest()).status_code, 200)
+        self.assert_uploaded()
+        # The finished file takes no more chunks.
+        self.assertEqual(self.post_chunk(0, 1000).status_code, 400)
+
+    def test_chunks_hold_file_lock(self):
+        # The chunks of the file are saved one by one in all the processes, the
+        # received range is saved while holding the lock of the file.
+        locked = []
+        save = File.save
+
+        def check_lock(file_object, *args, **kwargs):
+            path = os.path.join(settings.BUILD_LOCK_DIR, 'upload-%s.lock' % self.uuid)
+            with open(path) as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked.append(file_object.uuid)
+            return save(file_object, *args, **kwargs)
+
+        with mock.patch.object(File, 'save', check_lock):
+            self.assertEqual(self.post_chunk(0, 1000).status_code, 200)
+            self.assertEqual(self.finalize().status_code, 200)
+        self.assertEqual(len(locked), 2)
+        self.assertEqual(os.listdir(settings.BUILD_LOCK_DIR), [])
+
+
+def make_zip(files):
+    # Return the zip archive of the files {file_path: bytes}.
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        for file_path, content in files.items():
+            zip_file.writestr(file_path, content)
+    archive.seek(0)
+    return archive
+
+
+def make_tar(files, links=None):
+    # Return the tar.gz archive of the files {file_path: bytes},
+    # and the symbolic links {file_path: target}.
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar_file:
+        for file_path, content in files.items():
+            info = tarfile.TarInfo(file_path)
+            info.size = len(content)
+            tar_file.addfile(info, io.BytesIO(content))
+        for file_path, target in (links or {}).items():
+            info = tarfile.TarInfo(file_path)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar_file.addfile(info)
+    archive.seek(0)
+    return archive
+
+
+class ArchiveUploadTest(DataDirTestCase):
+    FILES = {'RPi/RPi/gpio.py': b'GPIO = 1\n', 'RPi/examples/a.py': b'a = 1\n'}
+
+    def assert_saved(self, archive, files):
+        err_msg, code, file_upload_id = save_archive(archive)
+        self.assertEqual((err_msg, code), ('', 200))
+        saved = {}
+        for file_object in File.objects.filter(upload_batch=file_upload_id):
+            self.assertTrue(file_object.is_upload)
+            with file_object.open('rb') as f:
+                saved[file_object.file_path] = f.read()
+        self.assertEqual(saved, files)
+
+    def assert_rejected(self, archive, reason):
+        files = self.data_files()
+        self.assertEqual(save_archive(archive), (reason, 400, None))
+        # Nothing is left by the rejected archive.
+        self.assertFalse(File.objects.exists())
+        self.assertFalse(UploadBatch.objects.exists())
+        self.assertEqual(self.data_files(), files)
+
+    def test_zip(self):
+        self.assert_saved(make_zip(self.FILES), self.FILES)
+
+    def test_tar_gz(self):
+        self.assert_saved(make_tar(self.FILES), self.FILES)
+
+    def test_path_traversal(self):
+        for name in ['../a.py', 'RPi/../../a.py', '/etc/a.py']:
+            files = dict(self.FILES, **{name: b'a'})
+            for archive in [make_zip(files), make_tar(files)]:
+                self.assert_rejected(archive, 'Invalid file path: %s' % name)
+
+    def test_tar_links_ignored(self):
+        # The links are not followed or extracted.
+        self.assert_saved(
+            make_tar(self.FILES, {'RPi/passwd': '/etc/passwd', 'RPi/up': '../..'}),
+            self.FILES
+        )
+
+    @override_settings(ARCHIVE_UPLOAD_MAX_SIZE=1500)
+    def test_size_limit(self):
+        files = {'a.py': b'a' * 1000}
+        self.assert_saved(make_zip(files), files)
+        File.objects.all().delete()
+        UploadBatch.objects.all().delete()
+        for archive in [make_zip(dict(files, **{'b.py': b'b' * 1000})),
+                        make_tar({'a.py': b'a' * 2000})]:
+            self.assert_rejected(archive, 'Archive is too large.')
+
+    def test_invalid_archive(self):
+        self.assert_rejected(
+            io.BytesIO(b'not an archive'), 'Invalid archive, should be zip or tar(.gz).')
+        self.assert_rejected(make_zip({}), 'No file in the archive.')
+
+
+class ArchiveViewTest(DataDirTransactionTestCase):
+    def test_failed_library_removes_files(self):
+        # The extracted files are removed if the library can't be created.
+        archive = make_zip(ArchiveUploadTest.FILES)
+        archive.name = 'RPi.zip'
+        response = self.client.post('/api/library/Python/100', {'file': archive})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(File.objects.exists())
+        self.assertFalse(UploadBatch.objects.exists())
+        self.assertEqual(self.data_files(), ['datas/upload/blobs/.lock'])
+
+
+class BlobTest(DataDirTransactionTestCase):
+    CONTENT = b'GPIO = 1\n'
+
+    def save_files(self, *contents):
+        # Upload the files with the contents, return them in the same order.
+        file_upload_id = self.upload({
+            'f%d.py' % i: content for i, content in enumerate(contents)})
+        return list(File.objects.filter(
+            upload_batch=file_upload_id).order_by('file_path'))
+
+    def blob_paths(self):
+        return [path for path in self.data_files() if '/blobs/' in path
+                and not path.endswith('.lock')]
+
+    def read(self, file_object):
+        file_object.refresh_from_db()
+        with file_object.open('rb') as f:
+            return f.read()
+
+    def test_dedup(self):
+        # The files with the same content share one blob, in the same upload or not.
+        a, b, c = self.save_files(self.CONTENT, self.CONTENT, b'other')
+        d, = self.save_files(self.CONTENT)
+        self.assertEqual(len({a.real_path, b.real_path, d.real_path}), 1)
+        self.assertNotEqual(a.real_path, c.real_path)
+        self.assertEqual(a.sha256, hashlib.sha256(self.CONTENT).hexdigest())
+        self.assertEqual(len(self.blob_paths()), 2)
+        # No uploaded copy is left.
+        self.assertEqual([
+            path for path in self.data_files()
+            if path.startswith(settings.FILE_UPLOAD_DIR) and '/blobs/' not in path
+        ], [])
+
+    def test_release_by_real_path(self):
+        # The blob is removed when the last file referring to it is deleted.
+        a, b = self.save_files(self.CONTENT, self.CONTENT)
+        a.delete()
+        self.assertEqual(self.read(b), self.CONTENT)
+        self.assertTrue(os.path.exists(b.real_path))
+        File.bulk_delete([b])
+        self.assertEqual(self.blob_paths(), [])
+
+    def test_detach_on_write(self):
+        # Writing a file detaches it from the blob, the other files keep the content.
+        a, b = self.save_files(self.CONTENT, self.CONTENT)
+        blob_path = a.real_path
+        a.write('new')
+        self.assertEqual(self.read(a), b'new')
+        self.assertEqual(a.sha256, '')
+        self.assertNotEqual(a.real_path, blob_path)
+        self.assertEqual(self.read(b), self.CONTENT)
+
+        # Opening for append copies the content, then the unused blob is removed.
+        with b.open('ab') as f:
+            f.write(b'x')
+        self.assertEqual(self.read(b), self.CONTENT + b'x')
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertEqual(self.blob_paths(), [])
+
+    def test_rollback_keeps_blob(self):
+        a, b = self.save_files(self.CONTENT, self.CONTENT)
+        try:
+            with transaction.atomic():
+                File.bulk_delete([a, b])
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(File.objects.count(), 2)
+        self.assertEqual(self.read(a), self.CONTENT)
+        self.assertEqual(len(self.blob_paths()), 1)
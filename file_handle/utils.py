@@ -1,13 +1,29 @@
+import hashlib
+import os
 import pathlib
+import posixpath
 import shutil
+import tarfile
+import uuid as uuid_lib
+import zipfile
 
 from django.conf import settings
+from django.db import (
+    IntegrityError,
+    transaction,
+)
+
+from api.build import file_lock
 
 from .models import (
     File,
-    UploadBatch
+    UploadBatch,
+    file_sha256,
 )
 
+# Times to generate the uuids again, if they conflict with the existing files.
+UUID_CONFLICT_RETRIES = 3
+
 
 def create_upload_batch(upload_files: list):
     """
@@ -22,30 +38,70 @@ def create_upload_batch(upload_files: list):
         'file_upload_id': <id>
     }
     """
-    upload_batch_object = UploadBatch.objects.create()
-    upload_info_dict = {}
+    def set_uuid(file_object, uuid):
+        extension = pathlib.Path(file_object.file_path).suffix
+        file_object.uuid = uuid
+        file_object.real_path = f'{settings.FILE_UPLOAD_DIR}{uuid}{extension}'
 
-    for file_path in upload_files:
-        uuid = File.uuid_generate()
-        extension = pathlib.Path(file_path).suffix
-        real_path = f'{settings.FILE_UPLOAD_DIR}{uuid}{extension}'
-
-        # Create record for upload file
-        new_file_object = File.objects.create(
-            file_path=file_path,
-            real_path=real_path,
-            uuid=uuid,
-            upload_batch=upload_batch_object
-        )
-        upload_info_dict[file_path] = new_file_object.uuid
-    upload_batch_object.save()
+    with transaction.atomic():
+        upload_batch_object = UploadBatch.objects.create()
+        # Create record for upload files
+        file_objects = [
+            File(
+                file_path=file_path,
+                upload_batch=upload_batch_object
+            )
+            for file_path in upload_files
+        ]
+        bulk_create_files(file_objects, set_uuid)
 
     return {
-        'upload_info': upload_info_dict,
+        'upload_info': {
+            file_object.file_path: file_object.uuid
+            for file_object in file_objects
+        },
         'file_upload_id': upload_batch_object.id
     }
 
 
+def bulk_create_files(file_objects, set_uuid=None):
+    """
+    Save the new files in bulk, with unique uuid4 generated in memory.
+    The uuids are only generated again if they violate the unique constraint.
+    :param file_objects: list of unsaved file_handle.models.File, the uuid is
+        generated if it's not set.
+    :param set_uuid: function(file_object, uuid), set the uuid and the fields
+        depending on it, default only sets the uuid.
+    """
+    if set_uuid is None:
+        def set_uuid(file_object, uuid):
+            file_object.uuid = uuid
+
+    for file_object in file_objects:
+        if file_object.uuid is None:
+            set_uuid(file_object, uuid_lib.uuid4())
+    for retry in range(UUID_CONFLICT_RETRIES, -1, -1):
+        try:
+            with transaction.atomic():
+                File.objects.bulk_create(file_objects)
+            return
+        except IntegrityError:
+            # Find the conflicting uuids, with the existing files or in the batch.
+            existing_uuids = set(File.objects.filter(
+                uuid__in=[file_object.uuid for file_object in file_objects]
+            ).values_list('uuid', flat=True))
+            conflict_objects = []
+            for file_object in file_objects:
+                if file_object.uuid in existing_uuids:
+                    conflict_objects.append(file_object)
+                existing_uuids.add(file_object.uuid)
+            # Not a uuid conflict, or too many retries.
+            if not conflict_objects or retry == 0:
+                raise
+            for file_object in conflict_objects:
+                set_uuid(file_object, uuid_lib.uuid4())
+
+
 def save_file(uuid: str, file):
     try:
         # Get the file item from File table.
@@ -59,18 +115,246 @@ def save_file(uuid: str, file):
 
     # Save the file in server
     # TOFIX: filetype is string, used for copying files only as a workaround
+    sha256 = None
     if type(file) is str:
         # File from cli by file path, use copy file
         shutil.copy(file, file_object.real_path)
     else:
         # File from django request, save the chunks
+        sha256 = hashlib.sha256()
         with file_object.open('wb') as fp:
             # Read uploaded file's chunk and write it to the file open from server.
             for chunk in file.chunks():
                 fp.write(chunk)
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
 
+    complete_upload(file_object, sha256)
+    return '', 200
+
+
+def complete_upload(file_object, sha256=None):
     # Set the `is_upload` flag of the file object.
     file_object.is_upload = True
+    file_object.upload_length = None
+    file_object.received_ranges = []
     file_object.save()
+    # Share the same content with the other files by the blob store.
+    file_object.store_blob(sha256)
+
+
+def merge_range(ranges, start, end):
+    # Merge the byte range [start, end) into the sorted and disjoint `ranges`.
+    result = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if result and range_start <= result[-1][1]:
+            result[-1][1] = max(result[-1][1], range_end)
+        else:
+            result.append([range_start, range_end])
+    return result
+
+
+def get_upload_state(uuid: str):
+    """
+    Get the state of the chunked upload of a file.
+    :param uuid: the uuid of the file
+    :return: None if the file is not found, or {
+        'offset': <int>,  # Size of the received data from the beginning of the file.
+        'length': <int> | None,  # Total size of the file, None before the first chunk.
+        'is_upload': <bool>  # The file is uploaded and finalized.
+    }
+    """
+    try:
+        file_object = File.objects.get(uuid=uuid)
+    except:
+        return None
+
+    ranges = file_object.received_ranges
+    return {
+        'offset': ranges[0][1] if ranges and ranges[0][0] == 0 else 0,
+        'length': file_object.upload_length,
+        'is_upload': file_object.is_upload,
+    }
+
+
+def save_file_chunk(uuid: str, offset: int, length: int, chunk, chunk_length: int):
+    """
+    Save a chunk of the file, the chunks can be sent in any order and be sent again.
+    :param uuid: the uuid of the file
+    :param offset: the position of this chunk in the file
+    :param length: the total size of the file
+    :param chunk: file-like object of the chunk's data
+    :param chunk_length: the size of the chunk's data
+    :return: (error message, status code)
+    """
+    try:
+        # Get the file item from File table.
+        file_object = File.objects.get(uuid=uuid)
+    except:
+        return 'File not found.', 404
+
+    if offset < 0 or offset > length or chunk_length < 0:
+        return 'Invalid upload offset.', 400
+    # Reject the chunk before writing any of it.
+    if offset + chunk_length > length:
+        return 'Chunk exceeds the upload length.', 400
 
+    # The chunks of the same file are saved one by one in all the processes,
+    # so none of the received ranges is lost. SQLite has no row lock.
+    with file_lock('upload-%s' % file_object.uuid):
+        file_object.refresh_from_db()
+        if file_object.is_upload:
+            # File has been uploaded
+            return 'File already uploaded.', 400
+        if file_object.upload_length not in (None, length):
+            return 'Upload length changed.', 400
+
+        # Write the chunk at its offset. The file is not truncated,
+        # so the other received chunks are kept.
+        size = 0
+        fd = os.open(file_object.real_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.seek(offset)
+            # Never read more than `chunk_length`, so the file never exceeds `length`.
+            for data in iter(
+                lambda: chunk.read(min(64 * 1024, chunk_length - size)), b''
+            ):
+                fp.write(data)
+                size += len(data)
+
+        # Record the received range.
+        file_object.upload_length = length
+        file_object.received_ranges = merge_range(
+            file_object.received_ranges,
+            offset,
+            offset + size
+        )
+        file_object.save()
     return '', 200
+
+
+def finalize_file(uuid: str, sha256: str = None):
+    """
+    Finish the chunked upload of the file when all of its chunks are received.
+    :param uuid: the uuid of the file
+    :param sha256: the SHA-256 of the file computed by the client, optional.
+    :return: (error message, status code)
+    """
+    try:
+        # Get the file item from File table.
+        file_object = File.objects.get(uuid=uuid)
+    except:
+        return 'File not found.', 404
+
+    # Not finalized while its chunks are saved, see `save_file_chunk`.
+    with file_lock('upload-%s' % file_object.uuid):
+        file_object.refresh_from_db()
+        if file_object.is_upload:
+            # File has been uploaded
+            return 'File already uploaded.', 400
+        if (file_object.upload_length is None
+                or file_object.received_ranges != [[0, file_object.upload_length]]):
+            return 'File is not completely uploaded.', 400
+
+        digest = file_sha256(file_object.real_path)
+        if sha256 and sha256 != digest:
+            # Drop the received data, the file needs to be uploaded again.
+            os.remove(file_object.real_path)
+            file_object.upload_length = None
+            file_object.received_ranges = []
+            file_object.save()
+            return 'SHA-256 mismatch.', 400
+
+        complete_upload(file_object, digest)
+    return '', 200
+
+
+def _archive_members(archive):
+    # Yield (path, file-like object) of the regular files in the zip or tar(.gz) archive.
+    # The tar archive is read in a single streaming pass.
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zip_file:
+            for info in zip_file.infolist():
+                if info.is_dir():
+                    continue
+                with zip_file.open(info) as fp:
+                    yield info.filename, fp
+    else:
+        archive.seek(0)
+        with tarfile.open(fileobj=archive, mode='r|*') as tar_file:
+            for info in tar_file:
+                # Ignore directories, links and the other special files.
+                if not info.isfile():
+                    continue
+                yield info.name, tar_file.extractfile(info)
+
+
+def save_archive(archive):
+    """
+    Extract the zip or tar(.gz) archive into the File store, and create an upload
+    batch of the extracted files, the same as uploading the files one by one.
+    The paths in the archive are used as the files' paths.
+    :param archive: file-like object of the archive
+    :return: (error message, status code, file_upload_id)
+    """
+    # [(file_path, uuid, real_path, sha256), ...]
+    extracted = []
+    total_size = 0
+    try:
+        for name, fp in _archive_members(archive):
+            file_path = posixpath.normpath(name)
+            if (file_path.startswith('/') or file_path == '.'
+                    or '..' in file_path.split('/')):
+                raise ValueError(f'Invalid file path: {name}')
+            if len(file_path) > File._meta.get_field('file_path').max_length:
+                raise ValueError(f'File path too long: {name}')
+
+            uuid = uuid_lib.uuid4()
+            extension = pathlib.Path(file_path).suffix
+            real_path = f'{settings.FILE_UPLOAD_DIR}{uuid}{extension}'
+            sha256 = hashlib.sha256()
+            extracted.append((file_path, uuid, real_path, None))
+            with open(real_path, 'wb') as dst:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                    total_size += len(chunk)
+                    if total_size > settings.ARCHIVE_UPLOAD_MAX_SIZE:
+                        raise ValueError('Archive is too large.')
+                    dst.write(chunk)
+                    sha256.update(chunk)
+            extracted[-1] = (file_path, uuid, real_path, sha256.hexdigest())
+        if not extracted:
+            raise ValueError('No file in the archive.')
+    except Exception as e:
+        for __, __, real_path, __ in extracted:
+            try:
+                os.remove(real_path)
+            except FileNotFoundError:
+                pass
+        if isinstance(e, ValueError):
+            return str(e), 400, None
+        if isinstance(e, (zipfile.BadZipFile, tarfile.TarError, EOFError)):
+            return 'Invalid archive, should be zip or tar(.gz).', 400, None
+        raise
+
+    file_objects = [
+        File(
+            file_path=file_path,
+            real_path=real_path,
+            is_upload=True,
+            uuid=uuid
+        )
+        for file_path, uuid, real_path, __ in extracted
+    ]
+    with transaction.atomic():
+        upload_batch_object = UploadBatch.objects.create()
+        for file_object in file_objects:
+            file_object.upload_batch = upload_batch_object
+        bulk_create_files(file_objects)
+        # Share the same content with the other files by the blob store.
+        File.store_blobs([
+            (file_object, sha256)
+            for file_object, (__, __, __, sha256) in zip(file_objects, extracted)
+        ])
+
+    return '', 200, upload_batch_object.id
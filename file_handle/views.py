@@ -7,7 +7,10 @@ from django.views.generic.base import View
 from .models import File
 from .utils import (
     create_upload_batch,
-    save_file
+    finalize_file,
+    get_upload_state,
+    save_file,
+    save_file_chunk,
 )
 from api.utils import (
     DeviceTalkJsonResponse,
@@ -21,11 +24,15 @@ class FileView(View):
     """
     Route: DEVICETALK_POSFIX/api/file/<str:uuid>
     GET: Get the file's content.
-    POST: Upload the file to server.
+    HEAD: Get the state of the chunked upload.
+    POST: Upload the file, or a chunk of the file to server.
+    PUT: Finalize the chunked upload.
     """
     http_method_names = [
         'get',
-        'post'
+        'head',
+        'post',
+        'put',
     ]
 
     @check_login
@@ -42,27 +49,96 @@ class FileView(View):
         template = loader.get_template('view_file.html')
         return HttpResponse(template.render({'words': f.read()}, request))
 
+    @check_login
+    def head(self, request, *args, **kwargs):
+        """ This function return the state of the chunked upload in the headers,
+            so an interrupted upload can be resumed from `Upload-Offset`.
+
+        Response format::
+            Header:
+                Upload-Offset: size of the received data from the beginning of the file.
+                Upload-Length: total size of the file, empty before the first chunk.
+        """
+        state = get_upload_state(kwargs['uuid'])
+        if state is None:
+            return HttpResponse(status=404)
+        response = HttpResponse()
+        response['Upload-Offset'] = state['offset']
+        response['Upload-Length'] = '' if state['length'] is None else state['length']
+        return response
+
     @check_login
     def post(self, request, *args, **kwargs):
         """ This function that user upload the file's raw data.
+            With the `Upload-Offset` header, the body is a chunk of the file,
+            which is saved at that offset. The chunks can be sent in any order
+            and be sent again, then the upload is finished by PUT.
 
         Request format::
             Header:
                 Content-Type: application/octet-stream
+                Upload-Offset: the offset of this chunk (chunked upload only)
+                Upload-Length: the total size of the file (chunked upload only)
             Body:
-                file's raw data
+                file's raw data, or the chunk's raw data
 
         Response format::
 
             {
                 {
                     'state': 'OK',
-                    'result': {}
+                    'result': {}  # The result of `get_upload_state` for chunked upload.
                 },
             }
         """
         uuid = kwargs['uuid']
-        err_msg, code = save_file(uuid, request.FILES.get('file'))
+        if 'HTTP_UPLOAD_OFFSET' not in request.META:
+            err_msg, code = save_file(uuid, request.FILES.get('file'))
+            if err_msg:
+                return DeviceTalkErrorJsonResponse(err_msg, code)
+            else:
+                return DeviceTalkJsonResponse()
+
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META['HTTP_UPLOAD_LENGTH'])
+            chunk_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except:
+            return DeviceTalkErrorJsonResponse('Wrong request parameter.', 400)
+        err_msg, code = save_file_chunk(
+            uuid, offset, length, request, chunk_length)
+        if err_msg:
+            return DeviceTalkErrorJsonResponse(err_msg, code)
+        else:
+            return DeviceTalkJsonResponse(get_upload_state(uuid))
+
+    @check_login
+    def put(self, request, *args, **kwargs):
+        """ This function finish the chunked upload after all the chunks are received.
+
+        Request format::
+
+            {
+                'data': {
+                    'sha256': 'abc123...'  # optional, checked against the received file.
+                }
+            }
+
+        Response format::
+
+            {
+                {
+                    'state': 'OK',
+                    'result': {}
+                },
+            }
+        """
+        try:
+            body = json.loads(request.body or '{}')
+            sha256 = (body.get('data') or {}).get('sha256')
+        except:
+            return DeviceTalkErrorJsonResponse('Wrong request parameter.', 400)
+        err_msg, code = finalize_file(kwargs['uuid'], sha256)
         if err_msg:
             return DeviceTalkErrorJsonResponse(err_msg, code)
         else:
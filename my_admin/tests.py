@@ -1,3 +1,62 @@
-# from django.test import TestCase
+from django.conf import settings
 
-# Create your tests here.
+from api.models import BasicFile, Language
+from file_handle.tests import DataDirTestCase
+
+from .utils import update_basicfile
+
+CONFIG = """[templates]
+sa = SA.py
+safuncs = libraries/{sa[device_name]}_library/safuncs.py
+[new-function]
+IDF = new_idf.tpl
+ODF = new_odf.tpl
+[manual]
+url = http://manual
+[lib]
+root = libraries/
+example-dir = examples
+"""
+
+
+class UpdateBasicFileTest(DataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        Language.objects.create(name='Python')
+        self.files = {
+            settings.BASICFILE_CONF_FILENAME: CONFIG,
+            'SA.py': '# {{ sa.device_name }}\n',
+        }
+        self.assertEqual(
+            update_basicfile(self.upload(self.files), 'completed', 'Python', 'default'),
+            ('', 200)
+        )
+        self.basic_file = BasicFile.objects.get(name='default')
+
+    def test_update(self):
+        files = dict(self.files, **{'SA.py': '# new\n'})
+        self.assertEqual(update_basicfile(
+            self.upload(files), 'completed', 'Python', 'default', is_create=False
+        ), ('', 200))
+        with self.basic_file.file_set.get(file_path='SA.py').open('r') as f:
+            self.assertEqual(f.read(), '# new\n')
+
+    def test_invalid_update_keeps_basic_file(self):
+        # An invalid update is rejected, the existing basic file and its files are
+        # kept, so are its libraries and devices.
+        file_ids = set(self.basic_file.file_set.values_list('id', flat=True))
+        err_msg, code = update_basicfile(
+            self.upload({'SA.py': '# new\n'}), 'completed', 'Python', 'default',
+            is_create=False
+        )
+        self.assertEqual((err_msg, code), ('Config file not found.', 404))
+        self.assertTrue(BasicFile.objects.filter(id=self.basic_file.id).exists())
+        self.assertEqual(
+            set(self.basic_file.file_set.values_list('id', flat=True)), file_ids)
+
+    def test_invalid_create(self):
+        # An invalid new basic file is not created.
+        err_msg, code = update_basicfile(
+            self.upload({'SA.py': '# new\n'}), 'completed', 'Python', 'other')
+        self.assertEqual(code, 404)
+        self.assertFalse(BasicFile.objects.filter(name='other').exists())
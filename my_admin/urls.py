@@ -3,6 +3,7 @@ from django.urls import path
 from .views import (
     IndexView,
     BasicFileView,
+    BasicFileArchiveView,
     LanguageView
 )
 
@@ -11,5 +12,6 @@ app_name = 'my_admin'
 urlpatterns = [
     path('', IndexView.as_view(), name='index_endpoint'),
     path('file', BasicFileView.as_view(), name='file_endpoint'),
+    path('file/archive', BasicFileArchiveView.as_view(), name='file_archive_endpoint'),
     path('language', LanguageView.as_view(), name='language_endpoint'),
 ]
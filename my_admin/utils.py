@@ -60,8 +60,10 @@ def update_basicfile(file_upload_id, state, language, basicfile_name, is_create=
         err_msg, code = check_format(upload_batch_object)
         if err_msg:
             # Return error if basic file format is invalid.
+            # An existing basic file keeps its files, its libraries and devices.
             remove_file_group(upload_batch_object)
-            basic_file_object.delete()
+            if is_create:
+                basic_file_object.delete()
             return err_msg, code
 
         # All pass, move uploaded files to available basic files.
@@ -87,6 +89,13 @@ def move_file_to_basicfile(upload_batch_object, basic_file_object):
         file.basic_file = basic_file_object
         file.save()
     upload_batch_object.delete()
+    # The config file is replaced, clear the parsed one.
+    basic_file_object.invalidate_config()
+
+    # Pre-compress the static files for the device builds.
+    # `api.build` imports this module, so import it here.
+    from api.build import basic_file_bundle
+    basic_file_bundle(basic_file_object)
 
 
 def check_format(basicfile_object):
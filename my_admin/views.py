@@ -18,6 +18,7 @@ from api.utils import (
     DeviceTalkJsonResponse,
     DeviceTalkErrorJsonResponse
 )
+from file_handle.utils import save_archive
 from xtalk_account.utils import (
     check_login,
     check_is_admin
@@ -325,6 +326,67 @@ class BasicFileView(View):
         return DeviceTalkJsonResponse()
 
 
+class BasicFileArchiveView(View):
+    '''
+    Route: DEVICETALK_POSFIX/admin/file/archive
+    POST: Create or update the Basic File from a single archive.
+    '''
+    http_method_names = [
+        'post',
+    ]
+
+    @check_login
+    @check_is_admin
+    def post(self, request, *args, **kwargs):
+        """ Extract the uploaded archive and create or update the Basic File,
+            the same as uploading the files one by one then PUT or POST `file`.
+        Request format::
+            Header:
+                Content-Type: multipart/form-data
+            Body:
+                file: zip or tar(.gz) archive. The paths in the archive are the same
+                      as the uploaded files' paths, ex: `config.ini`.
+                basicfile_name: 'Default'  # name of basicfile
+                language: 'Python'  # the language this basicfile belong to
+                is_create: 'true' | 'false'  # create new Basic File or update exist one.
+
+        Sucess Response format::
+            {
+                {
+                    'state': 'OK',
+                    'result': {}
+                },
+            }
+
+        Error Response format::
+            {
+                {
+                    'state': 'error',
+                    'reason': '...'
+                },
+            }
+        """
+        archive = request.FILES.get('file')
+        if archive is None:
+            return DeviceTalkErrorJsonResponse('Archive file not found.', 400)
+        err_msg, code, file_upload_id = save_archive(archive)
+        if err_msg:
+            return DeviceTalkErrorJsonResponse(err_msg, code)
+
+        err_msg, code = update_basicfile(
+            file_upload_id,
+            'completed',
+            request.POST.get('language'),
+            request.POST.get('basicfile_name'),
+            is_create=request.POST.get('is_create', 'false').lower() == 'true',
+        )
+
+        if err_msg:
+            return DeviceTalkErrorJsonResponse(err_msg, code)
+        else:
+            return DeviceTalkJsonResponse()
+
+
 class IndexView(View):
     """
     This View return the my_admin's index page.
@@ -585,7 +585,7 @@ function init(){
                             }, 500);
                         }
                         ctx.show_manual();
-                        download_zip(data.zip_path, data.zip_name);
+                        wait_build_job(data.job_id);
                     },
                     function(reason){
                         alert(reason);
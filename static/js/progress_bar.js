@@ -16,6 +16,11 @@ var ProgressBar = {
         endpoint_prefix: {
             type: String,
             default: '/devicetalk/api/file'
+        },
+        // Size of each chunk of the upload (bytes).
+        chunk_size: {
+            type: Number,
+            default: 1024 * 1024
         }
     },
     data() {
@@ -38,17 +43,64 @@ var ProgressBar = {
     methods: {
         start: function(){
             this.state = 1;
+            let ctx = this;
+            // Ask the server how much of the file is received,
+            // so an interrupted upload is resumed instead of sent again.
+            var req = new XMLHttpRequest();
+            req.onreadystatechange = function () {
+                if (this.readyState != 4) return;
+                if (this.status == 200) {
+                    let offset = parseInt(this.getResponseHeader('Upload-Offset') || '0');
+                    let started = (this.getResponseHeader('Upload-Length') || '') != '';
+                    ctx.upload_chunk(offset, started);
+                }
+                else{
+                    ctx.state = -1;
+                    ctx.restart(this.responseText);
+                }
+            };
+            req.open("HEAD", this.endpoint_prefix+this.uuid, true);
+            req.send();
+        },
+        upload_chunk: function(offset, started){
+            // All the chunks are sent, finish the upload.
+            if (started && offset >= this.file.size){
+                this.finalize();
+                return;
+            }
             var req = new XMLHttpRequest();
             let ctx = this;
+            let end = Math.min(offset + this.chunk_size, this.file.size);
             req.upload.onprogress = function(e){
-                if (e.lengthComputable){
-                    ctx.value =  Math.floor(100 * e.loaded / e.total);
+                if (e.lengthComputable && ctx.file.size > 0){
+                    ctx.value =  Math.floor(100 * (offset + e.loaded) / ctx.file.size);
                 }
             }
             req.onreadystatechange = function () {
                 if (this.readyState != 4) return;
                 if (this.status == 200) {
                     let data = JSON.parse(this.responseText);
+                    ctx.upload_chunk(data.result.offset, true);
+                }
+                else{
+                    ctx.state = -1;
+                    ctx.restart(this.responseText);
+                }
+            };
+            req.open("POST", this.endpoint_prefix+this.uuid, true);
+            req.setRequestHeader('X-CSRFToken', csrftoken);
+            req.setRequestHeader('Content-Type', 'application/octet-stream');
+            req.setRequestHeader('Upload-Offset', offset);
+            req.setRequestHeader('Upload-Length', this.file.size);
+            req.send(this.file.slice(offset, end));
+        },
+        finalize: function(){
+            var req = new XMLHttpRequest();
+            let ctx = this;
+            req.onreadystatechange = function () {
+                if (this.readyState != 4) return;
+                if (this.status == 200) {
+                    ctx.value = 100;
                     ctx.state = 2;
                     ctx.$emit('upload_completed', ctx.index);
                 }
@@ -57,12 +109,10 @@ var ProgressBar = {
                     ctx.restart(this.responseText);
                 }
             };
-            req.open("POST", this.endpoint_prefix+this.uuid, true);
+            req.open("PUT", this.endpoint_prefix+this.uuid, true);
             req.setRequestHeader('X-CSRFToken', csrftoken);
-            req.overrideMimeType('application/octet-stream')
-            var fd = new FormData();
-            fd.append("file", this.file);
-            req.send(fd);
+            req.setRequestHeader('Content-Type', 'application/json');
+            req.send(JSON.stringify({data: {}}));
         },
         restart: function(responseText){
             if (this.restartTime > 0){
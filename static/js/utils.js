@@ -57,7 +57,7 @@ function devicetalk_api(method, path, message_object, cb_func, error_cb_func = n
             let data = JSON.parse(this.responseText);
             cb_func(data.result);
         }
-        else if (this.status == 400 ||　this.status == 404) {
+        else if (this.status == 400 ||　this.status == 404 || this.status == 503) {
             let data = JSON.parse(this.responseText);
             if (error_cb_func){
                 error_cb_func(data.reason);
@@ -92,6 +92,37 @@ function download_zip(path, name){
     delete link;
 }
 
+// Poll the state of the device build, and download the zip file when it's done.
+// Stop polling after `max_wait` milliseconds.
+function wait_build_job(job_id, interval = 1000, max_wait = 10 * 60 * 1000){
+    let path = "../../../api/build/" + job_id;
+    devicetalk_api(
+        "GET",
+        path,
+        {},
+        function (data){
+            if (data.state == "done"){
+                download_zip(path + "/download", data.zip_name);
+            }
+            else if (data.state == "failed"){
+                alert(data.reason);
+            }
+            else if (max_wait <= interval){
+                alert("The SA code is not generated in time, please save the device again.");
+            }
+            else{
+                setTimeout(
+                    () => wait_build_job(job_id, interval, max_wait - interval),
+                    interval
+                );
+            }
+        },
+        function(reason){
+            alert(reason);
+        }
+    );
+}
+
 // Generate random uuid4
 // Ref: https://stackoverflow.com/questions/105034/how-to-create-a-guid-uuid
 function uuid4() {